@@ -58,12 +58,12 @@ class ALS11012RSoXSLoader(FileLoader):
         '''
         for file in os.listdir(basepath):
             if dark_base_name in file:
-                darkimage = fits.open(basepath+file)
-                assert darkimage[0].header['CCD Shutter Inhibit']==1,"CCD Shutter was not inhibited for image "+file+"... probably not a dark."
+                header = fits.getheader(os.path.join(basepath,file),0)
+                assert header['CCD Shutter Inhibit']==1,"CCD Shutter was not inhibited for image "+file+"... probably not a dark."
 
-                exptime = round(darkimage[0].header['EXPOSURE'],2)
+                exptime = round(header['EXPOSURE'],2)
 
-                self.darks[exptime] = darkimage[2].data
+                self.darks[exptime] = fits.getdata(os.path.join(basepath,file),ext=2)
 
                 
     def loadSampleSpecificDarks(self,basepath,file_filter='',file_skip='donotskip',md_filter={}):
@@ -83,39 +83,39 @@ class ALS11012RSoXSLoader(FileLoader):
         
         for file in os.listdir(basepath):
             if (re.match(self.file_ext,file) is not None) and file_filter in file and file_skip not in file:
-                if self.md_loading_is_quick:
-                    #if metadata loading is quick, we can just peek at the metadata and decide what to do
-                    md = self.peekAtMd(basepath+file)
-                    img = None
-                else:
-                        input_image = fits.open(basepath+file)
-                        md = self.normalizeMetadata(dict(zip(input_image[0].header.keys(),input_image[0].header.values())))
-                        img = input_image[2].data
+                # headers are cheap to read, so only darks that pass md_filter have their pixels loaded
+                md = self.peekAtMd(os.path.join(basepath,file))
                 load_this_image = True
                 for key,val in md_filter.items():
                     if md[key] != md_filter[key]:
                         load_this_image = False
                         #print(f'Not loading {file}, expected {key} to be {val} but it was {md[key]}')
                 if load_this_image:
-                    if img == None:
-                        input_image = fits.open(basepath+file)
-                        img = input_image[2].data
                     print(f'Loading dark for {md["EXPOSURE"]} from {file}')
                     exptime = md['EXPOSURE']
-                    self.darks[exptime] = img
-    def loadSingleImage(self,filepath,coords=None,return_q=False,**kwargs):
+                    self.darks[exptime] = fits.getdata(os.path.join(basepath,file),ext=2)
+    def loadSingleImage(self,filepath,coords=None,return_q=False,image_slice=None,**kwargs):
         '''
         THIS IS A HELPER FUNCTION, mostly - should not be called directly unless you know what you are doing
 
 
         Load a single image from filepath and return a single-image, raw xarray, performing dark subtraction if so configured.
 
+        Args:
+            image_slice (tuple of slices): if provided, only this (pix_x, pix_y) region of the image is read from disk
+
         '''
         if len(kwargs.keys())>0:
             warnings.warn(f'Loader does not support features for args: {kwargs.keys()}',stacklevel=2)
-        input_image = fits.open(filepath)
-        headerdict =  self.normalizeMetadata(dict(zip(input_image[0].header.keys(),input_image[0].header.values())))
-        img = input_image[2].data
+        if image_slice is None:
+            image_slice = ()
+        image_slice = tuple(image_slice)
+        # section does positioned reads of just the rows in image_slice.  memmap stays off because unsigned CCD
+        # images carry BZERO scaling, which astropy cannot apply to a memory map.
+        with fits.open(filepath,memmap=False,lazy_load_hdus=True) as input_image:
+            headerdict =  self.normalizeMetadata(dict(zip(input_image[0].header.keys(),input_image[0].header.values())))
+            full_shape = input_image[2].shape
+            img = input_image[2].section[image_slice]
         # two steps in this pre-processing stage: 
         #     (1) get and apply the right scalar correction term to the image
         #     (2) find and subtract the right dark
@@ -149,15 +149,16 @@ class ALS11012RSoXSLoader(FileLoader):
                 darkimg = self.darks[headerdict['EXPOSURE']]
             except KeyError:
                 warnings.warn(f"Could not find a dark image with exposure time {headerdict['EXPOSURE']}.  Using zeros.",stacklevel=2)
-                darkimg = np.zeros_like(img)
+                darkimg = np.zeros(full_shape)
+            darkimg = darkimg[image_slice]
 
             img = (img-darkimg+self.dark_pedestal)/corr
         
         # now, match up the dims and coords
         if return_q:
             qpx = 2*np.pi*60e-6/(headerdict['sdd']/1000)/(headerdict['wavelength']*1e10)
-            qx = (np.arange(1,img.shape[0]+1)-headerdict['beamcenter_x'])*qpx
-            qy = (np.arange(1,img.shape[1]+1)-headerdict['beamcenter_y'])*qpx
+            qx = (np.arange(1,full_shape[0]+1)[image_slice[0] if len(image_slice)>0 else slice(None)]-headerdict['beamcenter_x'])*qpx
+            qy = (np.arange(1,full_shape[1]+1)[image_slice[1] if len(image_slice)>1 else slice(None)]-headerdict['beamcenter_y'])*qpx
             # now, match up the dims and coords
             return xr.DataArray(img,dims=['qy','qx'],coords={'qy':qy,'qx':qx},attrs=headerdict)
         return xr.DataArray(img,dims=['pix_x','pix_y'],attrs=headerdict)
@@ -166,11 +167,13 @@ class ALS11012RSoXSLoader(FileLoader):
         '''
         load the header/metadata without opening the corresponding image
 
+        Only the primary HDU header is parsed, and the file is closed before returning.
+
         Args:
             file (str): fits file from which to load metadata
         '''
-        input_image = fits.open(file)
-        headerdict =  self.normalizeMetadata(dict(zip(input_image[0].header.keys(),input_image[0].header.values())))
+        header = fits.getheader(file,0)
+        headerdict =  self.normalizeMetadata(dict(zip(header.keys(),header.values())))
         return headerdict
     
     
@@ -11,7 +11,6 @@ import PyHyperScattering
 import pandas
 import json
 
-from collections import defaultdict
 from . import _version
 phs_version = _version.get_versions()['version']
 
@@ -35,13 +34,24 @@ class FileIO:
         with open(filename, 'wb') as file:
             pickle.dump(self._obj, file)
             
-    def saveNexus(self,fileName,compression=5):
+    def saveNexus(self,fileName,compression=5,chunks=None):
+        '''
+        Write this array to a NeXus/canSAS HDF5 file.
+
+        The intensity is stored as a chunked dataset.  Dask-backed arrays are streamed to disk one block at a time, so
+        the array never has to fit in memory.
+
+        Args:
+            fileName (str or Path): file to write
+            compression (int, default 5): gzip level for the intensity dataset
+            chunks (tuple or None): HDF5 chunk shape for the intensity.  If None, every chunk holds whole frames
+                                    (full chi/q, qx/qy or pix_x/pix_y extent) and about 1 MB of data.
+        '''
         data = self._obj
         timestamp = datetime.datetime.now()
         # figure out if xr is a raw or integrated array
         
         axes = list(data.indexes.keys())
-        array_to_save = data.variable.to_numpy()
         dims_of_array_to_save = data.variable.dims
     
         dim_to_index = {}
@@ -72,7 +82,9 @@ class FileIO:
             nonspatial_coords.remove('q')
         else:
             raise Exception(f'Invalid PyHyper_type {self.pyhyper_type}.  Cannot write Nexus.')
-        raw_axes = list(data.indexes.keys())
+        # I_axes is read back as the dim order, and newer xarray also lists MultiIndex levels in .indexes,
+        # so list the dimension indexes in array order
+        raw_axes = [axis for axis in dims_of_array_to_save if axis in data.indexes]
             
             # create the HDF5 NeXus file
         with h5py.File(fileName, "w") as f:
@@ -121,7 +133,14 @@ class FileIO:
                     raise Exception(f'Invalid PyHyper_type {self.pyhyper_type}.  Cannot write Nexus.')
             '''
             
-            ds = nxdata.create_dataset(u'I', data=array_to_save,compression=compression)
+            if chunks is None:
+                chunks = _frame_chunks(data.shape,[dim in _frame_dims for dim in dims_of_array_to_save],data.dtype.itemsize)
+            ds = nxdata.create_dataset(u'I',shape=data.shape,dtype=data.dtype,chunks=chunks,compression=compression)
+            if _is_dask_collection(data.variable.data):
+                import dask.array as da
+                da.store(data.variable.data,ds,lock=True)
+            else:
+                ds[...] = data.variable.values
             ds.attrs[u'units'] = u'arbitrary'
             ds.attrs[u'long_name'] = u'Intensity (arbitrary units)'    # suggested X axis plot label
             # the following are to enable compatibility with Nika canSAS loading
@@ -135,14 +154,13 @@ class FileIO:
                 if type(data.indexes[axis]) == pandas.core.indexes.multi.MultiIndex:
                     idx = data.indexes[axis]
                     I_axes = I_axes[:-1]+'('
-                    lvls = idx.levels
-                    multiindex_arrays = defaultdict(list)
-                    for row in idx:
-                        for n,level in enumerate(lvls):
-                            multiindex_arrays[level.name].append(row[n])
-                    for level in lvls:
-                        ds = nxdata.create_dataset(level.name, data=multiindex_arrays[level.name])
-                        I_axes += f'{level.name};'
+                    for n,name in enumerate(idx.names):
+                        # one typed column per level, built by pandas rather than row by row
+                        values = idx.get_level_values(n).values
+                        if values.dtype.kind in 'OU':
+                            values = values.astype(h5py.string_dtype())
+                        ds = nxdata.create_dataset(name, data=values)
+                        I_axes += f'{name};'
                         ds.attrs[u'PyHyper_origin'] = axis
                     I_axes = I_axes[:-1]+'),'
                 else:
@@ -202,9 +220,68 @@ class FileIO:
 def loadPickle(filename):
     return pickle.load( open( filename, "rb" ) )
 
-def loadNexus(filename):
-    with h5py.File(filename, "r") as f:    
-        ds = xr.DataArray(f['entry']['sasdata']['I'],
+_frame_dims = ('pix_x','pix_y','qx','qy','chi','q')
+
+def _is_dask_collection(arr):
+    try:
+        import dask
+    except ImportError:
+        return False
+    return dask.is_dask_collection(arr)
+
+def _frame_chunks(shape,is_frame_dim,itemsize,target_bytes=2**20):
+    '''
+    HDF5 chunk shape that keeps whole frames together: full extent along frame dims, and along the innermost other
+    dim as many frames as fit in target_bytes.
+    '''
+    chunks = [n if frame else 1 for n,frame in zip(shape,is_frame_dim)]
+    frame_bytes = itemsize*int(np.prod(chunks))
+    stacked = [i for i,frame in enumerate(is_frame_dim) if not frame]
+    if len(stacked)>0:
+        chunks[stacked[-1]] = int(min(shape[stacked[-1]],max(1,target_bytes//max(frame_bytes,1))))
+    return tuple(max(1,c) for c in chunks)
+
+class HDF5Source():
+    '''
+    Picklable, array-like view of an HDF5 dataset that opens the file only while a slice is being read.
+
+    Wrapping one in dask.array.from_array gives a lazy array with no open file handle, which can be shipped to
+    distributed workers and kept in long-running sessions.
+    '''
+    def __init__(self,filename,path):
+        self.filename = str(filename)
+        self.path = path
+        with h5py.File(self.filename,'r') as f:
+            ds = f[path]
+            self.shape = ds.shape
+            self.dtype = ds.dtype
+            self.chunks = ds.chunks
+        self.ndim = len(self.shape)
+
+    def __getitem__(self,key):
+        with h5py.File(self.filename,'r') as f:
+            return f[self.path][key]
+
+def loadNexus(filename,lazy=False,chunks='auto'):
+    '''
+    Load a file written by saveNexus.
+
+    Args:
+        filename (str or Path): file to read
+        lazy (bool, default False): return a Dask-backed array that reads blocks from disk on demand, rather than
+                                    reading the whole intensity dataset now
+        chunks: Dask chunks for a lazy load.  'auto' picks sizes that are whole multiples of the stored HDF5 chunks.
+    '''
+    with h5py.File(filename, "r") as f:
+        if lazy:
+            import dask.array as da
+            source = HDF5Source(filename,'entry/sasdata/I')
+            if chunks == 'auto' and source.chunks is not None:
+                chunks = da.core.normalize_chunks('auto',source.shape,dtype=source.dtype,previous_chunks=source.chunks)
+            intensity = da.from_array(source,chunks=chunks)
+        else:
+            intensity = f['entry']['sasdata']['I'][()]
+        ds = xr.DataArray(intensity,
                   dims=_parse_Iaxes(f['entry']['sasdata'].attrs['I_axes']),
                  coords = _make_coords(f))
 
@@ -272,6 +349,14 @@ def _parse_multiindex_Iaxes(axis):
     axis = axis.split('(')[1]
     return axis.split(';')
 
+def _read_column(ds):
+    '''
+    read a whole 1D coordinate dataset, decoding string columns to str
+    '''
+    if h5py.check_string_dtype(ds.dtype) is not None:
+        return ds.asstr()[()]
+    return ds[()]
+
 def _make_coords(f):
     axes = _parse_Iaxes(f['entry']['sasdata'].attrs['I_axes'],suppress_multiindex=True)
     axes_raw = _parse_Iaxes(f['entry']['sasdata'].attrs['I_axes'],suppress_multiindex=False)
@@ -284,11 +369,11 @@ def _make_coords(f):
             names = []
             for level in levels:
                 names.append(level)
-                vals.append(f['entry']['sasdata'][level])
+                vals.append(_read_column(f['entry']['sasdata'][level]))
             #print(names)
             #print(vals)
             coords[axes[n]] = pandas.MultiIndex.from_arrays(vals,names=names)
         else:
-            coords[axes[n]] = f['entry']['sasdata'][axis]
+            coords[axes[n]] = _read_column(f['entry']['sasdata'][axis])
 
     return coords
\ No newline at end of file
@@ -7,6 +7,9 @@ import warnings
 import math
 import numpy as np
 import pathlib
+import concurrent.futures
+import collections
+import itertools
 from tqdm.auto import tqdm
 
 class FileLoader():
@@ -32,10 +35,51 @@ class FileLoader():
     
     def peekAtMd(self,filepath):
         return self.loadSingleImage(filepath,{})
-    
 
+    def _seriesMd(self,filepath,local_coords,output_qxy,image_slice,peek_only=None):
+        '''
+        metadata for one file of a series, and the image itself if reading the metadata meant loading the pixels.
+        peek_only (default md_loading_is_quick) reads just the metadata; otherwise the whole image is loaded once and
+        its attrs used.
+        '''
+        if peek_only is None:
+            peek_only = self.md_loading_is_quick
+        if peek_only:
+            #if metadata loading is quick, we can just peek at the metadata and decide what to do
+            md = dict(self.peekAtMd(filepath))
+            md.update(local_coords)
+            return md,None
+        img = self.loadSingleImage(filepath,coords=local_coords,return_q=output_qxy,image_slice=image_slice)
+        return img.attrs,img
+
+    def _map(self,func,items,workers):
+        '''
+        map func over items with a progress bar, on a thread pool if workers > 1.  results keep the order of items.
+        '''
+        if workers is not None and workers > 1:
+            # reads are I/O-bound and the file libraries release the GIL, so threads overlap them
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                return list(tqdm(pool.map(func,items),total=len(items)))
+        return [func(item) for item in tqdm(items)]
+
+    def _imap(self,func,items,workers):
+        '''
+        like _map, but yields results in order as they complete, with at most 2*workers calls in flight, so results
+        consumed straight away are never all held at once.
+        '''
+        if workers is None or workers <= 1:
+            yield from (func(item) for item in tqdm(items))
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool, tqdm(total=len(items)) as pbar:
+            items = iter(items)
+            pending = collections.deque(pool.submit(func,item) for item in itertools.islice(items,2*workers))
+            while len(pending) > 0:
+                result = pending.popleft().result()
+                pending.extend(pool.submit(func,item) for item in itertools.islice(items,1))
+                pbar.update(1)
+                yield result
 
-    def loadFileSeries(self,basepath,dims,coords={},file_filter=None,file_filter_regex=None,file_skip=None,md_filter={},quiet=True,output_qxy=False,dest_qx=None,dest_qy=None,output_raw=False,image_slice=None):
+    def loadFileSeries(self,basepath,dims,coords={},file_filter=None,file_filter_regex=None,file_skip=None,md_filter={},quiet=True,output_qxy=False,dest_qx=None,dest_qy=None,output_raw=False,image_slice=None,workers=None,memmap_file=None,duplicates='drop'):
         '''
         Load a series into a single xarray.
         
@@ -54,6 +98,13 @@ class FileLoader():
             dest_qx (array-like or None): set of qx points that you would like the final stack to have.  If None, will take the middle image and remesh to that.
             dest_qy (array-like or None): set of qy points that you would like the final stack to have.  If None, will take the middle image and remesh to that.
             image_slice(tuple of slices): If provided, all images will be reduced according to these slice objects
+            workers (int or None): number of threads reading files concurrently.  None or 1 reads serially.  Files are
+                                   always assembled in sorted name order, whatever order the reads finish in.
+            memmap_file (str, Path or None): if provided, the pixel stack is written to this .npy file and returned
+                                   memory-mapped, rather than held in RAM.  Ignored with output_qxy.
+            duplicates (str, default 'drop'): what to do with images whose dims values match an earlier image.  'drop'
+                                   skips them with a warning, 'keep' loads them as separate frames, and 'sum' or
+                                   'mean' combine them into the first frame with those values (e.g. repeated exposures).
         
         '''
         if type(basepath) != pathlib.Path:
@@ -67,8 +118,9 @@ class FileLoader():
         dest_coords = defaultdict(list)
         if file_filter_regex is not None:
             file_filter_regex = re.compile(file_filter_regex)
-            
-        for file in tqdm(sorted(os.listdir(basepath))):
+
+        files_to_load = []
+        for file in sorted(os.listdir(basepath)):
             nprocessed += 1
             
             if re.match(self.file_ext,file) is None:
@@ -82,59 +134,97 @@ class FileLoader():
                 
             if (file_skip is not None) and (file_skip in file):
                 continue
-            
+            files_to_load.append(file)
+        nloaded = len(files_to_load)
+
+        def peek(file):
             local_coords = {}
             for key,value in coords.items():
-                local_coords[key] = value[file] 
-           
-            if self.md_loading_is_quick:
-                #if metadata loading is quick, we can just peek at the metadata and decide what to do
-                md = self.peekAtMd(basepath/file)
-                img = None
-            else:
-                img = self.loadSingleImage(basepath/file,coords=local_coords,image_slice=image_slice)
-                md = self.peekAtMd(basepath/file)
+                local_coords[key] = value[file]
+            return (file,local_coords)+self._seriesMd(basepath/file,local_coords,output_qxy,image_slice,peek_only)
+
+        if duplicates not in ('drop','keep','sum','mean'):
+            raise ValueError(f'unsupported duplicates mode {duplicates}, expected "drop", "keep", "sum" or "mean"')
+
+        def allocate(first,nframes,filename):
+            # sums of integer frames are widened so they cannot wrap, and means are float
+            dtype = first.dtype
+            if duplicates == 'mean':
+                dtype = np.result_type(dtype,np.float64)
+            elif duplicates == 'sum' and dtype.kind in 'biu':
+                dtype = np.result_type(dtype,np.int64)
+            shape = (nframes,)+first.shape
+            if filename is not None:
+                return np.lib.format.open_memmap(filename,mode='w+',dtype=dtype,shape=shape)
+            return np.empty(shape,dtype=dtype)
+
+        # Quick loaders peek at the metadata first only when md_filter can reject files.  Otherwise pass 1 reads each
+        # file once, and (without output_qxy) its pixels go straight into the stack and are released, so the series is
+        # never held twice.  The stack is sized for every file and trimmed once filtering and duplicates are settled.
+        peek_only = self.md_loading_is_quick and len(md_filter) > 0
+        streamed = not (peek_only or output_qxy)
+        partial_file = None if memmap_file is None else f'{memmap_file}.partial'
+        stack = None
+        first = None
+
+        # pass 1: settle which files are kept and how many frames the stack will have.
+        # to_load holds one list of files per output frame; seen maps each dim-value tuple to its frame.
+        to_load = []
+        seen = {}
+        for file,local_coords,md,img in self._imap(peek,files_to_load,workers):
             load_this_image = True
-            nloaded+=1
             for key,val in md_filter.items():
                 if md[key] != md_filter[key]:
                     load_this_image = False
                     if not quiet:
                         print(f'Not loading {file}, expected {key} to be {val} but it was {md[key]}')
             if load_this_image:
-                if img == None:
+                key = tuple(md[dim] for dim in dims)
+                try:
+                    row = seen.get(key)
+                except TypeError: # unhashable metadata value, e.g. a list; fall back to its repr
+                    key = repr(key)
+                    row = seen.get(key)
+                if row is None or duplicates == 'keep':
+                    row = len(to_load)
+                    seen[key] = row
+                    to_load.append([])
+                    for dim in dims:
+                        dest_coords[dim].append(md[dim])
+                elif duplicates == 'drop':
+                    warnings.warn(f'Duplicate image detected while loading... skipping this image {md}',stacklevel=2)
+                    continue
+                if streamed:
+                    if first is None:
+                        first = img
+                        stack = allocate(first,len(files_to_load),partial_file)
+                    if img.shape != first.shape:
+                        raise ValueError(f'Image {file} has shape {img.shape}, but the first image in this series has shape {first.shape}.  Cannot stack.')
+                    if len(to_load[row]) == 0:
+                        stack[row] = img.values
+                    else:
+                        stack[row] += img.values
+                    img = None
+                to_load[row].append((file,local_coords,img))
+
+        def load(group):
+            imgs = []
+            for file,local_coords,img in group:
+                if img is None:
                     if not quiet:
                         print(f'Loading {file}')
-                    img = self.loadSingleImage(basepath/file,coords=local_coords, return_q = output_qxy,image_slice=image_slice,use_cached_md=False)
+                    img = self.loadSingleImage(basepath/file,coords=local_coords,return_q=output_qxy,image_slice=image_slice)
                     # this is a dataarray with dims ['pix_x', 'pix_y']+attrs (standardized)
                     # e.g. generated by img = xr.DataArray(img,dims=['pix_x','pix_y'],
                     #      coords={},attrs=headerdict)
-                is_duplicate = []
+                imgs.append(img)
+            if len(imgs) == 1:
+                return imgs[0]
+            total = np.sum([img.values for img in imgs],axis=0)
+            if duplicates == 'mean':
+                total = total/len(imgs)
+            return imgs[0].copy(data=total)
 
-                try:
-                    reshaped_md = [{key:dest_coords[key][i] for key in dest_coords.keys()} for i in range(len(list(dest_coords.values())[0]))]
-                    # Tyler Martin (tyler.martin@nist.gov) personally claims that the preceding line is the most Pythonic line of code he has
-                    # ever seen, and respectfully submits that he should be declared BDFL on the basis of this line.
-                    # Seriously, all this does is take dest_coords (a dict of lists) and reshape it to a list of dicts, it's just a mess.
-
-                    for entry in reshaped_md:
-                        duplicate = True
-                        for key,val in entry.items():
-                            if img.attrs[key] != val:
-                                duplicate = False
-                        if duplicate:
-                            break
-                except IndexError: # handle the edge case of the first run, where dest_coords has no keys.  Can't be a duplicate if there's nothing to duplicate ;)
-                    duplicate=False
-                if duplicate:
-                    warnings.warn(f'Duplicate image detected while loading... skipping this image {img.attrs}',stacklevel=2)
-                else:
-                    data_rows.append(img)
-                    for dim in dims:
-                        dest_coords[dim].append(img.attrs[dim])
-
-            #update_progress(float(nprocessed)/nfiles,prestring="Loading file " + str(nprocessed) + " of "+
-            #    str(nfiles)+" -- "+file)
         #prepare the index...
         dest_coords_sorted = sorted(dest_coords.items())
         
@@ -158,6 +248,8 @@ class FileLoader():
             raise ValueError('This load found files, but none were deemed loadable.\nThis usually means that you set a file_filter or md_filter that was too restrictive, or your directory is wrong.\nCheck and rerun') from e
         index.name = 'system'
         if output_qxy:
+            # every frame is remeshed onto its own q grid, so these still have to be gathered before stacking
+            data_rows = self._map(load,to_load,workers)
             #come up with destination qx/qy here
             if 'energy' in dest_coords.keys():
                 en_sorted = np.sort(dest_coords['energy'])
@@ -176,8 +268,48 @@ class FileLoader():
                 data_rows_transformed.append(
                     row.interp(coords={'qx':dest_qx,'qy':dest_qy}))
             data_rows = data_rows_transformed
-        #this doesn't work post-xarray 2022.3  out = xr.concat(data_rows,dim=index)
-        out = xr.concat(data_rows,dim='system').assign_coords({'system':('system',index)})
+            #this doesn't work post-xarray 2022.3  out = xr.concat(data_rows,dim=index)
+            out = xr.concat(data_rows,dim='system').assign_coords({'system':('system',index)})
+        elif streamed:
+            if duplicates == 'mean':
+                for row,group in enumerate(to_load):
+                    if len(group) > 1:
+                        stack[row] /= len(group)
+            nframes = len(to_load)
+            if memmap_file is not None:
+                partial = stack
+                partial.flush()
+                if nframes == len(partial):
+                    del partial,stack
+                    os.replace(partial_file,memmap_file)
+                    stack = np.load(memmap_file,mmap_mode='r+')
+                else:
+                    stack = allocate(first,nframes,memmap_file)
+                    for n in range(nframes):
+                        stack[n] = partial[n]
+                    del partial
+                    os.remove(partial_file)
+            elif nframes < len(stack):
+                stack.resize((nframes,)+first.shape,refcheck=False)
+        else:
+            # pass 2: the first frame fixes shape and dtype, then every frame is copied straight into one buffer
+            first = load(to_load[0])
+            stack = allocate(first,len(to_load),memmap_file)
+            stack[0] = first.values
+            to_load[0] = None
+
+            def fill(n):
+                img = load(to_load[n])
+                if img.shape != first.shape:
+                    raise ValueError(f'Image {to_load[n][0][0]} has shape {img.shape}, but the first image in this series has shape {first.shape}.  Cannot stack.')
+                stack[n] = img.values
+                to_load[n] = None
+
+            self._map(fill,range(1,len(to_load)),workers)
+        if not output_qxy:
+            out = xr.DataArray(stack,dims=('system',)+first.dims,
+                               coords={k:v for k,v in first.coords.items() if set(v.dims) <= set(first.dims)},
+                               attrs=first.attrs).assign_coords({'system':('system',index)})
         out.attrs.update({'dims_unpacked':dims})
         if not output_qxy and not output_raw:
             out = out.assign_coords(pix_x=('pix_x',np.arange(0,len(out.pix_x))),pix_y=('pix_y',np.arange(0,len(out.pix_y))))
@@ -1,4 +1,8 @@
 import scipy.optimize
+import functools
+import inspect
+import concurrent.futures
+import warnings
 import xarray as xr
 import numpy as np
 import pandas as pd
@@ -28,20 +32,67 @@ DataArrayGroupBy.progress_map = inner_generator(df_function='map')
 DatasetGroupBy.progress_map = inner_generator(df_function='map')
 #end monkey patch
 
+# per-process state for Fitting.apply_processes workers
+_fit_worker_state = {}
+
+def _fit_worker_init(fit_func,warm_start,kwargs):
+    _fit_worker_state['fit_func'] = fit_func
+    _fit_worker_state['warm_start'] = warm_start
+    _fit_worker_state['kwargs'] = kwargs
+
+def _fit_worker_chunk(chunk):
+    fit_func = _fit_worker_state['fit_func']
+    kwargs = dict(_fit_worker_state['kwargs'])
+    user_guess = kwargs.pop('guess',None)
+    results = []
+    previous = None
+    for i in range(chunk.sizes['temp_fit_axis']):
+        curve = chunk.isel(temp_fit_axis=[i])
+        # copied, since fit functions like fit_lorentz edit their guess in place
+        cold_guess = list(user_guess) if isinstance(user_guess,(list,tuple)) else user_guess
+        if previous is not None:
+            kwargs['guess'] = list(previous)
+            try:
+                res = fit_func(curve,**kwargs)
+            except Exception:
+                # e.g. a warm guess built from extra returned variables that fit_func cannot take; fit from cold
+                previous = None
+        if previous is None:
+            if cold_guess is None:
+                kwargs.pop('guess',None)
+            else:
+                kwargs['guess'] = cold_guess
+            res = fit_func(curve,**kwargs)
+        results.append(res)
+        previous = None
+        if _fit_worker_state['warm_start'] and type(res) == xr.Dataset:
+            params = [float(res[name].mean()) for name in res.data_vars]
+            # the previous solution only stands in for a user guess of the same length
+            if np.all(np.isfinite(params)) and (user_guess is None or len(params) == len(user_guess)):
+                previous = params
+    return results
+
 @xr.register_dataset_accessor('fit')
 @xr.register_dataarray_accessor('fit')
 class Fitting:
     def __init__(self,xr_obj):
         self._obj=xr_obj
-    def apply(self,fit_func,fit_axis = 'q',**kwargs):
+    def apply(self,fit_func,fit_axis = 'q',workers=None,method=None,**kwargs):
         '''
         Apply a fit function to this PyHyperScattering dataset.
         
         This is intended to smooth over some of the gory xarray details of fitting.
+
+        fit_func is called once per curve, serially or, if workers is given, on a process pool (see apply_processes).
+        The model functions lorentz, lorentz_w_flat_bg, gauss and cos_func are instead fit to every curve of a
+        DataArray at once by batch_curve_fit (see apply_batched); method='batched' does the same for the
+        fit_lorentz/fit_lorentz_bg wrappers, which otherwise keep their per-curve curve_fit behavior.
         
         Args:
             fit_func (callable): a function that takes any arguments passed as kwargs and returns an xarray Dataset or DataArray in the same coordinate space with the fit results.  See examples in Fitting.py.
             fit_axis (str, default 'q'): the "special axis" along which fits should be applied, i.e, you wish to fit in intensity vs fit_axis space.
+            workers (int or None): number of worker processes for fit functions that cannot be batched; None fits serially
+            method (str or None): 'batched' to fit with apply_batched; None batches the model functions only
             
             kwargs (anything): passed through to fit_func
             
@@ -49,6 +100,25 @@ class Fitting:
         Example:
             data.fit.apply(PyHyperScattering.Fitting.fit_lorentz_bg,silent=True)
         '''
+        if method not in (None,'batched'):
+            raise NotImplementedError(f'unsupported fit method {method}')
+        if method == 'batched' or (method is None and fit_func in batched_models):
+            if not isinstance(self._obj,xr.DataArray) or not (fit_func in batched_models or fit_func in batched_fit_funcs):
+                raise ValueError(f'{getattr(fit_func,"__name__",fit_func)} cannot be batched; batched fits take a DataArray and one of lorentz, lorentz_w_flat_bg, gauss, cos_func, fit_lorentz or fit_lorentz_bg.')
+            return self.apply_batched(fit_func,fit_axis=fit_axis,**kwargs)
+        if workers is not None:
+            return self.apply_processes(fit_func,fit_axis=fit_axis,workers=workers,**kwargs)
+        df = self._stackCurves(fit_axis)
+        df = df.groupby('temp_fit_axis')
+        df = df.progress_map(fit_func,**kwargs)
+        df = df.unstack('temp_fit_axis')
+        df = df.mean('q')
+        return df
+
+    def _stackCurves(self,fit_axis):
+        '''
+        unstack any MultiIndexes, then stack every indexed dim other than fit_axis into temp_fit_axis
+        '''
         df = self._obj    
         for name,idx in df.indexes.items():
             if type(idx)==pd.core.indexes.multi.MultiIndex:
@@ -60,13 +130,110 @@ class Fitting:
             if name != fit_axis:
                 dims_to_stack.append(name)
 
-        df = df.stack(temp_fit_axis = dims_to_stack)
-        df = df.groupby('temp_fit_axis')
-        df = df.progress_map(fit_func,**kwargs)
+        return df.stack(temp_fit_axis = dims_to_stack)
+
+    def apply_processes(self,fit_func,fit_axis='q',workers=None,chunk_size=32,warm_start=True,**kwargs):
+        '''
+        Fit curves with an arbitrary fit_func on a process pool.
+
+        The stacked curves are cut into chunks of chunk_size consecutive curves, one task per chunk, and the results
+        are put back together in the original order.  Within a chunk, each fit can start from the previous curve's
+        solution: neighbouring curves (e.g. adjacent energies) usually have similar parameters, so this both speeds
+        up and stabilizes the fits.
+
+        Args:
+            fit_func (callable): as for apply.  Must be picklable, i.e. defined at module level, not a lambda.
+            fit_axis (str, default 'q'): the axis to fit along
+            workers (int or None): number of worker processes, default os.cpu_count()
+            chunk_size (int, default 32): curves per task
+            warm_start (bool, default True): if fit_func takes a guess argument, pass it the previous curve's
+                                             parameters (the mean of each returned variable, in order) whenever those
+                                             are all finite and as many as the values in guess, if one is given.  A
+                                             curve whose warm-started fit raises is refit from guess.
+            kwargs (anything): passed through to fit_func; a guess given here is used for the first curve of each
+                               chunk and after failed fits
+        '''
+        df = self._stackCurves(fit_axis)
+        ncurves = df.sizes['temp_fit_axis']
+        chunks = [df.isel(temp_fit_axis=slice(start,start+chunk_size)) for start in range(0,ncurves,chunk_size)]
+        warm_start = warm_start and 'guess' in inspect.signature(fit_func).parameters
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,initializer=_fit_worker_init,
+                                                    initargs=(fit_func,warm_start,kwargs)) as pool:
+            results = list(tqdm(pool.map(_fit_worker_chunk,chunks),total=len(chunks)))
+        df = xr.concat([res for chunk in results for res in chunk],dim='temp_fit_axis')
         df = df.unstack('temp_fit_axis')
-        df = df.mean('q')
+        df = df.mean(fit_axis)
         return df
 
+    def apply_batched(self,fit_func,fit_axis='q',chunk_size=10000,max_iter=200,guess=None,**kwargs):
+        '''
+        Fit every curve along fit_axis at once with batch_curve_fit.
+
+        Args:
+            fit_func (callable): lorentz, lorentz_w_flat_bg, gauss or cos_func, or the fit_lorentz/fit_lorentz_bg
+                                 wrappers (which use their own default guesses and parameter names)
+            fit_axis (str, default 'q'): the axis to fit along
+            chunk_size (int, default 10000): number of curves solved together, to bound memory on very large cubes.
+                                             Only one chunk of curves is read at a time, so Dask-backed data is
+                                             computed chunk by chunk rather than loaded whole.
+            max_iter (int, default 200): curves not converged after this many iterations are returned as NaN
+            guess (list or None): starting parameters for every curve; by default estimated from each curve
+            kwargs: passed to the fit_lorentz/fit_lorentz_bg guess logic (pos_int_override); others are ignored
+
+        Returns:
+            Dataset over the non-fit dims with one variable per parameter, plus <parameter>_err standard errors
+        '''
+        df = self._obj
+        for dim in list(df.dims):
+            if isinstance(df.indexes.get(dim),pd.MultiIndex):
+                df = df.unstack(dim)
+        if fit_func in batched_fit_funcs:
+            model,guess_func = batched_fit_funcs[fit_func]
+            guess_func = functools.partial(guess_func,guess=guess,**kwargs)
+        else:
+            model = fit_func
+            if guess is None:
+                guess_func = batched_models[model]['guess']
+            else:
+                guess_func = lambda x,y,valid: np.tile(np.asarray(guess,dtype=float),(len(y),1))
+        names = batched_models[model]['names']
+
+        other_dims = [dim for dim in df.dims if dim != fit_axis]
+        df = df.transpose(*other_dims,fit_axis)
+        x = df[fit_axis].values
+        source = df.data if df.ndim > 1 else df.data[np.newaxis]
+        ncurves = int(np.prod(source.shape[:-1]))
+        params = np.full((ncurves,len(names)),np.nan)
+        errors = np.full((ncurves,len(names)),np.nan)
+        for start in tqdm(range(0,ncurves,chunk_size),disable=ncurves<=chunk_size):
+            chunk = _curveBlock(source,start,min(start+chunk_size,ncurves))
+            valid = np.isfinite(chunk)
+            with warnings.catch_warnings():
+                # curves with no valid points give all-NaN slices here; they are left unfit below
+                warnings.simplefilter('ignore',RuntimeWarning)
+                p0 = guess_func(x,chunk,valid)
+            p,cov,converged = batch_curve_fit(model,x,chunk,p0,max_iter=max_iter)
+            p[~converged] = np.nan
+            params[start:start+chunk_size] = p
+            errors[start:start+chunk_size] = np.where(converged[:,np.newaxis],np.sqrt(np.diagonal(cov,axis1=1,axis2=2)),np.nan)
+
+        shape = df.shape[:-1]
+        out = xr.Dataset(coords={dim:df[dim] for dim in other_dims if dim in df.coords})
+        for i,name in enumerate(names):
+            out[name] = (other_dims,params[:,i].reshape(shape))
+            out[f'{name}_err'] = (other_dims,errors[:,i].reshape(shape))
+        return out
+
+def _curveBlock(data,start,stop):
+    '''
+    curves start:stop of an (..., n) numpy or Dask array flattened over its leading dims, read without copying or
+    computing the rest
+    '''
+    index = np.unravel_index(np.arange(start,stop),data.shape[:-1])
+    if hasattr(data,'vindex'):
+        return np.asarray(data.vindex[index].compute(),dtype=float)
+    return np.asarray(data[index],dtype=float)
+
 def fit_lorentz(x,guess=None,pos_int_override=False,silent=False):
     '''
     Fit a lorentzian, constructed as a lambda function compatible with xarray.groupby([...]).apply().
@@ -154,56 +321,94 @@ def fit_cos_anisotropy(data,qL,qU,qspacing,Enlist,ChiL,ChiU,binnumber,Chilim):
     ChiL, ChiU = allows you to cut out any problematic points around the mask
     binnumber = gives you the option of binning the data in chi - 0 keeps it as is
     Chilim = an upper limit for the goodness of fit beyond which all results will be set to 0, implies that the data does not reflect a cos function for whatever reason
+
+    a*cos(2 chi)+c is linear in a and c, so every (energy, q) cell is solved exactly by cos_anisotropy_lstsq, all at
+    once, rather than with one curve_fit call per cell.  Results match fitting each cell with fit_cos.
     '''
     
     #generates arrays to store the final results
     qarray=np.arange(qL,qU,qspacing)
-    anisotropy=np.zeros([len(Enlist),len(qarray)])
-    chisq=np.zeros([len(Enlist),len(qarray)])
-    anisotropyU=np.zeros([len(Enlist),len(qarray)])
+    polarization = data['polarization'].values.reshape(-1)[0]
+    extra_dims = [dim for dim in data.dims if dim not in ('energy','chi','q')]
+    for dim in extra_dims:
+        if data.sizes[dim] > 1:
+            raise ValueError(f'fit_cos_anisotropy fits one {dim} at a time, but data has {data.sizes[dim]} values of {dim}')
+    data = data.isel({dim:0 for dim in extra_dims}).sel(energy=list(Enlist)).transpose('energy','chi','q')
+
+    # mean over each q window (inclusive at both ends, as with .sel(q=slice(...))), skipping NaNs
+    q = data['q'].values
+    in_window = ((q >= (qarray-qspacing/2)[:,np.newaxis]) & (q <= (qarray+qspacing/2)[:,np.newaxis])).astype(float)
+    values = data.values
+    finite = np.isfinite(values)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        intensity = (np.where(finite,values,0) @ in_window.T) / (finite.astype(float) @ in_window.T)
+    chi = data['chi'].values
     
-    for Ecount,En in enumerate(Enlist):
-        for i in range(len(qarray)):
-            
-            qmin=qarray[i]-qspacing/2
-            qmax=qarray[i]+qspacing/2
-            r=data.sel(energy=En,q=slice(qmin,qmax)).mean('q')
-            
-            if binnumber >0:
-                rc=r.coarsen(chi=binnumber,boundary='trim').mean()
-                intensity=rc.values
-                chi=rc['chi'].values
-            else:
-                intensity=r.values
-                chi=r['chi'].values
-            # removes any nans    
-            a_infs = np.where(np.isnan(intensity))
-            intensity=np.delete(intensity,a_infs)
-            chi=np.delete(chi,a_infs)
-            
-            #removes any problematic points around the edge of the mask
-            check=np.where(np.logical_and(chi>=ChiU, chi<=ChiL))
-            chi=np.delete(chi,check)
-            intensity=np.delete(intensity,check)
-            
-            chi=np.radians(chi) # switches chi from degrees to radians for the fitting function
-            
-            params, ani, ani_unc, gf=fit_cos(chi, intensity) # calls the fitting function on the selected I vs Chi cut
+    if binnumber >0:
+        nbins = len(chi)//binnumber
+        chi = chi[:nbins*binnumber].reshape(nbins,binnumber).mean(axis=1)
+        binned = intensity[:,:nbins*binnumber].reshape(len(Enlist),nbins,binnumber,len(qarray))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',RuntimeWarning)
+            intensity = np.nanmean(binned,axis=2)
+
+    # leaves out nans and any problematic points around the edge of the mask
+    valid = np.isfinite(intensity) & ~((chi>=ChiU) & (chi<=ChiL))[np.newaxis,:,np.newaxis]
+    
+    # chi is switched from degrees to radians for the fit
+    a,c,a_unc,c_unc,chisq = cos_anisotropy_lstsq(np.radians(chi)[np.newaxis,:,np.newaxis],intensity,valid,axis=1)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        anisotropy = a/c
+        anisotropyU = np.sqrt((a_unc/a)**2+(c_unc/c)**2)*anisotropy
+    anisotropy[np.abs(anisotropy)>1] = 0
+
+    # too few points to fit: same placeholders that fit_cos returns on failure
+    failed = valid.sum(axis=1) < 2
+    anisotropy[failed] = 0
+    anisotropyU[failed] = 0
+    chisq[failed] = 100
             
-            # Check to compare the Chi value to a upper limit where the fit is assumed to ha
-            if gf > Chilim:
-                anisotropy[Ecount,i]=0
-                anisotropyU[Ecount,i]=ani_unc
-                chisq[Ecount,i]=gf
-            else: 
-                anisotropy[Ecount,i]=ani
-                anisotropyU[Ecount,i]=ani_unc
-                chisq[Ecount,i]=gf
-    if data['polarization'].values[0]==0:
+    # Check to compare the Chi value to a upper limit where the fit is assumed to ha
+    anisotropy[chisq > Chilim] = 0
+    if polarization==0:
         anisotropy=-1*anisotropy
     return qarray, anisotropy, anisotropyU, chisq
     
     
+def cos_anisotropy_lstsq(x,y,valid,axis=-1):
+    '''
+    Closed-form least squares fit of cos_func, y = a*cos(2x)+c, along axis of any number of curves at once.
+
+    Args:
+        x (array): angles in radians, broadcastable against y
+        y (array): intensities
+        valid (array of bool): points to include in each fit
+        axis (int, default -1): the axis to fit along
+
+    Returns:
+        a, c, standard errors of a and c (scaled by the residual variance, as curve_fit reports them), and the sum of
+        squared residuals; one value per curve
+    '''
+    u = np.broadcast_to(np.cos(2*x),np.shape(y))
+    w = valid.astype(float)
+    y = np.where(valid,y,0)
+    n = w.sum(axis=axis)
+    su = (w*u).sum(axis=axis)
+    suu = (w*u*u).sum(axis=axis)
+    sy = (w*y).sum(axis=axis)
+    suy = (w*u*y).sum(axis=axis)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        det = n*suu - su**2
+        a = (n*suy - su*sy)/det
+        c = (suu*sy - su*suy)/det
+        resid = w*(y - np.expand_dims(a,axis)*u - np.expand_dims(c,axis))
+        chisq = (resid**2).sum(axis=axis)
+        residual_variance = np.where(n > 2,chisq/(n-2),np.inf)
+        a_unc = np.sqrt(residual_variance*n/det)
+        c_unc = np.sqrt(residual_variance*suu/det)
+    return a,c,a_unc,c_unc,chisq
+
+
 def fit_cos_anisotropy_single(data,q,qspacing,En,ChiL,ChiU,binnumber,Chilim):
     '''
     fits the anisotropy with a cos function for a single energy/q position
@@ -329,4 +534,181 @@ def fit_cos(x_data, y_data):
         Ani_unc=0
         Chisq=100
     
-    return params, Ani, Ani_unc, Chisq
\ No newline at end of file
+    return params, Ani, Ani_unc, Chisq
+
+def lorentz_jacobian(x, a, x0, gam):
+    '''
+    Helper function - partial derivatives of lorentz with respect to [a, x0, gam], stacked on the last axis
+    '''
+    d = x - x0
+    denom = gam**2 + d**2
+    return np.stack(np.broadcast_arrays(gam**2/denom, 2*a*gam**2*d/denom**2, 2*a*gam*d**2/denom**2),axis=-1)
+
+def lorentz_w_flat_bg_jacobian(x, a, x0, gam, bg):
+    '''
+    Helper function - partial derivatives of lorentz_w_flat_bg with respect to [a, x0, gam, bg], stacked on the last axis
+    '''
+    peak = lorentz_jacobian(x, a, x0, gam)
+    return np.concatenate([peak,np.ones(peak.shape[:-1]+(1,))],axis=-1)
+
+def gauss_jacobian(x, A, mu, sigma):
+    '''
+    Helper function - partial derivatives of gauss with respect to [A, mu, sigma], stacked on the last axis
+    '''
+    d = x - mu
+    e = np.exp(-d**2/(2.*sigma**2))
+    return np.stack(np.broadcast_arrays(e, A*e*d/sigma**2, A*e*d**2/sigma**3),axis=-1)
+
+def cos_func_jacobian(x, a, c):
+    '''
+    Helper function - partial derivatives of cos_func with respect to [a, c], stacked on the last axis
+    '''
+    return np.stack(np.broadcast_arrays(np.cos(2*x)+0*a, np.ones_like(x)+0*c),axis=-1)
+
+def peak_guess(x, y, valid):
+    '''
+    Helper function - data-driven [height, center, half width at half maximum, baseline] starting points for a
+    stack of (n, m) peaks sampled at x, ignoring points where valid is False
+    '''
+    y_valid = np.where(valid, y, np.nan)
+    baseline = np.nanmin(y_valid, axis=1)
+    peak = np.nanargmax(np.where(valid, y, -np.inf), axis=1)
+    height = y[np.arange(len(y)), peak] - baseline
+    center = x[peak]
+    spacing = np.median(np.abs(np.diff(x))) if len(x) > 1 else 1.
+    above_half = np.sum(y_valid - baseline[:,np.newaxis] >= height[:,np.newaxis]/2, axis=1)
+    hwhm = np.maximum(above_half, 1) * spacing / 2
+    return height, center, hwhm, baseline
+
+def _lorentz_guess(x, y, valid):
+    height, center, hwhm, baseline = peak_guess(x, y, valid)
+    return np.stack([height + baseline, center, hwhm], axis=-1)
+
+def _lorentz_w_flat_bg_guess(x, y, valid):
+    return np.stack(peak_guess(x, y, valid), axis=-1)
+
+def _gauss_guess(x, y, valid):
+    height, center, hwhm, baseline = peak_guess(x, y, valid)
+    return np.stack([height + baseline, center, hwhm/np.sqrt(2*np.log(2))], axis=-1)
+
+def _cos_func_guess(x, y, valid):
+    y_valid = np.where(valid, y, np.nan)
+    return np.stack([np.nanmax(y_valid, axis=1) - np.nanmin(y_valid, axis=1), np.nanmean(y_valid, axis=1)], axis=-1)
+
+# models that batch_curve_fit can fit: jacobian, parameter names in the output Dataset, and a starting-point heuristic
+batched_models = {
+    lorentz: dict(jacobian=lorentz_jacobian, names=['intensity','pos','width'], guess=_lorentz_guess),
+    lorentz_w_flat_bg: dict(jacobian=lorentz_w_flat_bg_jacobian, names=['intensity','pos','width','bg'], guess=_lorentz_w_flat_bg_guess),
+    gauss: dict(jacobian=gauss_jacobian, names=['intensity','pos','sigma'], guess=_gauss_guess),
+    cos_func: dict(jacobian=cos_func_jacobian, names=['a','c'], guess=_cos_func_guess),
+}
+
+def _wrapper_guess(default):
+    '''
+    starting points matching fit_lorentz/fit_lorentz_bg: guess, with the center at the median q of each curve and the
+    intensity at that q if guess is None or pos_int_override is set
+    '''
+    def guess_func(x, y, valid, guess=None, pos_int_override=False, **kwargs):
+        if guess is None:
+            guess = default
+            pos_int_override = True
+        p0 = np.tile(np.asarray(guess, dtype=float), (len(y), 1))
+        if pos_int_override:
+            center = np.nanmedian(np.where(valid, x, np.nan), axis=1)
+            nearest = np.argmin(np.where(valid, np.abs(x - center[:,np.newaxis]), np.inf), axis=1)
+            p0[:,1] = center
+            p0[:,0] = y[np.arange(len(y)), nearest]
+        return p0
+    return guess_func
+
+# the per-curve wrappers that Fitting.apply runs through batch_curve_fit instead
+batched_fit_funcs = {
+    fit_lorentz: (lorentz, _wrapper_guess([500.,0.00665,0.0002])),
+    fit_lorentz_bg: (lorentz_w_flat_bg, _wrapper_guess([500.,0.00665,0.0002,0])),
+}
+
+def batch_curve_fit(model, x, y, p0, max_iter=200, ftol=1.49012e-8, xtol=1.49012e-8):
+    '''
+    Fit many curves sampled on the same x at once with a vectorized Levenberg-Marquardt solver.
+
+    Every curve gets its own damping parameter and convergence test, as curve_fit would give it, but each iteration
+    updates all unconverged curves together with NumPy broadcasting and batched 2x2-4x4 linear solves.
+
+    Args:
+        model (callable): one of the keys of batched_models, e.g. lorentz
+        x (array): (m,) shared abscissa
+        y (array): (n, m) curves; NaN points are left out of their curve's fit
+        p0 (array): (n, k) or (k,) starting parameters
+        max_iter (int, default 200): curves not converged after this many iterations are flagged
+        ftol, xtol (float): relative tolerances on the sum of squares and on the parameters, as in curve_fit
+
+    Returns:
+        params (n, k), covariance (n, k, k) and converged (n,) bool arrays.  Curves with fewer valid points than
+        parameters are not fit and come back NaN.
+    '''
+    jacobian = batched_models[model]['jacobian']
+    x = np.asarray(x, dtype=float)
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    valid = np.isfinite(y)
+    y = np.where(valid, y, 0.)
+    weight = valid.astype(float)
+    nparams = np.shape(p0)[-1]
+    params = np.array(np.broadcast_to(p0, (len(y), nparams)), dtype=float)
+
+    def residuals(p, rows):
+        return (y[rows] - model(x, *p.T[..., np.newaxis])) * weight[rows]
+
+    dof = valid.sum(axis=1) - nparams
+    converged = np.zeros(len(y), dtype=bool)
+    active = np.flatnonzero(dof >= 0)
+    damping = np.full(len(y), 1e-3)
+    resid = residuals(params[active], active)
+    cost = np.full(len(y), np.nan)
+    cost[active] = np.sum(resid**2, axis=1)
+
+    for iteration in range(max_iter):
+        if len(active) == 0:
+            break
+        p = params[active]
+        jac = jacobian(x, *p.T[..., np.newaxis]) * weight[active][..., np.newaxis]
+        jac_t = jac.swapaxes(1, 2)
+        jtj = jac_t @ jac
+        jtr = (jac_t @ resid[..., np.newaxis])[..., 0]
+        scale = np.maximum(np.diagonal(jtj, axis1=1, axis2=2), np.finfo(float).tiny)
+        damped = jtj + (damping[active][:, np.newaxis] * scale)[:, :, np.newaxis] * np.eye(nparams)
+        try:
+            step = np.linalg.solve(damped, jtr[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            step = np.einsum('nij,nj->ni', np.linalg.pinv(damped), jtr)
+
+        trial = p + step
+        with np.errstate(all='ignore'):
+            trial_resid = residuals(trial, active)
+            trial_cost = np.sum(trial_resid**2, axis=1)
+        improved = np.isfinite(trial_cost) & (trial_cost <= cost[active])
+
+        small_cost_change = improved & (cost[active] - trial_cost <= ftol * cost[active])
+        small_step = np.all(np.abs(step) <= xtol * (np.abs(p) + xtol), axis=1)
+        # damping this large means no downhill step exists: we are at the minimum
+        stalled = damping[active] > 1e12
+
+        params[active[improved]] = trial[improved]
+        cost[active[improved]] = trial_cost[improved]
+        resid[improved] = trial_resid[improved]
+        damping[active] = np.where(improved, damping[active]/10, damping[active]*10)
+
+        done = small_cost_change | small_step | stalled
+        converged[active[done]] = True
+        resid = resid[~done]
+        active = active[~done]
+
+    covariance = np.full((len(y), nparams, nparams), np.nan)
+    fitted = np.flatnonzero(dof >= 0)
+    if len(fitted) > 0:
+        jac = jacobian(x, *params[fitted].T[..., np.newaxis]) * weight[fitted][..., np.newaxis]
+        jtj = jac.swapaxes(1, 2) @ jac
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s_sq = cost[fitted] / dof[fitted]
+            covariance[fitted] = np.linalg.pinv(jtj) * s_sq[:, np.newaxis, np.newaxis]
+    params[dof < 0] = np.nan
+    return params, covariance, converged
@@ -1,81 +1,183 @@
+import warnings
 import numpy as np
-import skimage.morphology
-from collections import defaultdict
-from copy import deepcopy
+import scipy.sparse
 import pandas as pd
 import xarray as xr
+import skimage.morphology
+try:
+    import dask.array as da
+except ImportError:
+    warnings.warn('Failed to import Dask, if Dask HDR merging is desired install pyhyperscattering[performance]',stacklevel=2)
+
+
+def scaleAndMask(raw_xr,mask_hi=True,mask_lo=True,exposure_cutoff_hi=45000,exposure_cutoff_lo=20,close_mask=True,
+                 chunk_frames=None):
+    '''
+    Merge a multi-exposure stack into HDR images: one per unique combination of the system coordinates other than
+    exposure and filenumber.
 
+    Frames with the same conditions and exposure are averaged; pixels at or above exposure_cutoff_hi counts or at or
+    below exposure_cutoff_lo counts are masked in that exposure; and the exposures are then averaged with weights
+    proportional to exposure time, skipping masked pixels.  Pixels masked in every exposure come out as NaN.
 
-def scaleAndMask(raw_xr,mask_hi=True,mask_lo=True,exposure_cutoff_hi=45000,exposure_cutoff_lo=20,close_mask=True):
-    groupby_dims = []
-    for dim in raw_xr.coords['system'].unstack('system').coords.keys():
-        if dim not in ['filenumber','exposure']:
-            groupby_dims.append(dim)
+    All frames are grouped once and every step runs on the whole stack as array operations (sparse group sums and one
+    3D binary closing), so there is no per-group Python work.
+
+    Dask-backed stacks (e.g. from SST1RSoXSDB(use_chunked_loading=True)) stay lazy: frames are sorted by condition and
+    rechunked so that no condition straddles a chunk boundary, and each chunk is merged independently with
+    map_blocks.  Only a few chunks of raw frames are in memory at once, and the merged stack can go straight into an
+    integrator.
+
+    Args:
+        raw_xr (DataArray): frames stacked on a 'system' MultiIndex that includes an 'exposure' level, in counts per
+                            second
+        mask_hi (bool, default True): mask saturated pixels
+        mask_lo (bool, default True): mask low-count pixels
+        exposure_cutoff_hi (numeric, default 45000): saturation threshold, in counts
+        exposure_cutoff_lo (numeric, default 20): low-count threshold, in counts
+        close_mask (bool, default True): apply a binary closing to each exposure's mask before averaging
+        chunk_frames (int or None): for Dask input, target number of raw frames per chunk; defaults to the input's
+                                    largest chunk along system.  A chunk always holds whole conditions.
+
+    Returns:
+        DataArray of merged frames on a 'system' MultiIndex of the remaining coordinates, or a single frame if there
+        are none.  Dask-backed if raw_xr was.
+    '''
+    system = raw_xr.indexes['system'].to_frame(index=False)
+    groupby_dims = [dim for dim in system.columns if dim not in ['filenumber','exposure']]
     print(f'Grouping by: {groupby_dims}')
-    
-    data_rows,dest_coords= hdr_recurse(raw_xr,groupby_dims,{},
-                             mask_hi=mask_hi,mask_lo=mask_lo,
-                             exposure_cutoff_hi=exposure_cutoff_hi,exposure_cutoff_lo=exposure_cutoff_lo,
-                             close_mask=close_mask)
-    #return data_rows,dest_coords
-    index = pd.MultiIndex.from_arrays(list(dest_coords.values()),names=list(dest_coords.keys()))
-    index.name = 'system'
-    out = xr.concat(data_rows,dim=index)
-    return out
-
-def hdr_recurse(input_xr,groupby_dims,dest_coords,**kw):
-        data_rows_accumulator = []
-        dest_coords_accumulator = defaultdict(list)
-        if len(groupby_dims) > 0:
-            target_dim = groupby_dims.pop()
-            print(f'Grouping on {target_dim}')
-            print(f'  number of groups {len(input_xr.groupby(target_dim))}')
-            for xre in input_xr.groupby(target_dim,squeeze=False):
-                #print(f'    Element {xre[target_dim]}')
-                dest_coords[target_dim] = (xre[0])
-                print(f'    Launching workOrRecurse with xr, groupby {groupby_dims}, coords {dest_coords}')
-                data_rows_new,dest_coords_new = hdr_recurse(xre[1],deepcopy(groupby_dims),deepcopy(dest_coords),**kw)
-                for dim in dest_coords_new.keys():
-                    if type(dest_coords_new[dim]) is list:
-                        for item in dest_coords_new[dim]:
-                            dest_coords_accumulator[dim].append(item)
-                    else:
-                        dest_coords_accumulator[dim].append(dest_coords_new[dim])
-                if type(data_rows_new) is list:
-                    for item in data_rows_new:
-                        data_rows_accumulator.append(item)
-                else:
-                    data_rows_accumulator.append(data_rows_new)
-            return data_rows_accumulator, dest_coords_accumulator
-        else: # if there are no more dimensions to unstack
-            return hdr_work(input_xr,groupby_dims,dest_coords,**kw)
-            
-def hdr_work(input_xr,groupby_dims,dest_coords,**kw):
-    masked_accumulator = []
-    exposure_accumulator = []
-    for da in input_xr.groupby('exposure',squeeze=False):
-        print(f'        Processing exposure {da[0]}')
-        exposure = da[0]
-        da = da[1]
-        new_data = da.mean('system').values
-        if kw['mask_hi']: 
-            new_data = np.ma.masked_greater_equal(new_data,kw['exposure_cutoff_hi']/exposure)
-            mask_hi_stat = np.sum(new_data.mask.astype(bool))
-            print(f"                Masking hi: pixels >= {kw['exposure_cutoff_hi']} cts or {kw['exposure_cutoff_hi']/exposure} cps resulted in {mask_hi_stat} pixels masked")
-        if kw['mask_lo']:
-            new_data = np.ma.masked_less_equal(new_data,kw['exposure_cutoff_lo']/exposure)
-            mask_lo_stat = np.sum(new_data.mask.astype(bool))-mask_hi_stat
-            print(f"                Masking lo: pixels <= {kw['exposure_cutoff_lo']} cts or {kw['exposure_cutoff_lo']/exposure} cps resulted in {mask_lo_stat} pixels masked")
-        print(f'            masking resulted in {np.sum(new_data.mask.astype(bool))} masked pixels')
-
-        if kw['close_mask']:
-            before = new_data.mask.sum()
-            new_data.mask = skimage.morphology.binary_closing(new_data.mask)
-            print(f'            binary closing completed, masked pixels {before} --> {new_data.mask.sum()}')
-
-        masked_accumulator.append(new_data)
-        exposure_accumulator.append(exposure)
-    avg = np.ma.average(masked_accumulator,axis=0,weights=exposure_accumulator)
-    print(f'            after averaging, masked pixels = {avg.mask.sum()}')
-
-    return xr.DataArray(avg,dims=['pix_x','pix_y'],attrs={}),dest_coords
\ No newline at end of file
+    frame_dims = [dim for dim in raw_xr.dims if dim != 'system']
+    raw_xr = raw_xr.transpose('system',*frame_dims)
+
+    # one pass over the index: a code per condition
+    if len(groupby_dims) > 0:
+        group_codes,groups = pd.MultiIndex.from_frame(system[groupby_dims]).factorize(sort=True)
+    else:
+        group_codes,groups = np.zeros(len(system),dtype=np.int64),None
+    exposures = system['exposure'].to_numpy(dtype=float)
+    merge_args = dict(mask_hi=mask_hi,mask_lo=mask_lo,exposure_cutoff_hi=exposure_cutoff_hi,
+                      exposure_cutoff_lo=exposure_cutoff_lo,close_mask=close_mask)
+
+    if raw_xr.chunks is not None:
+        merged = _lazyMerge(raw_xr.data,group_codes,exposures,chunk_frames,merge_args)
+        print(f'Merging {len(system)} frames at {len(np.unique(exposures))} exposures into {merged.shape[0]} HDR images '
+              f'in {merged.numblocks[0]} chunks')
+    else:
+        merged = mergeFrames(raw_xr.values,group_codes,exposures,**merge_args)
+        print(f'Merged {len(system)} frames at {len(np.unique(exposures))} exposures into {len(merged)} HDR images, '
+              f'{int(np.isnan(merged).sum())} pixels masked in every exposure')
+
+    coords = {dim:raw_xr[dim] for dim in frame_dims if dim in raw_xr.coords}
+    if groups is None:
+        return xr.DataArray(merged[0],dims=frame_dims,coords=coords,attrs={})
+    out = xr.DataArray(merged,dims=['system']+frame_dims,coords=coords,attrs={})
+    index = pd.MultiIndex.from_tuples(list(groups),names=groupby_dims)
+    return out.assign_coords(xr.Coordinates.from_pandas_multiindex(index,'system'))
+
+
+def mergeFrames(frames,group_codes,exposures,**kw):
+    '''
+    HDR-merge an in-memory (n, pix, pix) stack.
+
+    Args:
+        frames (ndarray): raw frames
+        group_codes (array of int): condition of each frame
+        exposures (array of float): exposure time of each frame
+        **kw: masking options, as for scaleAndMask
+
+    Returns:
+        (ngroups, pix, pix) float array, one merged frame per distinct group code in ascending code order
+    '''
+    group_codes = np.unique(group_codes,return_inverse=True)[1].reshape(-1)
+    sub_codes,subgroups = pd.MultiIndex.from_arrays([group_codes,exposures]).factorize(sort=True)
+    sub_group = subgroups.get_level_values(0).to_numpy()
+    sub_exposure = subgroups.get_level_values(1).to_numpy(dtype=float)
+
+    # mean of the repeated frames for each (condition, exposure)
+    counts = np.bincount(sub_codes,minlength=len(subgroups))
+    means = groupSum(frames,sub_codes,len(subgroups)) / counts.reshape((-1,)+(1,)*(np.ndim(frames)-1))
+
+    mask = hdrMask(means,sub_exposure,**kw)
+    return weightedMerge(means,mask,sub_exposure,sub_group)
+
+
+def _lazyMerge(frames,group_codes,exposures,chunk_frames,merge_args):
+    '''
+    mergeFrames over a Dask stack, chunk by chunk, with every condition's frames inside one chunk
+    '''
+    if chunk_frames is None:
+        chunk_frames = max(frames.chunks[0])
+    order = np.argsort(group_codes,kind='stable')
+    sizes = np.bincount(group_codes)
+
+    # pack whole conditions into chunks of about chunk_frames raw frames
+    frame_chunks,group_chunks = [],[]
+    for size in sizes:
+        if len(frame_chunks) == 0 or frame_chunks[-1]+size > chunk_frames:
+            frame_chunks.append(0)
+            group_chunks.append(0)
+        frame_chunks[-1] += size
+        group_chunks[-1] += 1
+    frame_chunks = tuple(frame_chunks)
+
+    frames = frames[order].rechunk((frame_chunks,)+tuple(-1 for _ in frames.shape[1:]))
+    extra_axes = (1,)*(frames.ndim-1)
+    codes = da.from_array(group_codes[order].reshape((-1,)+extra_axes),chunks=(frame_chunks,)+extra_axes)
+    block_exposures = da.from_array(exposures[order].reshape((-1,)+extra_axes),chunks=(frame_chunks,)+extra_axes)
+
+    def merge_block(block,block_codes,block_exposures):
+        return mergeFrames(block,block_codes.reshape(-1),block_exposures.reshape(-1),**merge_args)
+
+    return da.map_blocks(merge_block,frames,codes,block_exposures,dtype=float,
+                         chunks=(tuple(group_chunks),)+frames.chunks[1:])
+
+
+def hdrMask(means,exposures,mask_hi=True,mask_lo=True,exposure_cutoff_hi=45000,exposure_cutoff_lo=20,close_mask=True):
+    '''
+    saturation/low-count mask for a stack of (n, pix, pix) frames taken at the given exposures, as one boolean array
+    '''
+    cutoff_shape = (-1,)+(1,)*(means.ndim-1)
+    mask = np.zeros(means.shape,dtype=bool)
+    with np.errstate(invalid='ignore'):
+        if mask_hi:
+            mask |= means >= (exposure_cutoff_hi/exposures).reshape(cutoff_shape)
+        if mask_lo:
+            mask |= means <= (exposure_cutoff_lo/exposures).reshape(cutoff_shape)
+    if close_mask:
+        mask = closeMasks(mask)
+    return mask
+
+
+def closeMasks(mask):
+    '''
+    skimage.morphology.binary_closing of each frame of an (n, pix, pix) mask stack.  On Dask stacks, _lazyMerge's map_blocks
+    calls this one chunk of frames at a time.
+    '''
+    closed = np.empty(np.shape(mask),dtype=bool)
+    for i,frame in enumerate(mask):
+        closed[i] = skimage.morphology.binary_closing(frame)
+    return closed
+
+
+def groupSum(frames,codes,ngroups):
+    '''
+    sum of the (n, ...) frames that share each of ngroups integer group codes, as one sparse indicator-matrix
+    product (a bincount over whole frames)
+    '''
+    indicator = scipy.sparse.csr_matrix((np.ones(len(codes)),(codes,np.arange(len(codes)))),shape=(ngroups,len(codes)))
+    flat = np.asarray(frames,dtype=float).reshape(len(codes),-1)
+    return (indicator @ flat).reshape((ngroups,)+np.shape(frames)[1:])
+
+
+def weightedMerge(means,mask,exposures,groups):
+    '''
+    exposure-weighted average of the unmasked pixels of frames that share a group code; NaN where every frame of a
+    group is masked
+    '''
+    ngroups = int(groups.max())+1
+    weights = np.where(mask,0.,exposures.reshape((-1,)+(1,)*(means.ndim-1)))
+    with np.errstate(invalid='ignore'):
+        total = groupSum(np.where(mask,0.,means*weights),groups,ngroups)
+    norm = groupSum(weights,groups,ngroups)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.where(norm > 0,total/norm,np.nan)
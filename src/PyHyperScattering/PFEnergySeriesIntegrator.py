@@ -1,5 +1,5 @@
 from pyFAI import azimuthalIntegrator
-from PyHyperScattering.PFGeneralIntegrator import PFGeneralIntegrator
+from PyHyperScattering.PFGeneralIntegrator import PFGeneralIntegrator, makeAzimuthalIntegrator
 import h5py
 import warnings
 import xarray as xr
@@ -58,12 +58,31 @@ class PFEnergySeriesIntegrator(PFGeneralIntegrator):
             self.integrator = self.createIntegrator(en)
         res = super().integrateSingleImage(img)
         try:
-            if len(self.dest_q)>0:
-                return res.interp(q=self.dest_q)
-            else:
+            if len(self.dest_q)==0:
                 return res
-        except TypeError:
+        except (TypeError,AttributeError):
             return res
+        if self.radialBinning()[1] is not None:
+            # binned straight onto dest_q; only float noise separates the coords
+            return res.assign_coords(q=self.dest_q)
+        return res.interp(q=self.dest_q)
+    def radialBinning(self):
+        '''
+        bin directly onto dest_q when it is evenly spaced in the integration unit (q, or arcsinh q if use_log_ish_binning),
+        so each energy's integrator produces intensities on the common q bins without interpolation.  Otherwise fall
+        back to npts bins over the full detector, and integrateSingleImage interpolates onto dest_q.
+        '''
+        dest_q = getattr(self,'dest_q',None)
+        try:
+            if dest_q is None or len(dest_q)<2:
+                return self.npts,None
+        except TypeError:
+            return self.npts,None
+        centers = np.arcsinh(np.asarray(dest_q)*10000) if self.use_log_ish_binning else np.asarray(dest_q)
+        widths = np.diff(centers)
+        if not np.allclose(widths,widths[0],rtol=1e-4,atol=0):
+            return self.npts,None
+        return len(centers),(centers[0]-widths[0]/2,centers[-1]+widths[0]/2)
     def setupIntegrators(self,energies):
         for en in energies:
             self.createIntegrator(en)
@@ -72,8 +91,11 @@ class PFEnergySeriesIntegrator(PFGeneralIntegrator):
         self.dest_q = self.integrator_stack[np.median(energies)].integrate2d(np.zeros_like(self.mask).astype(int), self.npts, 
                                                    unit='arcsinh(q.µm)' if self.use_log_ish_binning else 'q_A^-1',
                                                    method=self.integration_method).radial
+        if self.use_log_ish_binning:
+            self.dest_q = np.sinh(self.dest_q)/10000
 
     def integrateImageStack_dask(self,img_stack,chunksize=5):
+        import dask.array as da
         self.setupIntegrators(img_stack.energy.data)
         self.setupDestQ(img_stack.energy.data)
         indexes = list(img_stack.dims)
@@ -98,21 +120,20 @@ class PFEnergySeriesIntegrator(PFGeneralIntegrator):
             order_list.append(idx)
             coord_dict[idx] = img_stack.indexes[idx]
             shape = shape + tuple([len(img_stack.indexes[idx])])
-        shape = (360,self.npts) + shape 
         
         
         fake_image_to_process = img_stack.isel(**{dim_to_chunk:0},drop=False)
         #fake_image_to_process.attrs['energy'] = img_stack.energy.isel(**{idx_name_to_use:0})
         demo_integration = self.integrateSingleImage(fake_image_to_process)
         coord_dict.update({'chi':demo_integration.chi,'q':self.dest_q})
+        shape = (len(demo_integration.chi),len(self.dest_q)) + shape
         
         desired_order_list = ['chi','q']+order_list
         coord_dict_sorted = {k: coord_dict[k] for k in desired_order_list}
         
-        template = xr.DataArray(np.empty(shape),coords=coord_dict_sorted)
-   
-        
-        template = template.chunk({dim_to_chunk:chunksize})
+        # the template only describes the output, so keep it lazy rather than allocating the full cube
+        chunks = tuple(chunksize if dim == dim_to_chunk else -1 for dim in desired_order_list)
+        template = xr.DataArray(da.empty(shape,dtype=demo_integration.dtype,chunks=chunks),coords=coord_dict_sorted)
         if 'image_num' in demo_integration.dims:
             template = template.transpose(*[item if item != 'image_num' else dim_to_chunk for item in demo_integration.dims])
          
@@ -139,8 +160,6 @@ class PFEnergySeriesIntegrator(PFGeneralIntegrator):
                     raise TypeError('Geometry is incorrect, cannot integrate.\n \n - Do your mask dimensions match your image dimensions? \n - Do you have pixel sizes set that are not zero?\n - Is SDD, beamcenter/poni, and tilt set correctly?') from e
                 else:
                     raise e
-        if self.use_log_ish_binning:
-            self.dest_q = np.sinh(self.dest_q)/10000
         # single image reduce each entry in the stack
         # + 
         # restack the reduced data
@@ -163,16 +182,120 @@ class PFEnergySeriesIntegrator(PFGeneralIntegrator):
         return data_int
         #return img_stack.groupby('system',squeeze=False).progress_apply(self.integrateSingleImage)
     
+    def integrateImageStack_batch(self,img_stack,chunksize=64):
+        '''
+        Integrate an energy series through one shared, energy-independent sparse matrix.
+
+        The pixel -> (chi, 2theta) mapping does not depend on wavelength, so every frame is binned in 2theta with the
+        same matrix and the radial axis is then converted to q analytically for each frame's energy and linearly
+        interpolated onto dest_q (see _twoThetaToQ); q bins with no data get pyFAI's empty value, as in the legacy
+        method.  Interpolation smooths the profile slightly compared with binning each energy directly onto dest_q.
+        Setup time and matrix memory are constant in the number of energies.
+
+        Args:
+            img_stack (xarray): raw stack with pix_x and pix_y dimensions and an energy coordinate
+            chunksize (int, default 64): number of frames per sparse matrix product; bounds the temporary memory
+        '''
+        data,indexes,pixel_dims = self._prepareBatch(img_stack)
+        frame_shape = data.shape[len(indexes):]
+        template = data.isel({dim:0 for dim in pixel_dims},drop=True)
+        energies = np.asarray(template['energy'].broadcast_like(template).transpose(*template.dims).values,dtype=float).reshape(-1)
+
+        # any fixed wavelength will do, the 2theta binning is the same for all of them
+        self.integrator = self.createIntegrator(self.energy)
+        engine = self.getSparseEngine(frame_shape,unit='2th_deg')
+        tth = engine.radial
+
+        dest_q = getattr(self,'dest_q',None)
+        if dest_q is None or len(dest_q)==0:
+            dest_q = self._destQFromTwoTheta(tth,np.median(energies))
+
+        nframes = len(energies)
+        frames = data.data.reshape((nframes,)+frame_shape)
+        out = np.empty((nframes,)+engine.output_shape[:-1]+(len(dest_q),),dtype=np.float32)
+        dummy,empty = self._legacyFill()
+        for start in tqdm(range(0,nframes,chunksize)):
+            stop = min(start+chunksize,nframes)
+            binned = engine.integrate(frames[start:stop],empty=np.nan,dummy=dummy)
+            out[start:stop] = self._twoThetaToQ(binned,tth,energies[start:stop],dest_q,empty=empty)
+        return self._batchResult(data,indexes,pixel_dims,out,engine.azimuthal,dest_q)
+
+    def _destQFromTwoTheta(self,tth,energy):
+        '''
+        the q bins pyFAI would pick at energy for a detector covering the 2theta range binned in tth (degrees)
+        '''
+        wavelength = 1.239842e-6/energy*1e10 # Å
+        half_width = (tth[1]-tth[0])/2
+        q_edges = 4*np.pi/wavelength*np.sin(np.radians([tth[0]-half_width,tth[-1]+half_width])/2)
+        if self.use_log_ish_binning:
+            # pyFAI bins uniformly in arcsinh(q.µm)
+            edges = np.arcsinh(q_edges*10000)
+            centers = np.linspace(edges[0],edges[1],len(tth)+1)
+            return np.sinh((centers[1:]+centers[:-1])/2)/10000
+        centers = np.linspace(q_edges[0],q_edges[1],len(tth)+1)
+        return (centers[1:]+centers[:-1])/2
+
+    def _twoThetaToQ(self,binned,tth,energies,dest_q,empty=0.):
+        '''
+        linearly sample a (frames, [chi,] 2theta) block onto dest_q, using each frame's energy to convert 2theta to q
+
+        Each dest_q bin is interpolated between the two 2theta bins around its scattering angle.  Empty 2theta bins
+        (NaN in binned) are skipped: if only one neighbour has data its value is used as is, and a q bin with no
+        data on either side, or outside the binned 2theta range, is set to empty, as pyFAI fills bins that no pixel
+        reaches.
+
+        Args:
+            binned (ndarray): (frames, [chi,] 2theta) intensities, NaN in empty bins
+            tth (ndarray): 2theta bin centers, degrees
+            energies (ndarray): energy of each frame, eV
+            dest_q (ndarray): q bins to sample onto, Å^-1
+            empty (numeric, default 0): value for q bins with no data
+        '''
+        unique_energies,inverse = np.unique(energies,return_inverse=True)
+        wavelengths = 1.239842e-6/unique_energies*1e10 # Å
+        with np.errstate(invalid='ignore'):
+            target_tth = 2*np.degrees(np.arcsin(dest_q[np.newaxis,:]*wavelengths[:,np.newaxis]/(4*np.pi)))
+        position = np.stack([np.interp(t,tth,np.arange(len(tth)),left=np.nan,right=np.nan) for t in target_tth])[inverse]
+        in_range = np.isfinite(position)
+        lower = np.clip(np.floor(np.where(in_range,position,0)).astype(int),0,len(tth)-2)
+        weight = np.where(in_range,position,0)-lower
+
+        broadcast_shape = (len(energies),)+(1,)*(binned.ndim-2)+(len(dest_q),)
+        lower = lower.reshape(broadcast_shape)
+        weight = np.broadcast_to(weight.reshape(broadcast_shape),binned.shape[:-1]+(len(dest_q),))
+        below = np.take_along_axis(binned,lower,axis=-1)
+        above = np.take_along_axis(binned,lower+1,axis=-1)
+        weight = np.where(np.isnan(above),0,np.where(np.isnan(below),1,weight))
+        result = np.nan_to_num(below)*(1-weight) + np.nan_to_num(above)*weight
+        no_data = np.isnan(below) & np.isnan(above)
+        result[no_data | ~np.broadcast_to(in_range.reshape(broadcast_shape),result.shape)] = empty
+        return result
+
+    def integrateImageStack_processes(self,data,chunksize=16,workers=None):
+        '''
+        Not supported: the process-pool workers integrate every frame at the single wavelength of self.integrator, so
+        frames at other energies would land on the wrong q bins.  Use method='batch', which handles every energy.
+        '''
+        raise NotImplementedError('integrateImageStack_processes integrates at a single wavelength and cannot reduce an energy series; use method=\'batch\'.')
+
     def integrateImageStack(self,img_stack,method=None,chunksize=None):
         '''
-        
+        Integrate a stack of raw images taken at different energies.
+
+        Args:
+            img_stack (xarray): raw stack with pix_x and pix_y dimensions and an energy coordinate
+            method (str): 'legacy' (one integrator per energy), 'dask' (lazy, per-chunk), or 'batch' (one shared
+                          2theta sparse matrix for all energies).  Defaults to 'dask' if use_chunked_processing, else 'legacy'.
+            chunksize (int): frames per chunk for the 'dask' and 'batch' methods
         '''
+        func_args = {}
+        if chunksize is not None:
+            func_args['chunksize'] = chunksize
 
         if (self.use_chunked_processing and method is None) or method=='dask':
-            func_args = {}
-            if chunksize is not None:
-                func_args['chunksize'] = chunksize
             return self.integrateImageStack_dask(img_stack,**func_args)
+        elif method == 'batch':
+            return self.integrateImageStack_batch(img_stack,**func_args)
         elif (method is None) or method == 'legacy':
             return self.integrateImageStack_legacy(img_stack)
         else:
@@ -182,15 +305,17 @@ class PFEnergySeriesIntegrator(PFGeneralIntegrator):
 
     def createIntegrator(self,en,recreate=False):
         if en not in self.integrator_stack.keys() or recreate:
-            self.integrator_stack[en] = azimuthalIntegrator.AzimuthalIntegrator(
-            self.dist, self.poni1, self.poni2, self.rot1, self.rot2, self.rot3 ,pixel1=self.pixel1,pixel2=self.pixel2, wavelength = 1.239842e-6/en)
+            self.integrator_stack[en] = makeAzimuthalIntegrator(
+            self.dist, self.poni1, self.poni2, self.rot1, self.rot2, self.rot3, self.pixel1, self.pixel2, 1.239842e-6/en)
         return self.integrator_stack[en]
     def __init__(self,**kwargs):
         self.integrator_stack = {}
         
         super().__init__(**kwargs)
     def recreateIntegrator(self):
-        pass
+        # per-energy integrators are rebuilt lazily by createIntegrator after a geometry change
+        self.integrator_stack = {}
+        self._integrator = None
     
     def __str__(self):
         return f"PyFAI energy-series integrator  SDD = {self.dist} m, poni1 = {self.poni1} m, poni2 = {self.poni2} m, rot1 = {self.rot1} rad, rot2 = {self.rot2} rad"
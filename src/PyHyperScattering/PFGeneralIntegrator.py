@@ -1,5 +1,11 @@
 from pyFAI import azimuthalIntegrator
-from pyFAI.units import eq_q, formula_q, register_radial_unit
+from pyFAI.units import eq_q, formula_q, register_radial_unit, to_unit, CHI_DEG
+from pyFAI.method_registry import IntegrationMethod
+import scipy.sparse
+import hashlib
+import threading
+import concurrent.futures
+from collections import OrderedDict
 import h5py
 import warnings
 import xarray as xr
@@ -40,6 +46,229 @@ DatasetGroupBy.progress_map_blocks = inner_generator(df_function='map_blocks')
 
 # end monkey patch
 
+class SparseIntegrationEngine():
+    '''
+    A pyFAI CSR integration matrix for a single geometry, mask and binning, applied to whole stacks of frames at once.
+
+    The matrix is built once by pyFAI (using the same splitting scheme that integrate1d/integrate2d would pick for
+    the requested method); integrating a stack is then one sparse-dense matrix product for the signal and the
+    solid-angle normalization, rather than one pyFAI call per frame.
+    '''
+    # 2d integrations always use this many chi bins over the full circle
+    npts_chi = 360
+
+    def __init__(self,integrator,shape,npts,mask=None,unit='q_A^-1',method='csr',correctSolidAngle=True,do_1d_integration=False):
+        '''
+        Args:
+            integrator (pyFAI.AzimuthalIntegrator): integrator carrying the geometry
+            shape (tuple): (pix_y, pix_x) shape of a single frame
+            npts (int): number of radial bins
+            mask (array-like or None): pixel mask, true/nonzero = masked
+            unit (str): pyFAI radial unit to bin in
+            method (str or tuple): pyFAI integration method; only its pixel-splitting scheme is used
+            correctSolidAngle (bool): normalize by pixel solid angle
+            do_1d_integration (bool): build a 1d (q) rather than 2d (chi,q) matrix
+        '''
+        self.shape = tuple(shape)
+        self.npts = npts
+        self.do_1d_integration = do_1d_integration
+        pyfai_method = IntegrationMethod.select_one_available(method,dim=1 if do_1d_integration else 2,degradable=True)
+        split = 'bbox' if pyfai_method is None else pyfai_method.split_lower
+        if mask is not None:
+            mask = np.ascontiguousarray(mask,dtype=np.int8)
+
+        if do_1d_integration:
+            engine = integrator.setup_sparse_integrator(self.shape,npts,mask=mask,unit=unit,split=split,algo='CSR')
+            self.radial = engine.bin_centers * to_unit(unit).scale
+            self.azimuthal = None
+            self.output_shape = (npts,)
+        else:
+            engine = integrator.setup_sparse_integrator(self.shape,(npts,self.npts_chi),mask=mask,unit=(unit,'chi_deg'),split=split,algo='CSR')
+            self.radial = engine.bin_centers0 * to_unit(unit).scale
+            self.azimuthal = engine.bin_centers1 * CHI_DEG.scale
+            self.output_shape = (len(self.azimuthal),npts)
+
+        data,indices,indptr = engine.lut
+        self.matrix = scipy.sparse.csr_matrix((data,indices,indptr),shape=(len(indptr)-1,self.shape[0]*self.shape[1]))
+        if correctSolidAngle:
+            self.solid_angle = integrator.solidAngleArray(self.shape).astype(np.float32).reshape(-1)
+        else:
+            self.solid_angle = np.ones(self.shape[0]*self.shape[1],dtype=np.float32)
+        self.norm = self.matrix @ self.solid_angle
+
+    def integrate(self,frames,empty=0.,dummy=None,out=None):
+        '''
+        Integrate a stack of frames.
+
+        Non-finite pixels, and pixels equal to dummy, are excluded from both the signal and the normalization of the
+        frame they appear in, matching pyFAI's per-frame behavior.
+
+        Args:
+            frames (array-like): (n, pix_y, pix_x) or (pix_y, pix_x) intensities
+            empty (numeric, default 0): value to put in bins that no valid pixel contributes to
+            dummy (numeric or None): pixel value marking invalid pixels, as pyFAI's dummy argument
+            out (ndarray or None): optional (n,)+output_shape float32 array to write the result into
+
+        Returns:
+            ndarray of shape (n, chi, q), or (n, q) for 1d integration
+        '''
+        frames = np.asarray(frames,dtype=np.float32)
+        frames = frames.reshape(-1,self.shape[0]*self.shape[1])
+        nframes = frames.shape[0]
+        valid = np.isfinite(frames)
+        if dummy is not None:
+            valid &= frames != dummy
+        if valid.all():
+            signal = self.matrix @ frames.T
+            norm = self.norm[:,np.newaxis]
+        else:
+            signal = self.matrix @ np.where(valid,frames,0).T
+            norm = self.matrix @ (valid * self.solid_angle).T
+        with np.errstate(divide='ignore',invalid='ignore'):
+            result = signal / norm
+        result[np.broadcast_to(norm==0,result.shape)] = empty
+        if self.do_1d_integration:
+            result = result.T
+        else:
+            # pyFAI orders 2d bins radial-major; swap to (chi,q)
+            result = result.reshape(self.npts,-1,nframes).transpose(2,1,0)
+        if out is None:
+            return np.ascontiguousarray(result)
+        out[...] = result
+        return out
+
+    @property
+    def nbytes(self):
+        return (self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes
+                + self.solid_angle.nbytes + self.norm.nbytes)
+
+
+class IntegrationEngineCache():
+    '''
+    Process-wide LRU cache of sparse integration and polar remap engines, keyed on geometry.
+
+    Only immutable engines with a fixed nbytes are cached, so each entry's size is measured once, on insertion, and
+    stays right for as long as it is cached; the cache holds the only shared reference, so evicting an entry frees it
+    once no integration is using it.  Mutable pyFAI AzimuthalIntegrators are never cached or shared between
+    integrator instances.  Entries are evicted least-recently-used first once their total size exceeds max_bytes or
+    there are more than max_entries.
+    '''
+    def __init__(self,max_bytes=2*1024**3,max_entries=64):
+        '''
+        Args:
+            max_bytes (int, default 2 GiB): memory budget for cached engines
+            max_entries (int, default 64): maximum number of cached engines
+        '''
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+    def get(self,key,factory):
+        '''
+        return the cached engine for key, creating it with factory() on a miss
+
+        Args:
+            key (hashable): cache key, see geometryKey
+            factory (callable): no-argument callable that builds the engine; the engine should have an nbytes
+                                attribute, or it is counted as 0 bytes
+        '''
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        value = factory()
+        with self._lock:
+            if key in self._entries:
+                # built concurrently by another thread; keep the first one
+                return self._entries[key]
+            self._entries[key] = value
+            self._sizes[key] = getattr(value,'nbytes',0)
+            self.nbytes += self._sizes[key]
+            self._evict()
+        return value
+
+    def _evict(self):
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.nbytes > self.max_bytes):
+            key,value = self._entries.popitem(last=False)
+            self.nbytes -= self._sizes.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return f'IntegrationEngineCache with {len(self)} entries ({self.nbytes/1024**2:.1f} MiB), {self.hits} hits, {self.misses} misses'
+
+
+engine_cache = IntegrationEngineCache()
+
+def geometryKey(dist,poni1,poni2,rot1,rot2,rot3,pixel1,pixel2,wavelength):
+    '''
+    hashable key for a pyFAI geometry; values are rounded to 12 significant figures so that numbers that went
+    through unit conversions (e.g. Nika mm/pixel -> pyFAI m) still match
+    '''
+    return tuple(float(f'{float(v):.12g}') for v in (dist,poni1,poni2,rot1,rot2,rot3,pixel1,pixel2,wavelength))
+
+def maskKey(mask):
+    '''
+    hashable key for a mask array: its shape plus a digest of its boolean contents
+    '''
+    if mask is None:
+        return None
+    mask = np.ascontiguousarray(mask,dtype=bool)
+    return (mask.shape,hashlib.sha1(mask.tobytes()).hexdigest())
+
+def makeAzimuthalIntegrator(dist,poni1,poni2,rot1,rot2,rot3,pixel1,pixel2,wavelength):
+    '''
+    a new AzimuthalIntegrator for this geometry.  Integrators are mutable and build their own engines as they are
+    used, so they are not shared through engine_cache.
+    '''
+    return azimuthalIntegrator.AzimuthalIntegrator(dist,poni1,poni2,rot1,rot2,rot3,pixel1=pixel1,pixel2=pixel2,
+                                                   wavelength=wavelength)
+
+
+def _register_log_ish_unit():
+    register_radial_unit("arcsinh(q.µm)",
+                         scale=1.0,
+                         label=r"arcsinh($q$.µm)",
+                         formula="arcsinh(4.0e-6*π/λ*sin(arctan2(sqrt(x**2 + y**2), z)/2.0))")
+
+# per-process state for integrateImageStack_processes workers
+_worker_state = {}
+
+def _process_worker_init(geometry,frame_shape,engine_args,shm_name,out_shape,dummy,empty):
+    from multiprocessing import shared_memory
+    if engine_args['unit'] == 'arcsinh(q.µm)':
+        _register_log_ish_unit()
+    _worker_state['engine'] = SparseIntegrationEngine(makeAzimuthalIntegrator(*geometry),frame_shape,**engine_args)
+    _worker_state['shm'] = shared_memory.SharedMemory(name=shm_name)
+    _worker_state['out'] = np.ndarray(out_shape,dtype=np.float32,buffer=_worker_state['shm'].buf)
+    _worker_state['dummy'] = dummy
+    _worker_state['empty'] = empty
+
+def _process_worker_integrate(start,frames):
+    '''
+    integrate frames into the shared output from row start on, and return the engine's (radial, azimuthal) bin centers
+    '''
+    engine = _worker_state['engine']
+    engine.integrate(frames,empty=_worker_state['empty'],dummy=_worker_state['dummy'],out=_worker_state['out'][start:start+len(frames)])
+    return engine.radial,engine.azimuthal
+
+
 class PFGeneralIntegrator():
 
     def integrateSingleImage(self, img):
@@ -78,10 +307,12 @@ class PFGeneralIntegrator():
         else:
             integ_func = self.integrator.integrate2d
 
+        npts,radial_range = self.radialBinning()
         try:
             frame = integ_func(img_to_integ,
-                               self.npts,
+                               npts,
                                filename=None,
+                               radial_range=radial_range,
                                correctSolidAngle=self.correctSolidAngle,
                                error_model="azimuthal",
                                dummy=-8675309 if self.maskToNan else 0,
@@ -129,6 +360,12 @@ class PFGeneralIntegrator():
             res['dI'] = sigma
         return res
 
+    def radialBinning(self):
+        '''
+        number of radial bins and radial range (in integration units, or None for the full detector) for integrateSingleImage
+        '''
+        return self.npts,None
+
     '''
     legacy index ident code:
      indexes = list(data.indexes.keys())
@@ -169,6 +406,7 @@ class PFGeneralIntegrator():
         #return int_stack
         
     def integrateImageStack_dask(self,data,chunksize=5):
+        import dask.array as da
         #int_stack = img_stack.groupby('system').map(self.integrateSingleImage)   
         #return int_stack
         indexes = list(data.dims)
@@ -220,21 +458,20 @@ class PFGeneralIntegrator():
             order_list.append(idx)
             coord_dict[idx] = data.indexes[idx]
             shape = shape + tuple([len(data.indexes[idx])])
-        shape = shape + (360,npts_q)
+        shape = shape + (len(demo_integration.chi),npts_q)
         
         desired_order_list = order_list+['chi','q']
         coord_dict_sorted = {k: coord_dict[k] for k in desired_order_list}
         
-        
-        
-        template = xr.DataArray(np.empty(shape),coords=coord_dict_sorted)  
+        # the template only describes the output, so keep it lazy rather than allocating the full cube
+        chunks = tuple(chunksize if dim == indexes[0] else -1 for dim in desired_order_list)
+        template = xr.DataArray(da.empty(shape,dtype=demo_integration.dtype,chunks=chunks),coords=coord_dict_sorted)
         
         print(demo_integration.dims)
         if 'image_num' in demo_integration.dims:
             template = template.transpose(*[item if item != 'image_num' else dim_to_chunk for item in demo_integration.dims])
         elif dim_to_chunk not in demo_integration.dims:
             template = template.transpose(dim_to_chunk, *demo_integration.dims)
-        template = template.chunk({indexes[0]:chunksize})
         '''
         try:
             print(template)
@@ -253,8 +490,104 @@ class PFGeneralIntegrator():
         integ_fly = data.map_blocks(self.integrateImageStack_legacy,template=template)
         if dim_to_chunk=='pyhyper_internal_multiindex':
             integ_fly = integ_fly.unstack('pyhyper_internal_multiindex')
-        return integ_fly 
-    
+        return integ_fly
+
+    def getSparseEngine(self,shape,unit=None):
+        '''
+        return the sparse integration engine for the current geometry, mask and binning from the process-wide
+        engine_cache, building it if needed
+
+        Args:
+            shape (tuple): (pix_y, pix_x) shape of a single frame
+            unit (str or None): pyFAI radial unit to bin in; if None, q (or arcsinh q if use_log_ish_binning)
+        '''
+        integrator = self.integrator
+        if unit is None:
+            unit = 'arcsinh(q.µm)' if self.use_log_ish_binning else 'q_A^-1'
+        # angle and distance binning does not depend on wavelength, so one engine serves every energy
+        wavelength = 0 if unit.startswith(('2th','r_')) else integrator.wavelength
+        key = (('sparse',)
+               + geometryKey(integrator.dist,integrator.poni1,integrator.poni2,integrator.rot1,integrator.rot2,integrator.rot3,
+                             integrator.pixel1,integrator.pixel2,wavelength)
+               + (tuple(shape),maskKey(self.mask),self.npts,unit,self.integration_method,self.correctSolidAngle,self.do_1d_integration))
+        return engine_cache.get(key,lambda: SparseIntegrationEngine(integrator,shape,self.npts,
+                                                                   mask=self.mask,
+                                                                   unit=unit,
+                                                                   method=self.integration_method,
+                                                                   correctSolidAngle=self.correctSolidAngle,
+                                                                   do_1d_integration=self.do_1d_integration))
+
+    def _legacyFill(self):
+        '''
+        (dummy, empty) for the sparse engines, matching integrateSingleImage: pixels equal to the dummy value it passes
+        pyFAI are dropped, and bins that no valid pixel reaches get pyFAI's empty value (0 by default), whatever
+        maskToNan is
+        '''
+        return (-8675309 if self.maskToNan else 0),self.integrator.empty
+
+    def _prepareBatch(self,data):
+        '''
+        transpose a raw stack to (frames..., pix_y, pix_x) order and check (or create) the mask for batch integration
+
+        Returns:
+            (data, indexes, pixel_dims): the transposed stack, its non-pixel dims and its pixel dims
+        '''
+        if self.return_sigma:
+            raise NotImplementedError('batch integration does not support return_sigma, use method="legacy"')
+        pixel_dims = [dim for dim in data.dims if dim in ['pix_x','pix_y']]
+        indexes = [dim for dim in data.dims if dim not in pixel_dims]
+        data = data.transpose(*indexes,*pixel_dims)
+        frame_shape = data.shape[len(indexes):]
+
+        if self.mask is None:
+            warnings.warn(f'No mask defined.  Creating an empty mask with dimensions {frame_shape}.',stacklevel=2)
+            self.mask = np.zeros(frame_shape)
+        assert np.shape(self.mask)==frame_shape,f'Error!  Mask has shape {np.shape(self.mask)} but you are attempting to integrate data with shape {frame_shape}.  Try changing mask orientation or updating mask.'
+        return data,indexes,pixel_dims
+
+    def _batchResult(self,data,indexes,pixel_dims,out,chi,q):
+        '''
+        wrap a (frames, [chi,] q) batch result back into an xarray carrying the non-pixel coords of data
+        '''
+        stack_shape = data.shape[:len(indexes)]
+        if chi is None:
+            out_dims = indexes+['q']
+            out_coords = {'q':q}
+        else:
+            out_dims = indexes+['chi','q']
+            out_coords = {'chi':chi,'q':q}
+        res = xr.DataArray(out.reshape(stack_shape+out.shape[1:]),dims=out_dims,
+                           coords=data.isel({dim:0 for dim in pixel_dims},drop=True).coords,attrs=data.attrs)
+        return res.assign_coords(out_coords)
+
+    def integrateImageStack_batch(self,data,chunksize=64):
+        '''
+        Integrate a whole stack through a single sparse integration matrix.
+
+        The matrix is built once for the current geometry and mask, then applied to chunksize frames at a time,
+        writing into one preallocated (frames..., chi, q) output.  Non-pixel dimensions keep their order and coords.
+
+        Args:
+            data (xarray): raw stack with pix_x and pix_y dimensions
+            chunksize (int, default 64): number of frames per sparse matrix product; bounds the temporary memory
+        '''
+        data,indexes,pixel_dims = self._prepareBatch(data)
+        frame_shape = data.shape[len(indexes):]
+        engine = self.getSparseEngine(frame_shape)
+        nframes = int(np.prod(data.shape[:len(indexes)]))
+        frames = data.data.reshape((nframes,)+frame_shape)
+        out = np.empty((nframes,)+engine.output_shape,dtype=np.float32)
+        dummy,empty = self._legacyFill()
+        for start in tqdm(range(0,nframes,chunksize)):
+            stop = min(start+chunksize,nframes)
+            engine.integrate(frames[start:stop],empty=empty,dummy=dummy,out=out[start:stop])
+
+        if self.use_log_ish_binning:
+            radial_to_save = np.sinh(engine.radial) / 10000  # was 1000 for inverse nm
+        else:
+            radial_to_save = engine.radial
+        return self._batchResult(data,indexes,pixel_dims,out,engine.azimuthal,radial_to_save)
+
     
     def __init__(self,
                  maskmethod='none', 
@@ -302,10 +635,7 @@ class PFGeneralIntegrator():
         self.use_log_ish_binning = use_log_ish_binning
         self.do_1d_integration = do_1d_integration
         if self.use_log_ish_binning:
-            register_radial_unit("arcsinh(q.µm)",
-                                 scale=1.0,
-                                 label=r"arcsinh($q$.µm)",
-                                 formula="arcsinh(4.0e-6*π/λ*sin(arctan2(sqrt(x**2 + y**2), z)/2.0))")
+            _register_log_ish_unit()
 
         self.maskToNan = maskToNan
         self.return_sigma = return_sigma
@@ -331,21 +661,88 @@ class PFGeneralIntegrator():
         return f"PyFAI general integrator wrapper SDD = {self.dist} m, poni1 = {self.poni1} m, poni2 = {self.poni2} m, rot1 = {self.rot1} rad, rot2 = {self.rot2} rad"
 
 
-    def integrateImageStack(self,img_stack,method=None,chunksize=None):
+    def integrateImageStack(self,img_stack,method=None,chunksize=None,workers=None):
         '''
-        
+        Integrate a stack of raw images.
+
+        Args:
+            img_stack (xarray): raw stack with pix_x and pix_y dimensions
+            method (str): 'legacy' (one pyFAI call per frame), 'dask' (lazy, per-chunk), 'batch' (one sparse
+                          matrix applied to the whole stack), or 'processes' (batch integration spread over a local
+                          process pool, no Dask needed).  Defaults to 'dask' if use_chunked_processing, else 'legacy'.
+            chunksize (int): frames per chunk for the 'dask', 'batch' and 'processes' methods
+            workers (int): number of worker processes for the 'processes' method, default os.cpu_count()
         '''
+        func_args = {}
+        if chunksize is not None:
+            func_args['chunksize'] = chunksize
 
         if (self.use_chunked_processing and method is None) or method=='dask':
-            func_args = {}
-            if chunksize is not None:
-                func_args['chunksize'] = chunksize
             return self.integrateImageStack_dask(img_stack,**func_args)
+        elif method == 'batch':
+            return self.integrateImageStack_batch(img_stack,**func_args)
+        elif method == 'processes':
+            return self.integrateImageStack_processes(img_stack,workers=workers,**func_args)
         elif (method is None) or method == 'legacy':
             return self.integrateImageStack_legacy(img_stack)
         else:
             raise NotImplementedError(f'unsupported integration method {method}')
 
+    def integrateImageStack_processes(self,data,chunksize=16,workers=None):
+        '''
+        Batch-integrate a stack on a concurrent.futures process pool.
+
+        Each worker receives the geometry and mask once, through the pool initializer, builds its own sparse engine,
+        and writes its chunks of frames straight into a shared-memory output cube.  The parent never builds an
+        engine: the output shape follows from the binning settings, and the bin centers come back from the workers.
+
+        Args:
+            data (xarray): raw stack with pix_x and pix_y dimensions
+            chunksize (int, default 16): number of frames sent to a worker per task
+            workers (int or None): number of worker processes, default os.cpu_count()
+        '''
+        from multiprocessing import shared_memory
+
+        data,indexes,pixel_dims = self._prepareBatch(data)
+        frame_shape = data.shape[len(indexes):]
+        nframes = int(np.prod(data.shape[:len(indexes)]))
+        if nframes == 0:
+            # nothing to spread over a pool, and shared memory cannot be zero-sized
+            return self.integrateImageStack_batch(data)
+        frames = data.data.reshape((nframes,)+frame_shape)
+        out_shape = (nframes,self.npts) if self.do_1d_integration else (nframes,SparseIntegrationEngine.npts_chi,self.npts)
+
+        integrator = self.integrator
+        geometry = (integrator.dist,integrator.poni1,integrator.poni2,integrator.rot1,integrator.rot2,integrator.rot3,
+                    integrator.pixel1,integrator.pixel2,integrator.wavelength)
+        engine_args = dict(npts=self.npts,
+                           mask=np.asarray(self.mask,dtype=bool),
+                           unit='arcsinh(q.µm)' if self.use_log_ish_binning else 'q_A^-1',
+                           method=self.integration_method,
+                           correctSolidAngle=self.correctSolidAngle,
+                           do_1d_integration=self.do_1d_integration)
+
+        shm = shared_memory.SharedMemory(create=True,size=int(np.prod(out_shape))*np.dtype(np.float32).itemsize)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        initializer=_process_worker_init,
+                                                        initargs=(geometry,frame_shape,engine_args,shm.name,out_shape)
+                                                                 +self._legacyFill()) as pool:
+                futures = [pool.submit(_process_worker_integrate,start,np.asarray(frames[start:min(start+chunksize,nframes)]))
+                           for start in range(0,nframes,chunksize)]
+                for future in tqdm(concurrent.futures.as_completed(futures),total=len(futures)):
+                    radial,azimuthal = future.result()
+            out = np.array(np.ndarray(out_shape,dtype=np.float32,buffer=shm.buf))
+        finally:
+            shm.close()
+            shm.unlink()
+
+        if self.use_log_ish_binning:
+            radial_to_save = np.sinh(radial) / 10000  # was 1000 for inverse nm
+        else:
+            radial_to_save = radial
+        return self._batchResult(data,indexes,pixel_dims,out,azimuthal,radial_to_save)
+
 
     def loadPolyMask(self,maskpoints = [], **kwargs):
         '''
@@ -567,13 +964,26 @@ class PFGeneralIntegrator():
         self.ni_beamcenter_y = self.ni_beamcenter_y
         self.recreateIntegrator()
 
+    @property
+    def integrator(self):
+        if getattr(self,'_integrator',None) is None:
+            self._integrator = makeAzimuthalIntegrator(self.dist, self.poni1, self.poni2, self.rot1, self.rot2, self.rot3,
+                                                       self.pixel1, self.pixel2, self.wavelength)
+        return self._integrator
+
+    @integrator.setter
+    def integrator(self, value):
+        self._integrator = value
+
     def recreateIntegrator(self):
         '''
         recreate the integrator, after geometry change
+
+        The integrator is only rebuilt lazily on next use, so a chain of setter calls (e.g. calibrationFromNikaParams)
+        builds one integrator.  Sparse engines for batch integration are cached process-wide (see engine_cache), so
+        returning to a previously-used geometry reuses them.
         '''
-        self.integrator = azimuthalIntegrator.AzimuthalIntegrator(
-            self.dist, self.poni1, self.poni2, self.rot1, self.rot2, self.rot3, pixel1=self.pixel1, pixel2=self.pixel2,
-            wavelength=self.wavelength)
+        self._integrator = None
 
     def calibrationFromNikaParams(self, distance, bcx, bcy, tiltx, tilty, pixsizex, pixsizey):
         '''
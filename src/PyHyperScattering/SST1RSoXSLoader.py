@@ -7,6 +7,7 @@ import pandas as pd
 import datetime
 import warnings
 import json
+import threading
 #from pyFAI import azimuthalIntegrator
 import numpy as np
 
@@ -44,6 +45,8 @@ class SST1RSoXSLoader(FileLoader):
         self.dark_pedestal = dark_pedestal
         self.user_corr_func = user_corr_func
         self.exposure_offset = exposure_offset
+        self._scan_md_index = {}
+        self._scan_md_lock = threading.Lock()
         # self.darks = {}
     # def loadFileSeries(self,basepath):
     #     try:
@@ -71,16 +74,18 @@ class SST1RSoXSLoader(FileLoader):
             filepath (Pathlib.path): path of the file to load
             coords (dict-like): coordinate values to inject into the metadata
             return_q (bool): return qx / qy coords.  If false, returns pixel coords.
+            image_slice (tuple of slices): if provided, only this (pix_y, pix_x) region of the image is read
 
         '''
         if len(kwargs.keys())>0:
             warnings.warn(f'Loader does not support features for kwargs: {kwargs.keys()}',stacklevel=2)
         
-        if image_slice != None:
-            raise NotImplementedError('Image slicing is not supported for SST1')
         if use_cached_md != False:
             raise NotImplementedError('Caching of metadata is not supported for SST1')
-        img = Image.open(filepath)
+        if image_slice is None:
+            image_slice = ()
+        image_slice = tuple(image_slice)
+        img,full_shape = self.readTiff(filepath,image_slice)
 
         headerdict = self.loadMd(filepath)
         # two steps in this pre-processing stage:
@@ -112,17 +117,78 @@ class SST1RSoXSLoader(FileLoader):
 
         # # step 2: dark subtraction
         # this is already done in the suitcase, but we offer the option to add/subtract a pedestal.
-        image_data = (np.array(img)-self.dark_pedestal)/corr
+        image_data = (img-self.dark_pedestal)/corr
         if return_q:
             qpx = 2*np.pi*60e-6/(headerdict['sdd']/1000)/(headerdict['wavelength']*1e10)
-            qx = (np.arange(1,img.size[0]+1)-headerdict['beamcenter_y'])*qpx
-            qy = (np.arange(1,img.size[1]+1)-headerdict['beamcenter_x'])*qpx
+            rows = np.arange(1,full_shape[0]+1)[image_slice[0] if len(image_slice)>0 else slice(None)]
+            cols = np.arange(1,full_shape[1]+1)[image_slice[1] if len(image_slice)>1 else slice(None)]
+            qx = (cols-headerdict['beamcenter_y'])*qpx
+            qy = (rows-headerdict['beamcenter_x'])*qpx
             # now, match up the dims and coords
             return xr.DataArray(image_data,dims=['qy','qx'],coords={'qy':qy,'qx':qx},attrs=headerdict)
         else:
             # dim order changed by ktoth17 to reflect SST1RSoXSDB.py. See Issue #34 for more details. 
             return xr.DataArray(image_data,dims=['pix_y','pix_x'],attrs=headerdict)
 
+    # numpy dtypes for the PIL raw modes of uncompressed TIFF strips
+    _tiff_rawmode_dtypes = {'I;16':'<u2','I;16B':'>u2','I;16N':'=u2','I;32S':'<i4','I;32BS':'>i4','I;32':'<u4',
+                            'I;32B':'>u4','I;32N':'=u4','F;32F':'<f4','F;32BF':'>f4','F;64F':'<f8','F;64BF':'>f8',
+                            'L':'u1'}
+
+    def _rawTiffLayout(self,img):
+        '''
+        (dtype, offset) of an uncompressed image whose strips lie back to back in the file, top to bottom, so that the
+        whole image can be memory-mapped as one array; None for anything else.
+
+        Args:
+            img (PIL.Image): the opened, not yet decoded, image
+        '''
+        width,height = img.size
+        if len(img.tile) == 0:
+            return None
+        rawmode = img.tile[0][3][0]
+        if rawmode not in self._tiff_rawmode_dtypes:
+            return None
+        dtype = self._tiff_rawmode_dtypes[rawmode]
+        row_bytes = width*np.dtype(dtype).itemsize
+        offset = img.tile[0][2]
+        row = 0
+        for codec,extents,strip_offset,args in img.tile:
+            if (codec != 'raw' or tuple(args[:3]) != (rawmode,0,1) or (extents[0],extents[1],extents[2]) != (0,row,width)
+                    or strip_offset != offset+row*row_bytes):
+                return None
+            row = extents[3]
+        if row != height:
+            return None
+        return dtype,offset
+
+    def readTiff(self,filepath,image_slice=()):
+        '''
+        Read a (region of a) TIFF image.
+
+        Uncompressed images stored in contiguous strips are memory-mapped at their first strip, so only the bytes
+        inside image_slice are read from disk.  Anything else (compressed, tiled or scattered strips) is decoded by
+        PIL and then sliced, with a warning if image_slice selects only part of the image.
+
+        Args:
+            filepath (Pathlib.path): path of the file to load
+            image_slice (tuple of slices): region of the (rows, columns) image to return
+
+        Returns:
+            (ndarray of the region, shape of the full image)
+        '''
+        with Image.open(filepath) as img:
+            full_shape = (img.size[1],img.size[0])
+            layout = self._rawTiffLayout(img)
+            if layout is not None:
+                dtype,offset = layout
+                data = np.memmap(filepath,dtype=dtype,mode='r',offset=offset,shape=full_shape)
+                return np.array(data[image_slice]),full_shape
+            whole_image = all(isinstance(s,slice) and s.indices(n) == (0,n,1) for s,n in zip(image_slice,full_shape))
+            if not whole_image:
+                warnings.warn('TIFF image is not stored as contiguous uncompressed strips; decoding the whole image before slicing',stacklevel=2)
+            return np.array(img)[image_slice],full_shape
+
     def read_json(self,jsonfile):
         json_dict = {}
         with open(jsonfile) as f:
@@ -208,7 +274,10 @@ class SST1RSoXSLoader(FileLoader):
 
     def read_primary(self,primary_csv,seq_num, cwd):
         primary_dict = {}
-        df_primary = pd.read_csv(primary_csv)
+        if isinstance(primary_csv,pd.DataFrame):
+            df_primary = primary_csv
+        else:
+            df_primary = pd.read_csv(primary_csv)
         # if json_dict['rsoxs_config'] == 'waxs':
         try:
             primary_dict['exposure'] = df_primary['RSoXS Shutter Opening Time (ms)'][seq_num]
@@ -232,6 +301,41 @@ class SST1RSoXSLoader(FileLoader):
         return primary_dict
 
 
+    def scanMdIndex(self,cwd,scan_id):
+        '''
+        Parsed scan-level metadata (jsonl, baseline csv and primary csv) for one scan directory.
+
+        The files are globbed and parsed once per scan and cached, keyed by directory and scan id.  Later calls only
+        stat the cached files, and reparse if any of them changed on disk.
+
+        Args:
+            cwd (pathlib.Path): directory holding the images, jsonl and baseline csv
+            scan_id (str): scan id prefix of the primary csv, which sits in the parent directory
+
+        Returns:
+            dict with keys 'json' and 'baseline' (dicts) and 'primary' (DataFrame indexed by seq_num)
+        '''
+        key = (str(cwd.absolute()),scan_id)
+        with self._scan_md_lock:
+            cached = self._scan_md_index.get(key)
+            if cached is not None:
+                try:
+                    if all(os.path.getmtime(path) == mtime for path,mtime in cached['mtimes'].items()):
+                        return cached
+                except OSError:
+                    pass
+
+            json_fname = list(cwd.glob('*.jsonl'))
+            baseline_fname = list(cwd.glob('*baseline.csv'))
+            primary_path = pathlib.Path(os.path.dirname(cwd))
+            primary_fname = list(primary_path.glob(f'{scan_id}*primary.csv'))
+            scan_md = {'json':self.read_json(json_fname[0]),
+                       'baseline':self.read_baseline(baseline_fname[0]),
+                       'primary':pd.read_csv(primary_fname[0]),
+                       'mtimes':{path:os.path.getmtime(path) for path in (json_fname[0],baseline_fname[0],primary_fname[0])}}
+            self._scan_md_index[key] = scan_md
+            return scan_md
+
     def loadMd(self,filepath):
         # get sequence number of image for primary csv
         fname = os.path.basename(filepath)
@@ -247,16 +351,10 @@ class SST1RSoXSLoader(FileLoader):
         else:
             cwd = pathlib.Path(dirPath)
 
-        json_fname = list(cwd.glob('*.jsonl'))
-        json_dict = self.read_json(json_fname[0])
-
-        baseline_fname = list(cwd.glob('*baseline.csv'))
-        baseline_dict = self.read_baseline(baseline_fname[0])
-
-
-        primary_path = pathlib.Path(os.path.dirname(cwd))
-        primary_fname = list(primary_path.glob(f'{scan_id}*primary.csv'))
-        primary_dict = self.read_primary(primary_fname[0],seq_num, cwd)
+        scan_md = self.scanMdIndex(cwd,scan_id)
+        json_dict = scan_md['json']
+        baseline_dict = scan_md['baseline']
+        primary_dict = self.read_primary(scan_md['primary'],seq_num, cwd)
 
         # else:
         #     json_fname = list(pathlib.Path(dirPath).glob('*jsonl'))
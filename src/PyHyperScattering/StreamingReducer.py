@@ -0,0 +1,293 @@
+import os
+import pathlib
+import re
+import time
+import h5py
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+class StreamingReducer():
+    '''
+    Integrate frames one at a time as they arrive and append each result to a chunked, resizable HDF5 cube.
+
+    The cube is written in SWMR (single-writer, multiple-reader) mode and flushed after every frame, so
+    loadStreamedReduction() can be used to look at I(chi,q) while the scan is still running, and no reload of the
+    raw stack is needed once it finishes.
+
+    Frames can come from a polled directory (watchDirectory, using any FileLoader subclass), from Bluesky-style
+    (name, document) pairs (processDocuments), or be pushed directly as DataArrays (processFrame).
+
+    Usage:
+        with StreamingReducer(integrator,'live.h5',dims=['energy','polarization'],loader=SST1RSoXSLoader()) as sr:
+            sr.watchDirectory('/path/to/scan/',idle_timeout=60)
+        red = loadStreamedReduction('live.h5')
+    '''
+
+    def __init__(self,integrator,output_file,dims,loader=None,chunk_frames=16,compression=None,energies=None):
+        '''
+        Args:
+            integrator (PFGeneralIntegrator or similar): any integrator with an integrateSingleImage method
+            output_file (str or Path): HDF5 file to write the reduced cube to; overwritten if it exists
+            dims (list of str): metadata attributes of each frame to record as its coordinates
+            loader (FileLoader or None): loader used by watchDirectory to read new files
+            chunk_frames (int, default 16): number of frames per HDF5 chunk along the frame axis
+            compression (str, int or None): h5py compression for the intensity datasets.  Off by default to keep
+                                            per-frame latency low.
+            energies (list of float or None): energies of the scan, used to set up the common q axis of an energy-series
+                                              integrator that has no dest_q yet.  If None, the first frame's energy is used.
+        '''
+        self.integrator = integrator
+        self.output_file = pathlib.Path(output_file)
+        self.dims = list(dims)
+        self.loader = loader
+        self.chunk_frames = chunk_frames
+        self.compression = compression
+        self.energies = energies
+        self.nframes = 0
+        self.processed_files = set()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _createStore(self,reduced,attrs):
+        '''
+        create the resizable datasets from the first reduced frame, then switch the file to SWMR mode
+        '''
+        f = h5py.File(self.output_file,'w',libver='latest')
+        f.attrs['dims'] = self.dims
+        grp = f.create_group('reduced')
+        for name,var in reduced.items():
+            ds = grp.create_dataset(name,shape=(0,)+var.shape,maxshape=(None,)+var.shape,dtype=var.dtype,
+                                    chunks=(self.chunk_frames,)+var.shape,compression=self.compression)
+            ds.attrs['frame_dims'] = list(var.dims)
+        first = next(iter(reduced.values()))
+        for axis in first.dims:
+            f.create_dataset(axis,data=first[axis].values)
+        coords = f.create_group('coords')
+        for dim in self.dims:
+            # the first frame only decides string vs numeric: strings are variable-length and numbers float64, so later
+            # frames are neither truncated nor rounded to the first frame's dtype
+            dtype = h5py.string_dtype() if isinstance(attrs[dim],str) else np.float64
+            coords.create_dataset(dim,shape=(0,),maxshape=(None,),dtype=dtype,chunks=(max(self.chunk_frames,64),))
+        f.swmr_mode = True
+        self._file = f
+
+    def _setupDestQ(self,img):
+        '''
+        energy-series integrators resample every frame onto dest_q, so fix it before the first frame and every row of
+        the cube shares one q axis
+        '''
+        if not hasattr(self.integrator,'setupDestQ'):
+            return
+        dest_q = getattr(self.integrator,'dest_q',None)
+        if dest_q is not None and len(dest_q)>0:
+            return
+        if self.energies is not None:
+            energies = np.asarray(self.energies,dtype=float)
+        elif 'energy' in img.attrs:
+            energies = np.asarray([img.attrs['energy']],dtype=float)
+        else:
+            raise KeyError('Frame has no energy, cannot set up the q axis; pass energies to the StreamingReducer constructor.')
+        self.integrator.setupIntegrators(energies)
+        self.integrator.setupDestQ(energies)
+
+    def processFrame(self,img):
+        '''
+        Integrate one raw frame and append it to the output cube.
+
+        Args:
+            img (DataArray): raw pix_x/pix_y frame whose attrs contain every entry of dims
+
+        Returns:
+            the reduced frame, as returned by the integrator
+        '''
+        missing = [dim for dim in self.dims if dim not in img.attrs]
+        if len(missing)>0:
+            raise KeyError(f'Frame is missing metadata for dims {missing}, cannot place it in the reduced cube.')
+        if self._file is None:
+            self._setupDestQ(img)
+        res = self.integrator.integrateSingleImage(img)
+        if type(res) == xr.Dataset:
+            reduced = {name:res[name] for name in res.data_vars}
+        else:
+            reduced = {'I':res}
+        # drop the length-1 image_num/system axis that integrateSingleImage adds
+        reduced = {name:var.isel({dim:0 for dim in var.dims if dim not in ('chi','q')}) for name,var in reduced.items()}
+
+        if self._file is None:
+            self._createStore(reduced,img.attrs)
+        for dim in self.dims:
+            is_str = h5py.check_string_dtype(self._file['coords'][dim].dtype) is not None
+            if isinstance(img.attrs[dim],str) != is_str:
+                raise TypeError(f'Frame has {dim} = {img.attrs[dim]!r}, but earlier frames had {"string" if is_str else "numeric"} values of {dim}.')
+        n = self.nframes
+        for name,var in reduced.items():
+            ds = self._file['reduced'][name]
+            ds.resize(n+1,axis=0)
+            ds[n] = var.values
+        for dim in self.dims:
+            ds = self._file['coords'][dim]
+            ds.resize(n+1,axis=0)
+            ds[n] = img.attrs[dim]
+        self._file.flush()
+        self.nframes += 1
+        return res
+
+    def _fileIsSettled(self,filepath,settle_time):
+        '''
+        a file is ready to read once its size stops changing over settle_time
+        '''
+        size = os.path.getsize(filepath)
+        time.sleep(settle_time)
+        return size > 0 and size == os.path.getsize(filepath)
+
+    def watchDirectory(self,directory,file_filter=None,file_filter_regex=None,poll_interval=0.5,idle_timeout=None,
+                       settle_time=0.05,max_frames=None,stop_event=None,quiet=True):
+        '''
+        Poll a directory and reduce every new file the loader recognises, in sorted name order.
+
+        Only files that have not been seen before are read on each poll, so the cost per frame stays bounded however
+        long the scan runs.
+
+        Args:
+            directory (str or Path): directory to watch
+            file_filter (str): string that must be in each file name
+            file_filter_regex (str): regex that must match each file name
+            poll_interval (float, default 0.5): seconds to wait between directory listings
+            idle_timeout (float or None): stop after this many seconds with no new files; None waits forever
+            settle_time (float, default 0.05): seconds a file's size must stay constant before it is read
+            max_frames (int or None): stop after this many frames have been reduced
+            stop_event (threading.Event or None): stop when this event is set, e.g. from another thread
+            quiet (bool): skip printing per-file output if true
+
+        Returns:
+            number of frames reduced by this call
+        '''
+        if self.loader is None:
+            raise ValueError('watchDirectory needs a loader; pass one to the StreamingReducer constructor.')
+        directory = pathlib.Path(directory)
+        if file_filter_regex is not None:
+            file_filter_regex = re.compile(file_filter_regex)
+        nreduced = 0
+        last_new_file = time.monotonic()
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                break
+            new_files = []
+            for file in sorted(os.listdir(directory)):
+                if file in self.processed_files:
+                    continue
+                if re.match(self.loader.file_ext,file) is None:
+                    continue
+                if (file_filter is not None) and (file_filter not in file):
+                    continue
+                if (file_filter_regex is not None) and (not file_filter_regex.match(file)):
+                    continue
+                new_files.append(file)
+            for file in new_files:
+                if not self._fileIsSettled(directory/file,settle_time):
+                    # still being written, pick it up on the next poll
+                    continue
+                if not quiet:
+                    print(f'Reducing {file}')
+                img = self.loader.loadSingleImage(directory/file,coords={})
+                self.processFrame(img)
+                self.processed_files.add(file)
+                nreduced += 1
+                last_new_file = time.monotonic()
+                if max_frames is not None and nreduced >= max_frames:
+                    return nreduced
+            if idle_timeout is not None and time.monotonic()-last_new_file > idle_timeout:
+                break
+            time.sleep(poll_interval)
+        return nreduced
+
+    def processDocuments(self,documents,image_field,md_fields=None):
+        '''
+        Reduce frames from a Bluesky-style stream of (name, document) pairs, e.g. a RunRouter callback feed or
+        a replayed run's documents().
+
+        Each 'event' document contributes one frame, read from doc['data'][image_field].  Its coordinates come from
+        doc['data'] and, as a fallback, the run start document.
+
+        Args:
+            documents (iterable of (str, dict)): Bluesky (name, doc) pairs
+            image_field (str): data key holding the detector image
+            md_fields (dict or None): map of dim name -> data key, for dims whose data key differs from the dim name
+
+        Returns:
+            number of frames reduced
+        '''
+        if md_fields is None:
+            md_fields = {}
+        start = {}
+        nreduced = 0
+        for name,doc in documents:
+            if name == 'start':
+                start = doc
+            elif name == 'event':
+                attrs = dict(start)
+                attrs.update({k:v for k,v in doc['data'].items() if k != image_field})
+                for dim,key in md_fields.items():
+                    attrs[dim] = attrs[key]
+                image = np.asarray(doc['data'][image_field])
+                img = xr.DataArray(image,dims=['pix_y','pix_x'],
+                                   coords={'pix_y':np.arange(image.shape[0]),'pix_x':np.arange(image.shape[1])},
+                                   attrs={k:v for k,v in attrs.items() if k in self.dims or np.isscalar(v)})
+                self.processFrame(img)
+                nreduced += 1
+            elif name == 'stop':
+                break
+        return nreduced
+
+    def result(self):
+        '''
+        the reduced cube written so far, as an in-memory DataArray
+        '''
+        if self._file is not None:
+            self._file.flush()
+        return loadStreamedReduction(self.output_file)
+
+
+def loadStreamedReduction(filename,var='I'):
+    '''
+    Read a cube written by StreamingReducer.  Safe to call while the writer is still appending.
+
+    Args:
+        filename (str or Path): HDF5 file written by StreamingReducer
+        var (str, default 'I'): reduced variable to read ('I', or 'dI' if the integrator returned sigma)
+
+    Returns:
+        DataArray with a 'system' MultiIndex over the recorded dims followed by the frame dims (chi, q)
+    '''
+    with h5py.File(filename,'r',libver='latest',swmr=True) as f:
+        ds = f['reduced'][var]
+        ds.refresh()
+        nframes = ds.shape[0]
+        values = ds[:nframes]
+        frame_dims = [str(d) for d in ds.attrs['frame_dims']]
+        dims = [str(d) for d in f.attrs['dims']]
+        coord_vals = []
+        for dim in dims:
+            ds = f['coords'][dim]
+            ds.refresh()
+            if h5py.check_string_dtype(ds.dtype) is not None:
+                vals = ds.asstr()[:nframes]
+            else:
+                vals = ds[:nframes]
+            coord_vals.append(vals)
+        coords = {axis:f[axis][()] for axis in frame_dims}
+    index = pd.MultiIndex.from_arrays(coord_vals,names=dims)
+    out = xr.DataArray(values,dims=['system']+frame_dims,coords=coords)
+    return out.assign_coords(xr.Coordinates.from_pandas_multiindex(index,'system'))
@@ -11,6 +11,8 @@ import datetime
 import time
 import h5py
 import skimage
+import scipy.sparse
+from PyHyperScattering.PFGeneralIntegrator import engine_cache
 try:
     import cupy as cp
     import cupyx.scipy.ndimage as ndigpu
@@ -24,16 +26,118 @@ except ImportError:
     warnings.warn('Failed to import Dask, if Dask reduction is desired install pyhyperscattering[performance]',stacklevel=2)
 
 
+class PolarRemapEngine():
+    '''
+    The bilinear interpolation table behind skimage.transform.warp_polar for one frame shape, center and output
+    shape, stored as a sparse matrix so a whole stack of frames can be remapped with one sparse-dense product.
+
+    Each output pixel has (up to) four input pixels and weights; neighbours that fall outside the frame are dropped,
+    which matches warp_polar's mode='constant', cval=0.
+    '''
+    def __init__(self,shape,center,radius=None,output_shape=None,radii=None):
+        '''
+        Args:
+            shape (tuple): (row, col) shape of a single frame
+            center (tuple): (row, col) position of the origin, may be fractional
+            radius (float or None): radius of the remapped circle in pixels; defaults to the frame half-diagonal
+            output_shape (tuple or None): (angle, radius) bins; defaults to (360, ceil(radius)) as in warp_polar
+            radii (array-like or None): explicit pixel radius of each output column, e.g. log-spaced or cut off
+                                        below the frame edge.  Overrides radius and the radial size of output_shape.
+        '''
+        self.shape = tuple(shape)
+        self.center = tuple(center)
+        if radius is None:
+            radius = np.sqrt((self.shape[0]/2)**2 + (self.shape[1]/2)**2)
+        if output_shape is None:
+            output_shape = (360,int(np.ceil(radius)))
+        if radii is not None:
+            radii = np.asarray(radii,dtype=float)
+            radius = radii.max()
+            output_shape = (output_shape[0],len(radii))
+        self.radius = radius
+        self.output_shape = tuple(int(n) for n in output_shape)
+
+        angle = np.arange(self.output_shape[0])*(2*np.pi/self.output_shape[0])
+        if radii is None:
+            r = np.arange(self.output_shape[1])*(radius/self.output_shape[1])
+        else:
+            r = radii
+        rows = (r[np.newaxis,:]*np.sin(angle)[:,np.newaxis] + self.center[0]).ravel()
+        cols = (r[np.newaxis,:]*np.cos(angle)[:,np.newaxis] + self.center[1]).ravel()
+        row0 = np.floor(rows).astype(np.int64)
+        col0 = np.floor(cols).astype(np.int64)
+        frac_row = rows - row0
+        frac_col = cols - col0
+        out_index = np.arange(rows.size)
+
+        matrix_rows,matrix_cols,weights = [],[],[]
+        for drow,wrow in ((0,1-frac_row),(1,frac_row)):
+            for dcol,wcol in ((0,1-frac_col),(1,frac_col)):
+                nrow = row0+drow
+                ncol = col0+dcol
+                weight = wrow*wcol
+                keep = (nrow>=0) & (nrow<self.shape[0]) & (ncol>=0) & (ncol<self.shape[1]) & (weight>0)
+                matrix_rows.append(out_index[keep])
+                matrix_cols.append(nrow[keep]*self.shape[1]+ncol[keep])
+                weights.append(weight[keep])
+        self.matrix = scipy.sparse.csr_matrix((np.concatenate(weights),(np.concatenate(matrix_rows),np.concatenate(matrix_cols))),
+                                              shape=(rows.size,self.shape[0]*self.shape[1]))
+
+    def remap(self,frames):
+        '''
+        Remap a frame or a stack of frames to polar coordinates.
+
+        Args:
+            frames (array-like): (..., row, col) intensities
+
+        Integer frames are first scaled by skimage.util.img_as_float, as warp_polar does.
+
+        Returns:
+            ndarray of shape (..., angle, radius), float32 for float32 input and float64 otherwise
+        '''
+        frames = skimage.util.img_as_float(np.asarray(frames))
+        dtype = np.float32 if frames.dtype == np.float32 else np.float64
+        lead_shape = frames.shape[:-2]
+        flat = frames.reshape(-1,self.shape[0]*self.shape[1])
+        result = (self.matrix @ flat.T).T
+        return np.ascontiguousarray(result,dtype=dtype).reshape(lead_shape+self.output_shape)
+
+    @property
+    def nbytes(self):
+        return self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes
+
+
+def cachedPolarRemapEngine(shape,center,radius=None,output_shape=None,radii=None):
+    '''
+    return a PolarRemapEngine for this geometry from the process-wide engine_cache, creating it on first use
+    '''
+    center = tuple(float(f'{float(c):.12g}') for c in center)
+    radii_key = None if radii is None else tuple(float(f'{float(r):.12g}') for r in radii)
+    key = ('polar',tuple(shape),center,radius,None if output_shape is None else tuple(output_shape),radii_key)
+    return engine_cache.get(key,lambda: PolarRemapEngine(shape,center,radius=radius,output_shape=output_shape,radii=radii))
+
+
 class WPIntegrator():
     '''
     Integrator for qx/qy format xarrays using skimage.transform.warp_polar or a custom cuda-accelerated version, warp_polar_gpu
     '''
     
-    def __init__(self,return_cupy=False,force_np_backend=False,use_chunked_processing=False):
+    def __init__(self,return_cupy=False,force_np_backend=False,use_chunked_processing=False,npts_chi=360,npts_q=None,
+                 q_max=None,q_min=None,log_q=False):
         '''
         Args:
             return_cupy (bool, default False): return arrays as cupy rather than numpy, for further GPU processing
             force_np_backend (bool, default False): if true, use numpy backend regardless of whether CuPy is available. 
+            npts_chi (int, default 360): number of chi bins over the full circle
+            npts_q (int or None): number of q bins; default is one per pixel of radius out to q_max
+            q_max (float or None): largest q to remap to, in the units of qx/qy; default is the corner of the image
+            q_min (float or None): smallest q for log-spaced bins; default is one pixel.  Ignored for linear bins,
+                                   which always start at 0.
+            log_q (bool, default False): space the q bins logarithmically between q_min and q_max
+
+        With all of npts_q, q_max and log_q left at their defaults, the q bins are the same as
+        skimage.transform.warp_polar's.  Otherwise the pixel radius of each q bin is computed from the qx spacing
+        (square pixels are assumed) and built into the remap table, so pixels beyond q_max are never touched.
         '''
         if MACHINE_HAS_CUDA and not force_np_backend:
             self.MACHINE_HAS_CUDA = True
@@ -42,8 +146,13 @@ class WPIntegrator():
             
         self.return_cupy = return_cupy
         self.use_chunked_processing=use_chunked_processing
+        self.npts_chi = npts_chi
+        self.npts_q = npts_q
+        self.q_max = q_max
+        self.q_min = q_min
+        self.log_q = log_q
     
-    def warp_polar_gpu(self,image, center=None, radius=None, output_shape=None, **kwargs):
+    def warp_polar_gpu(self,image, center=None, radius=None, output_shape=None, radii=None, **kwargs):
         """
         Function to emulate warp_polar in skimage.transform on the GPU. Not all
         parameters are supported
@@ -59,6 +168,8 @@ class WPIntegrator():
         radius: float, optional
             Radius of the circle that bounds the area to be transformed.
         output_shape: tuple (row, col), optional
+        radii: array-like, optional
+            Explicit pixel radius of each output column; overrides radius and output_shape[1].
 
         Returns
         -------
@@ -74,12 +185,14 @@ class WPIntegrator():
         if output_shape is None:
             output_shape = (360, radius)
         delta_theta = 360 / output_shape[0]
-        delta_r = radius / output_shape[1]
         t = cp.arange(output_shape[0])
-        r = cp.arange(output_shape[1])
+        if radii is None:
+            r = cp.arange(output_shape[1]) * (radius / output_shape[1])
+        else:
+            r = cp.asarray(radii)
         R, T = cp.meshgrid(r, t)
-        X = R * delta_r * cp.cos(cp.deg2rad(T * delta_theta)) + cx
-        Y = R * delta_r * cp.sin(cp.deg2rad(T * delta_theta)) + cy
+        X = R * cp.cos(cp.deg2rad(T * delta_theta)) + cx
+        Y = R * cp.sin(cp.deg2rad(T * delta_theta)) + cy
         coordinates = cp.stack([Y, X])
         polar = ndigpu.map_coordinates(image, coordinates, order=1)
         if not self.return_cupy:
@@ -88,19 +201,46 @@ class WPIntegrator():
             retval = polar
         return retval
     
+    def beamCenter(self,img):
+        '''
+        fractional (qx, qy) pixel indices of q=0, i.e. the (row, col) center of the polar remap
+        '''
+        center_x = np.interp(0,img.qx.values,np.arange(len(img.qx)))
+        center_y = np.interp(0,img.qy.values,np.arange(len(img.qy)))
+        return float(center_x),float(center_y)
+
+    def polarGeometry(self,img):
+        '''
+        bins of the polar remap for images on img's qx/qy axes
+
+        Returns:
+            (output_shape, radii, chi, q): radii is the pixel radius of each q bin, or None for warp_polar's
+            default radial sampling
+        '''
+        corner_q = np.sqrt(np.amax(img.qx.values**2)+np.amax(img.qy.values**2))
+        # warp_polar maps to 0-360 instead of -180-180
+        chi_step = 360/self.npts_chi
+        chi = -180 + chi_step/2 + chi_step*np.arange(self.npts_chi)
+        if self.npts_q is None and self.q_max is None and not self.log_q:
+            radius = np.sqrt((len(img.qx)/2)**2 + (len(img.qy)/2)**2)
+            output_shape = (self.npts_chi,int(np.ceil(radius)))
+            return output_shape,None,chi,np.linspace(0,corner_q,output_shape[1])
+
+        q_per_pixel = float(np.abs(np.diff(img.qx.values)).mean())
+        q_max = corner_q if self.q_max is None else self.q_max
+        npts_q = self.npts_q if self.npts_q is not None else int(np.ceil(q_max/q_per_pixel))
+        if self.log_q:
+            q_min = q_per_pixel if self.q_min is None else self.q_min
+            if not 0 < q_min < q_max:
+                raise ValueError(f'log-spaced q needs 0 < q_min < q_max, got q_min={q_min}, q_max={q_max}')
+            q = np.geomspace(q_min,q_max,npts_q)
+        else:
+            q = np.linspace(0,q_max,npts_q)
+        return (self.npts_chi,npts_q),q/q_per_pixel,chi,q
+
     def integrateSingleImage(self,img):
         img_to_integ = img.values.squeeze()
- 
-        center_x = float(xr.DataArray(np.linspace(0,len(img.qx)-1,len(img.qx)))
-                    .assign_coords({'dim_0':img.qx.values})
-                    .rename({'dim_0':'qx'})
-                    .interp(qx=0)
-                    .data)
-        center_y = float(xr.DataArray(np.linspace(0,len(img.qy)-1,len(img.qy)))
-                    .assign_coords({'dim_0':img.qy.values})
-                    .rename({'dim_0':'qy'})
-                    .interp(qy=0)
-                    .data)        
+        center_x,center_y = self.beamCenter(img)
         try:
             stacked_axis = list(img.coords)
             stacked_axis.remove('qx')
@@ -111,20 +251,11 @@ class WPIntegrator():
         except AttributeError:
             pass
         
+        output_shape,radii,chi,q = self.polarGeometry(img)
         if self.MACHINE_HAS_CUDA:
-            TwoD = self.warp_polar_gpu(img_to_integ,center=(center_x,center_y))
+            TwoD = self.warp_polar_gpu(img_to_integ,center=(center_x,center_y),output_shape=output_shape,radii=radii)
         else:
-            TwoD = skimage.transform.warp_polar(img_to_integ,center=(center_x,center_y))
-
-        
-        qx = img.qx
-        qy = img.qy
-        q = np.sqrt(qy**2+qx**2)
-        q = np.linspace(0,np.amax(q), TwoD.shape[1])
-
-        # warp_polar maps to 0-360 instead of -180-180
-        chi = np.linspace(-179.5,179.5,360)
-        # chi = np.linspace(0.5,359.5,360)
+            TwoD = cachedPolarRemapEngine(img_to_integ.shape,(center_x,center_y),output_shape=output_shape,radii=radii).remap(img_to_integ)
         
         try:
             return xr.DataArray([TwoD],dims=[stacked_axis,'chi','q'],coords={'q':q,'chi':chi,stacked_axis:system_to_integ},attrs=img.attrs)
@@ -134,18 +265,50 @@ class WPIntegrator():
 
     def integrateImageStack(self,img_stack,method=None,chunksize=None):
         '''
-        
+        Integrate a stack of qx/qy images.
+
+        Args:
+            img_stack (DataArray): images with qx and qy dims plus any number of other (e.g. energy) dims
+            method (str or None): 'legacy' integrates one image at a time (on the GPU if available), 'batched'
+                                  remaps the whole stack at once on the CPU and 'dask' does one or the other
+                                  lazily, chunk by chunk ('batched' on the CPU).  Default is 'dask' if
+                                  use_chunked_processing, otherwise 'legacy'.  All give the same values:
+                                  like warp_polar, integer images are scaled to floats by skimage's img_as_float.
+            chunksize (int or None): images per chunk for the dask method
         '''
         if (self.use_chunked_processing and method is None) or method=='dask':
             func_args = {}
             if chunksize is not None:
                 func_args['chunksize'] = chunksize
             return self.integrateImageStack_dask(img_stack,**func_args)
+        elif method == 'batched':
+            return self.integrateImageStack_batched(img_stack)
         elif (method is None) or method == 'legacy':
             return self.integrateImageStack_legacy(img_stack)
         else:
             raise NotImplementedError(f'unsupported integration method {method}')
 
+    def integrateImageStack_batched(self,data):
+        '''
+        Remap every qx/qy image in data with one PolarRemapEngine, built (or fetched from the engine cache) once for
+        the whole stack.  Works on numpy or Dask-backed data; Dask data stays lazy and is remapped chunk by chunk.
+
+        Returns:
+            DataArray with the non-qx/qy dims of data, followed by chi and q
+        '''
+        center = self.beamCenter(data)
+        output_shape,radii,chi,q = self.polarGeometry(data)
+        engine = cachedPolarRemapEngine((len(data.qx),len(data.qy)),center,output_shape=output_shape,radii=radii)
+        if data.chunks is not None:
+            data = data.chunk({'qx':-1,'qy':-1})
+        dtype = np.float32 if data.dtype == np.float32 else np.float64
+        reduced = xr.apply_ufunc(engine.remap,data,
+                                 input_core_dims=[['qx','qy']],output_core_dims=[['chi','q']],
+                                 dask='parallelized',output_dtypes=[dtype],
+                                 dask_gufunc_kwargs={'output_sizes':{'chi':len(chi),'q':len(q)}},
+                                 keep_attrs=True)
+        return reduced.assign_coords({'chi':chi,'q':q})
+
     def integrateImageStack_legacy(self,data):
         #int_stack = img_stack.groupby('system').map(self.integrateSingleImage)   
         #return int_stack
@@ -176,6 +339,15 @@ class WPIntegrator():
     
     
     def integrateImageStack_dask(self,data,chunksize=5):
+        '''
+        Lazily integrate a stack, chunksize images at a time: with the batched remap on the CPU (same values as the
+        per-image path) or image by image on the GPU.
+        '''
+        if not self.MACHINE_HAS_CUDA:
+            stacked_dims = [dim for dim in data.dims if dim not in ('qx','qy')]
+            if len(stacked_dims) > 0:
+                data = data.chunk({stacked_dims[0]:chunksize})
+            return self.integrateImageStack_batched(data.chunk({'qx':-1,'qy':-1}))
         #int_stack = img_stack.groupby('system').map(self.integrateSingleImage)   
         #return int_stack
         indexes = list(data.indexes.keys())
@@ -215,14 +387,15 @@ class WPIntegrator():
             order_list.append(idx)
             coord_dict[idx] = data.indexes[idx]
             shape = shape + tuple([len(data.indexes[idx])])
-        shape = shape + (360,npts_q)
+        shape = shape + (len(demo_integration.chi),npts_q)
         print(shape)
         
         desired_order_list = order_list+['chi','q']
         coord_dict_sorted = {k: coord_dict[k] for k in desired_order_list}
         
-        template = xr.DataArray(np.empty(shape),coords=coord_dict_sorted)  
-        template = template.chunk({indexes[0]:chunksize})
+        # the template only describes the output, so keep it lazy rather than allocating the full cube
+        chunks = tuple(chunksize if dim == indexes[0] else -1 for dim in desired_order_list)
+        template = xr.DataArray(da.empty(shape,dtype=demo_integration.dtype,chunks=chunks),coords=coord_dict_sorted)
         integ_fly = data.map_blocks(self.integrateImageStack_legacy,template=template)#integ_traditional.chunk({'energy':5}))
         return integ_fly 
             
\ No newline at end of file
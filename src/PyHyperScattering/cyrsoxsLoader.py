@@ -9,12 +9,28 @@ import datetime
 import time
 import h5py
 import pathlib
+import concurrent.futures
+from PyHyperScattering.FileIO import HDF5Source
 try:
     import dask.array as da
     import dask
 except ImportError:
     warnings.warn('Failed to import Dask, if Dask reduction desired install pyhyperscattering[performance]',stacklevel=2)
 
+def _parse_param(value):
+    '''
+    convert a sweep parameter parsed from a directory name to int or float, if it is one.  None, from an optional group
+    that did not match, is kept as is.
+    '''
+    if value is None:
+        return value
+    for kind in (int,float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
 class cyrsoxsLoader():
     '''
     Loader for cyrsoxs simulation files
@@ -73,6 +89,81 @@ class cyrsoxsLoader():
         else:
             raise NotImplementedError('unsupported method {method}, expected "dask" or "legacy"')
             
+    def loadSweep(self,basedir,dir_regex,output_dir='HDF5',PhysSize=None,workers=8,integrator=None,method=None):
+        '''
+        Loads a parameter sweep of CyRSoXS simulations, one per subdirectory, into a single Dask-backed xarray.
+
+        Subdirectories of basedir whose names match dir_regex are loaded.  Sweep parameters come from the regex groups:
+        named groups become dims of the same name, and a single unnamed group becomes a dim called 'param'.  Values are
+        converted to int or float where possible, and an optional group that matches none of the directories is dropped.
+        For example, dir_regex='sim_r(?P<radius>[0-9.]+)_s(?P<spacing>[0-9.]+)'
+        gives dims (radius, spacing, energy, qx, qy).  If the parameters do not form a complete grid they are kept as
+        one 'sweep' MultiIndex dim instead.
+
+        Configs and file layouts are read in parallel threads.  Pixel data is not read here, but on compute (or by the
+        integrator).
+
+        Args:
+            basedir (string or Path): directory holding the simulation directories
+            dir_regex (str): regex that simulation directory names must match, with groups for the sweep parameters
+            output_dir (string or Path, default HDF5): directory relative to each simulation to look for hdf5 files in
+            PhysSize (float or None): physical voxel size, passed to loadDirectoryDask
+            workers (int, default 8): number of threads reading simulation configs
+            integrator (WPIntegrator or None): if provided, the whole sweep is reduced with one
+                                               integrator.integrateImageStack call and the (param..., energy, chi, q)
+                                               result is returned instead
+            method (str or None): integration method passed to integrator.integrateImageStack; default 'dask', which
+                                  keeps the reduced sweep lazy
+
+        Returns:
+            xarray with dims (param..., energy, qx, qy), or (param..., energy, chi, q) if integrator is given
+        '''
+        basedir = pathlib.Path(basedir)
+        regex = re.compile(dir_regex)
+        matches = [(d,regex.match(d.name)) for d in sorted(basedir.iterdir()) if d.is_dir()]
+        matches = [(d,m) for d,m in matches if m is not None]
+        if len(matches) == 0:
+            raise ValueError(f'No simulation directories in {basedir} match {dir_regex}.')
+        if len(regex.groupindex) > 0:
+            param_names = list(regex.groupindex.keys())
+            param_vals = [[_parse_param(m.group(name)) for name in param_names] for d,m in matches]
+        elif regex.groups == 1:
+            param_names = ['param']
+            param_vals = [[_parse_param(m.group(1))] for d,m in matches]
+        else:
+            raise ValueError(f'dir_regex needs named groups, or exactly one group, to label the sweep; {dir_regex} has {regex.groups} unnamed groups.')
+        # an optional group that never matched labels nothing, so drop it rather than index on None
+        keep = [i for i in range(len(param_names)) if any(vals[i] is not None for vals in param_vals)]
+        if 0 < len(keep) < len(param_names):
+            param_names = [param_names[i] for i in keep]
+            param_vals = [[vals[i] for i in keep] for vals in param_vals]
+
+        def load(directory):
+            return self.loadDirectoryDask(directory,output_dir=output_dir,PhysSize=PhysSize)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            sims = list(pool.map(load,[d for d,m in matches]))
+
+        first = sims[0]
+        for (directory,m),sim in zip(matches,sims):
+            if sim.shape != first.shape or not np.allclose(sim.energy,first.energy) or not np.allclose(sim.qx,first.qx):
+                raise ValueError(f'Simulation {directory} has different energies, size or PhysSize than {matches[0][0]}; cannot stack the sweep.')
+
+        frame_dims = ('energy','qx','qy')
+        out = xr.concat(sims,dim='sweep',coords='minimal',compat='override',combine_attrs='override')
+        index = pd.MultiIndex.from_tuples([tuple(v) for v in param_vals],names=param_names)
+        if len(param_names) == 1:
+            out = out.rename({'sweep':param_names[0]}).assign_coords({param_names[0]:index.get_level_values(0).values})
+        else:
+            out = out.assign_coords(xr.Coordinates.from_pandas_multiindex(index,'sweep'))
+            if np.prod([len(level) for level in index.levels]) == len(index):
+                out = out.unstack('sweep')
+        if integrator is not None:
+            # the whole sweep is reduced in one call; the integrator treats the sweep dims like any other stacked dim
+            out = integrator.integrateImageStack(out,method='dask' if method is None else method)
+            frame_dims = ('energy','chi','q')
+        return out.transpose(*[dim for dim in out.dims if dim not in frame_dims],*frame_dims)
+
     def loadDirectoryDask(self,directory,output_dir='HDF5',morphology_file=None, PhysSize=None):
         '''
         Loads a CyRSoXS simulation output directory into a Dask-backed qx/qy xarray.
@@ -134,29 +225,26 @@ class cyrsoxsLoader():
         hd5files = [f'Energy_{e:0.2f}.h5' for e in elist]
 
         outlist = []
-        filehandles = []
         for i, e in enumerate(elist):
             if self.eager_load:
-                while not (directory/'HDF5'/hd5files[i]).is_dir():
+                while not (directory/output_dir/hd5files[i]).is_dir():
                     time.sleep(0.5)
-            
-            h5 = h5py.File(directory/'HDF5'/hd5files[i],'r')
-            filehandles.append(h5)
 
-            try:
-                img = da.from_array(h5['K0']['projection'])
-            except KeyError:
-                img = da.from_array(h5['projection'])
+            # no handle is kept open: each Dask chunk opens its file only while it is read, so the array pickles to
+            # distributed workers and does not leak handles in long sessions
+            with h5py.File(directory/output_dir/hd5files[i],'r') as h5:
+                projection_path = 'K0/projection' if 'K0' in h5 else 'projection'
+            source = HDF5Source(directory/output_dir/hd5files[i],projection_path)
+            img = da.from_array(source,chunks=source.shape,
+                                name='cyrsoxs-'+dask.base.tokenize(source.filename,source.path,os.path.getmtime(source.filename)))
             if i==0:
                 NumY, NumX = img.shape
-                img = da.rechunk(img,chunks=(None,None))
                 Qx = 2.0*np.pi*np.fft.fftshift(np.fft.fftfreq(NumX,d=PhysSize))
                 Qy = 2.0*np.pi*np.fft.fftshift(np.fft.fftfreq(NumY,d=PhysSize))
                 
             outlist.append(img)
         data = da.stack(outlist,axis=2)
 
-        config['filehandles'] = filehandles
         if self.profile_time: 
              print(f'Finished reading ' + str(num_energies) + ' energies. Time required: ' + str(datetime.datetime.now()-start))
         # index = pd.MultiIndex.from_arrays([elist],names=['energy'])
@@ -164,13 +252,14 @@ class cyrsoxsLoader():
         return xr.DataArray(data, dims=("qx", "qy","energy"), coords={ "qx":Qx, "qy":Qy, "energy":elist},attrs=config)
         
 
-    def loadDirectoryLegacy(self,directory,output_dir='HDF5',morphology_file=None, PhysSize=None):
+    def loadDirectoryLegacy(self,directory,output_dir='HDF5',morphology_file=None, PhysSize=None, workers=4):
         '''
         Loads a CyRSoXS simulation output directory into a qx/qy xarray.
         
         Args:
             directory  (string or Path): root simulation directory
             output_dir (string or Path, default /HDF5): directory relative to the base to look for hdf5 files in.
+            workers (int, default 4): number of threads reading energy files
         '''
         if self.profile_time:
             start = datetime.datetime.now()
@@ -224,35 +313,35 @@ class cyrsoxsLoader():
         #Synthesize list of filenames; note this is not using glob to see what files are there so you are at the mercy of config.txt
         hd5files = [f'Energy_{e:0.2f}.h5' for e in elist]
 
-        for i, e in enumerate(elist):
-            if self.eager_load:
-                while not (directory/'HDF5'/hd5files[i]).is_dir():
-                    time.sleep(0.5)
-                    
-            if i==0:
-                with h5py.File(directory/'HDF5'/hd5files[i],'r') as h5:
-                    try:
-                        img = h5['K0']['projection'][()]
-                    except KeyError:
-                        img = h5['projection'][()]
-                    NumY, NumX = img.shape
-                Qx = 2.0*np.pi*np.fft.fftshift(np.fft.fftfreq(NumX,d=PhysSize))
-                Qy = 2.0*np.pi*np.fft.fftshift(np.fft.fftfreq(NumY,d=PhysSize))
-                data = np.zeros([NumX*NumY*num_energies])
-                
-            else:
-                with h5py.File(directory/'HDF5'/hd5files[i],'r') as h5:
-                    try:
-                        img = h5['K0']['projection'][()]
-                    except KeyError:
-                        img = h5['projection'][()]
-                #remeshed = warp_polar_gpu(img)
+        def projection(h5):
+            try:
+                return h5['K0']['projection']
+            except KeyError:
+                return h5['projection']
 
+        if self.eager_load:
+            while not (directory/output_dir/hd5files[0]).is_dir():
+                time.sleep(0.5)
+        with h5py.File(directory/output_dir/hd5files[0],'r') as h5:
+            NumY, NumX = projection(h5).shape
+            dtype = projection(h5).dtype
+        Qx = 2.0*np.pi*np.fft.fftshift(np.fft.fftfreq(NumX,d=PhysSize))
+        Qy = 2.0*np.pi*np.fft.fftshift(np.fft.fftfreq(NumY,d=PhysSize))
 
+        # each energy is read straight into its slot of one buffer, in the files' own dtype
+        data = np.empty((num_energies,NumY,NumX),dtype=dtype)
 
-            data[i*NumX*NumY:(i+1)*NumX*NumY] = img[:,:].reshape(-1, order='C')
+        def read_energy(i):
+            if self.eager_load:
+                while not (directory/output_dir/hd5files[i]).is_dir():
+                    time.sleep(0.5)
+            with h5py.File(directory/output_dir/hd5files[i],'r') as h5:
+                projection(h5).read_direct(data,dest_sel=np.s_[i])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(read_energy,range(num_energies)))
 
-        data = np.moveaxis(data.reshape(-1, NumY, NumX, order ='C'),0,-1)
+        data = np.moveaxis(data,0,-1)
 
         if self.profile_time: 
              print(f'Finished reading ' + str(num_energies) + ' energies. Time required: ' + str(datetime.datetime.now()-start))
@@ -260,73 +349,4 @@ class cyrsoxsLoader():
         # index.name = 'system'
         return xr.DataArray(data, dims=("qx", "qy","energy"), coords={ "qx":Qx, "qy":Qy, "energy":elist},attrs=config)
         
-        #bar = xr.DataArray(data_remeshed, dims=("chi", "q", "energy"), coords={"chi":output_chi, "q":output_q, "energy":elist})        
-'''
-    @TODO: support larger axes based on regex of dir names - this should be implemented at the fileloader level, I think, personally.
-    def datacubes_params(maindir, prefix, params):
-        start = datetime.datetime.now()
-
-        numparams = len(params)
-
-        for j, p in enumerate(params):
-        #    foo, bar = cyrsoxs_datacubes(maindir+prefix+str(p))
-            mydir = maindir+prefix+str(p).zfill(4)
-            if j ==0:
-                #need to get all that info from config.txt including elist
-                while not os.path.isfile(mydir + '/config.txt'):
-                    time.sleep(0.5)
-                config = read_config(mydir + '/config.txt')
-
-                while not os.path.isdir(mydir + '/HDF5'):
-                    time.sleep(0.5)
-                #os.chdir(mydir +'/HDF5')
-
-                elist = config['Energies']
-                num_energies = len(elist)
-                PhysSize = float(config['PhysSize'])
-                NumX = int(config['NumX'])
-                NumY = int(config['NumY'])
-
-                #Synthesize list of filenames; note this is not using glob to see what files are there so you are at the mercy of config.txt
-                hd5files = ["{:0.2f}".format(e) for e in elist]
-                hd5files = np.core.defchararray.add("Energy_", hd5files)
-                hd5files = np.core.defchararray.add(hd5files, ".h5")
-            else:
-                while not os.path.isdir(mydir + '/HDF5'):
-                    time.sleep(0.5)
-                #os.chdir(mydir +'/HDF5')
-
-            estart = datetime.datetime.now()
-            for i, e in enumerate(elist):
-                while not os.path.isfile(mydir + '/HDF5/' + hd5files[i]):
-                    time.sleep(0.5)
-                with h5py.File(hd5files[i],'r') as h5:
-                    img = h5['projection'][()]
-                    remeshed = warp_polar_gpu(img)
-                if (j==0) and (i==0):
-                    #create all this only once
-                    Qx = 2.0*np.pi*np.fft.fftshift(np.fft.fftfreq(img.shape[1],d=PhysSize))
-                    Qy = 2.0*np.pi*np.fft.fftshift(np.fft.fftfreq(img.shape[0],d=PhysSize))
-                    q = np.sqrt(Qy**2+Qx**2)
-                    output_chi = np.linspace(0,360,360)
-                    lenchi = len(output_chi)
-                    output_q = np.linspace(0,np.amax(q), remeshed.shape[1])
-                    lenq = len(output_q)
-                    data = np.zeros([NumX*NumY*num_energies*numparams])
-                    data_remeshed = np.zeros([len(output_chi)*len(output_q)*num_energies*numparams])
-
-                data[j*num_energies*NumX*NumY + i*NumX*NumY:j*num_energies*NumX*NumY +(i+1)*NumX*NumY] = img[:,:].reshape(-1, order='C')
-                data_remeshed[j*num_energies*lenchi*lenq + i*lenchi*lenq:j*num_energies*lenchi*lenq +(i+1)*lenchi*lenq] = remeshed[:,:].reshape(-1, order='C')
-            print(f'Finished reading ' + str(num_energies) + ' energies. Time required: ' + str(datetime.datetime.now()-estart))
-        data = data.reshape(numparams*num_energies, NumY, NumX, order ='C')
-        data = data.reshape(numparams, num_energies, NumY, NumX, order ='C')
-        data_remeshed = data_remeshed.reshape(numparams*num_energies,lenchi, lenq, order ='C')
-        data_remeshed = data_remeshed.reshape(numparams, num_energies,lenchi, lenq, order ='C')
-
-        lfoo = xr.DataArray(data, dims=("param","energy", "Qy", "Qx"), coords={"energy":elist, "param":params, "Qy":Qy, "Qx":Qx})
-        lbar = xr.DataArray(data_remeshed, dims=("param", "energy", "chi", "q"), coords={"chi":output_chi, "q":output_q, "energy":elist, "param":params})
-
-        print(f'Finished reading ' + str(numparams) + ' parameters. Time required: ' + str(datetime.datetime.now()-start))
-
-        return lfoo, lbar
-'''
+        #bar = xr.DataArray(data_remeshed, dims=("chi", "q", "energy"), coords={"chi":output_chi, "q":output_q, "energy":elist})
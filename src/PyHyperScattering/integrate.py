@@ -1,3 +1,4 @@
 from PyHyperScattering.PFEnergySeriesIntegrator import PFEnergySeriesIntegrator
 from PyHyperScattering.PFGeneralIntegrator import PFGeneralIntegrator
-from PyHyperScattering.WPIntegrator import WPIntegrator
\ No newline at end of file
+from PyHyperScattering.WPIntegrator import WPIntegrator
+from PyHyperScattering.StreamingReducer import StreamingReducer, loadStreamedReduction
\ No newline at end of file
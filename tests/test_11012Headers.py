@@ -0,0 +1,58 @@
+import sys
+sys.path.append("src/")
+
+from PyHyperScattering.load import ALS11012RSoXSLoader
+
+from astropy.io import fits
+from astropy.io.fits.hdu.image import _ImageBaseHDU
+import numpy as np
+import pytest
+
+
+def write_fits(path,energy,shutter_inhibit=0,exposure=1.0,data=None):
+    if data is None:
+        data = np.full((8,9),energy,dtype=np.float32)
+    header = fits.Header({'EXPOSURE':exposure,'Beamline Energy':energy,'EPU Polarization':100,'Sample X':0,'Sample Y':0,
+                          'Sample Z':0,'Sample Theta':0,'Sample Number':1,'CCD X':0,'CCD Y':0,'CCD Theta':0,
+                          'CCD Shutter Inhibit':shutter_inhibit})
+    fits.HDUList([fits.PrimaryHDU(header=header),fits.ImageHDU(),
+                  fits.ImageHDU(data)]).writeto(path)
+
+@pytest.fixture()
+def ccd_dir(tmp_path):
+    for n,energy in enumerate([280.,282.,284.]):
+        write_fits(tmp_path/f'scan-{n:05d}.fits',energy)
+    write_fits(tmp_path/'scan-00003.fits',280.,shutter_inhibit=1,exposure=1.0)
+    return tmp_path
+
+def test_peek_reads_only_the_header(ccd_dir,monkeypatch):
+    loader = ALS11012RSoXSLoader(corr_mode='none')
+    # any pixel access, through fits.getdata or an HDU's .data, fails the test
+    read_pixels = lambda *args,**kwargs: pytest.fail('peekAtMd read pixel data')
+    monkeypatch.setattr(fits,'getdata',read_pixels)
+    monkeypatch.setattr(_ImageBaseHDU,'data',property(read_pixels))
+    md = loader.peekAtMd(str(ccd_dir/'scan-00001.fits'))
+    assert md['energy'] == 282.
+
+def test_md_filter_never_reads_rejected_pixels(ccd_dir,monkeypatch):
+    loader = ALS11012RSoXSLoader(corr_mode='none')
+    loaded = []
+    load = loader.loadSingleImage
+    monkeypatch.setattr(loader,'loadSingleImage',lambda filepath,**kwargs: loaded.append(filepath.name) or load(filepath,**kwargs))
+    out = loader.loadFileSeries(ccd_dir,['energy'],md_filter={'CCD Shutter Inhibit':0})
+    assert len(out.system) == 3
+    assert 'scan-00003.fits' not in loaded
+
+def test_sample_specific_darks_load_only_darks(ccd_dir):
+    loader = ALS11012RSoXSLoader(corr_mode='none')
+    loader.loadSampleSpecificDarks(str(ccd_dir),md_filter={'sampleid':1})
+    assert list(loader.darks.keys()) == [1.0]
+    assert np.all(loader.darks[1.0] == 280.)
+
+def test_sliced_load_matches_full_load(ccd_dir):
+    loader = ALS11012RSoXSLoader(corr_mode='none')
+    write_fits(ccd_dir/'ramp.fits',280.,data=np.arange(8*9,dtype=np.float32).reshape(8,9))
+    full = loader.loadSingleImage(ccd_dir/'ramp.fits')
+    roi = (slice(2,6),slice(1,None,2))
+    sliced = loader.loadSingleImage(ccd_dir/'ramp.fits',image_slice=roi)
+    assert np.array_equal(sliced.values,full.values[roi])
@@ -0,0 +1,77 @@
+import sys
+sys.path.append("src/")
+
+from PyHyperScattering.integrate import PFGeneralIntegrator
+from PyHyperScattering.PFGeneralIntegrator import IntegrationEngineCache, engine_cache
+import PyHyperScattering.PFGeneralIntegrator as PFGeneralIntegratorModule
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture()
+def pfgenint():
+    engine_cache.clear()
+    integrator = PFGeneralIntegrator(maskmethod='none',geomethod='nika',NIdistance=500,NIbcx=60,NIbcy=64,
+                                     NIpixsizex=60,NIpixsizey=60,integration_method='csr')
+    integrator.mask = np.zeros((128,130))
+    return integrator
+
+def test_nika_calibration_builds_one_integrator(pfgenint,monkeypatch):
+    built = []
+    make = PFGeneralIntegratorModule.makeAzimuthalIntegrator
+    monkeypatch.setattr(PFGeneralIntegratorModule,'makeAzimuthalIntegrator',lambda *args: built.append(args) or make(*args))
+    pfgenint.calibrationFromNikaParams(510,61,65,0,0,60,60)
+    pfgenint.integrator
+    assert len(built) == 1
+
+def test_integrators_are_not_shared(pfgenint):
+    other = PFGeneralIntegrator(maskmethod='none',geomethod='nika',NIdistance=500,NIbcx=60,NIbcy=64,
+                                NIpixsizex=60,NIpixsizey=60,integration_method='csr')
+    assert other.integrator is not pfgenint.integrator
+    pfgenint.getSparseEngine((128,130))
+    assert len(engine_cache) == 1
+
+def test_returning_to_geometry_reuses_sparse_engine(pfgenint):
+    saxs = pfgenint.getSparseEngine((128,130))
+    pfgenint.ni_distance = 35
+    pfgenint.getSparseEngine((128,130))
+    pfgenint.ni_distance = 500
+    hits = engine_cache.hits
+    assert pfgenint.getSparseEngine((128,130)) is saxs
+    assert engine_cache.hits > hits
+
+def test_mask_change_rebuilds_sparse_engine(pfgenint):
+    unmasked = pfgenint.getSparseEngine((128,130))
+    pfgenint.mask = np.zeros((128,130))
+    assert pfgenint.getSparseEngine((128,130)) is unmasked
+    pfgenint.mask[:10,:10] = 1
+    assert pfgenint.getSparseEngine((128,130)) is not unmasked
+
+def test_lru_eviction():
+    cache = IntegrationEngineCache(max_entries=2)
+    cache.get('a',lambda: 'a')
+    cache.get('b',lambda: 'b')
+    cache.get('a',lambda: 'a')
+    cache.get('c',lambda: 'c')
+    assert len(cache) == 2
+    cache.get('a',lambda: 'a')
+    assert (cache.hits,cache.misses) == (2,3)
+    cache.get('b',lambda: 'b')
+    assert cache.misses == 4
+
+class Sized():
+    def __init__(self,nbytes):
+        self.nbytes = nbytes
+
+def test_byte_budget_eviction():
+    cache = IntegrationEngineCache(max_bytes=100)
+    cache.get('a',lambda: Sized(60))
+    cache.get('b',lambda: Sized(30))
+    assert cache.nbytes == 90
+    cache.get('c',lambda: Sized(30))
+    assert len(cache) == 2 and cache.nbytes == 60
+    cache.get('b',lambda: Sized(30))
+    assert cache.misses == 3
+    cache.clear()
+    assert cache.nbytes == 0
@@ -0,0 +1,54 @@
+import sys
+sys.path.append("src/")
+
+import PyHyperScattering
+from PyHyperScattering.FileIO import loadNexus
+
+import xarray as xr
+import numpy as np
+import pandas as pd
+import pickle
+import h5py
+import pytest
+
+
+@pytest.fixture()
+def reduced():
+    rng = np.random.default_rng(0)
+    energy = np.linspace(280,290,20)
+    return xr.DataArray(rng.random((20,36,50)),dims=['energy','chi','q'],
+                        coords={'energy':energy,'chi':np.linspace(-175,175,36),'q':np.linspace(0.001,0.1,50)},
+                        attrs={'sample_name':'test','dist':0.5})
+
+def test_nexus_round_trip(reduced,tmp_path):
+    reduced.fileio.saveNexus(str(tmp_path/'red.nxs'))
+    loaded = loadNexus(tmp_path/'red.nxs')
+    assert np.array_equal(loaded.values,reduced.values)
+    assert np.array_equal(loaded.energy,reduced.energy)
+    assert loaded.attrs['dist'] == 0.5
+
+def test_nexus_chunks_hold_whole_frames(reduced,tmp_path):
+    reduced.fileio.saveNexus(str(tmp_path/'red.nxs'))
+    with h5py.File(tmp_path/'red.nxs','r') as f:
+        assert f['entry/sasdata/I'].chunks == (20,36,50)
+    reduced.transpose('chi','q','energy').fileio.saveNexus(str(tmp_path/'red_t.nxs'))
+    with h5py.File(tmp_path/'red_t.nxs','r') as f:
+        assert f['entry/sasdata/I'].chunks == (36,50,20)
+
+def test_dask_write_and_lazy_reopen(reduced,tmp_path):
+    reduced.chunk({'energy':3}).fileio.saveNexus(str(tmp_path/'red.nxs'),chunks=(4,36,50))
+    lazy = loadNexus(tmp_path/'red.nxs',lazy=True)
+    assert lazy.chunks is not None
+    lazy = pickle.loads(pickle.dumps(lazy))
+    assert np.array_equal(lazy.sel(energy=slice(283,287)).values,reduced.sel(energy=slice(283,287)).values)
+
+def test_multiindex_round_trip(tmp_path):
+    n = 100000
+    index = pd.MultiIndex.from_arrays([np.repeat(np.linspace(280,290,n//4),4),np.tile(['s','p','s','p'],n//4),
+                                       np.arange(n)],names=['energy','polarization','frame'])
+    data = xr.DataArray(np.zeros((n,3)),dims=['system','q'],coords={'q':[0.01,0.02,0.03]})
+    data = data.assign_coords(xr.Coordinates.from_pandas_multiindex(index,'system'))
+    data.fileio.saveNexus(str(tmp_path/'mi.nxs'))
+    loaded = loadNexus(tmp_path/'mi.nxs')
+    assert loaded.indexes['system'].equals(index)
+    assert list(loaded.indexes['system'].names) == ['energy','polarization','frame']
@@ -0,0 +1,114 @@
+import sys
+sys.path.append("src/")
+
+from PyHyperScattering.load import FileLoader
+
+import xarray as xr
+import numpy as np
+import json
+import pytest
+
+
+class NpyLoader(FileLoader):
+    '''
+    minimal loader for .npy frames with a .json metadata sidecar, so series loading can be tested without example data
+    '''
+    file_ext = '(.*?).npy'
+    md_loading_is_quick = True
+
+    def __init__(self):
+        self.pixel_reads = 0
+        self.md_peeks = 0
+
+    def _readMd(self,filepath):
+        with open(str(filepath).replace('.npy','.json')) as f:
+            return json.load(f)
+
+    def peekAtMd(self,filepath):
+        self.md_peeks += 1
+        return self._readMd(filepath)
+
+    def loadSingleImage(self,filepath,coords=None,return_q=False,image_slice=None,**kwargs):
+        self.pixel_reads += 1
+        md = self._readMd(filepath)
+        if coords is not None:
+            md.update(coords)
+        return xr.DataArray(np.load(filepath),dims=['pix_y','pix_x'],attrs=md)
+
+@pytest.fixture()
+def series_dir(tmp_path):
+    rng = np.random.default_rng(0)
+    for n,energy in enumerate(np.linspace(280,290,12)):
+        for pol in [0,90]:
+            stem = tmp_path/f'{n:03d}_{pol}'
+            np.save(f'{stem}.npy',rng.random((6,5)))
+            with open(f'{stem}.json','w') as f:
+                json.dump({'energy':energy,'polarization':pol},f)
+    return tmp_path
+
+def test_threaded_load_matches_serial(series_dir):
+    serial = NpyLoader().loadFileSeries(series_dir,['energy','polarization'])
+    threaded = NpyLoader().loadFileSeries(series_dir,['energy','polarization'],workers=4)
+    assert serial.identical(threaded)
+    assert np.array_equal(serial.energy,np.repeat(np.linspace(280,290,12),2))
+
+def test_unfiltered_load_reads_each_file_once(series_dir):
+    loader = NpyLoader()
+    loader.loadFileSeries(series_dir,['energy','polarization'],workers=4)
+    assert loader.pixel_reads == 24
+    assert loader.md_peeks == 0
+
+def test_md_filter_skips_pixel_reads(series_dir):
+    loader = NpyLoader()
+    out = loader.loadFileSeries(series_dir,['energy','polarization'],md_filter={'polarization':90})
+    assert loader.pixel_reads == 12
+    assert loader.md_peeks == 24
+    assert np.all(out.polarization == 90)
+
+def test_memmapped_load_matches_in_memory(series_dir,tmp_path_factory):
+    in_memory = NpyLoader().loadFileSeries(series_dir,['energy','polarization'])
+    memmap_file = tmp_path_factory.mktemp('stack')/'stack.npy'
+    mapped = NpyLoader().loadFileSeries(series_dir,['energy','polarization'],workers=3,memmap_file=memmap_file)
+    assert isinstance(mapped.data,np.memmap)
+    assert in_memory.identical(mapped)
+    assert np.array_equal(np.load(memmap_file),in_memory.values)
+
+def test_filtered_memmapped_load_is_trimmed(series_dir,tmp_path_factory):
+    loader = NpyLoader()
+    loader.md_loading_is_quick = False
+    memmap_file = tmp_path_factory.mktemp('stack')/'stack.npy'
+    out = loader.loadFileSeries(series_dir,['energy','polarization'],md_filter={'polarization':0},memmap_file=memmap_file)
+    assert loader.pixel_reads == 24
+    assert np.array_equal(np.load(memmap_file),out.values)
+    assert len(out.system) == 12
+    assert list(memmap_file.parent.iterdir()) == [memmap_file]
+
+@pytest.fixture()
+def repeated_dir(series_dir):
+    for pol in [0,90]:
+        np.save(series_dir/f'999_{pol}.npy',np.ones((6,5)))
+        with open(series_dir/f'999_{pol}.json','w') as f:
+            json.dump({'energy':280.0,'polarization':pol},f)
+    return series_dir
+
+def test_duplicates_dropped_by_default(repeated_dir):
+    with pytest.warns(UserWarning,match='Duplicate image'):
+        out = NpyLoader().loadFileSeries(repeated_dir,['energy','polarization'])
+    assert len(out.system) == 24
+
+def test_duplicates_kept(repeated_dir):
+    out = NpyLoader().loadFileSeries(repeated_dir,['energy','polarization'],duplicates='keep')
+    assert len(out.system) == 26
+
+def test_duplicates_summed(repeated_dir):
+    dropped = NpyLoader().loadFileSeries(repeated_dir,['energy','polarization'])
+    summed = NpyLoader().loadFileSeries(repeated_dir,['energy','polarization'],duplicates='sum',workers=4)
+    assert len(summed.system) == 24
+    assert np.allclose(summed.values[0],dropped.values[0]+1)
+    assert np.array_equal(summed.values[2:],dropped.values[2:])
+
+def test_duplicates_averaged(repeated_dir):
+    dropped = NpyLoader().loadFileSeries(repeated_dir,['energy','polarization'])
+    averaged = NpyLoader().loadFileSeries(repeated_dir,['energy','polarization'],duplicates='mean',workers=4)
+    assert np.allclose(averaged.values[0],(dropped.values[0]+1)/2)
+    assert np.array_equal(averaged.values[2:],dropped.values[2:])
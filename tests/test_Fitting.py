@@ -0,0 +1,193 @@
+import sys
+sys.path.append("src/")
+
+from PyHyperScattering import Fitting
+
+import numpy as np
+import xarray as xr
+import scipy.optimize
+import pytest
+
+
+@pytest.fixture()
+def peak_cube():
+    rng = np.random.default_rng(0)
+    q = np.linspace(0.001,0.02,150)
+    energy = np.linspace(270,290,6)
+    chi = np.linspace(-175,175,8)
+    shape = (len(energy),len(chi))
+    true = {'intensity':rng.uniform(200,1000,shape),'pos':rng.uniform(0.007,0.012,shape),
+            'width':rng.uniform(0.0008,0.002,shape),'bg':rng.uniform(0,30,shape)}
+    data = Fitting.lorentz_w_flat_bg(q,*[true[k][...,np.newaxis] for k in ['intensity','pos','width','bg']])
+    data = data + rng.normal(0,2,data.shape)
+    data[...,::13] = np.nan
+    return xr.DataArray(data,dims=('energy','chi','q'),coords={'energy':energy,'chi':chi,'q':q}),true
+
+def test_batched_lorentz_bg_matches_curve_fit(peak_cube):
+    data,true = peak_cube
+    fit = data.fit.apply(Fitting.lorentz_w_flat_bg)
+    assert set(['intensity','pos','width','bg','pos_err']) <= set(fit.data_vars)
+    assert fit.pos.dims == ('energy','chi')
+    assert np.allclose(fit.pos,true['pos'],rtol=0.02)
+    curve = data.isel(energy=2,chi=3).dropna('q')
+    p0 = Fitting.batched_models[Fitting.lorentz_w_flat_bg]['guess'](curve.q.values,curve.values[np.newaxis],
+                                                                    np.ones((1,len(curve.q)),dtype=bool))[0]
+    coeff,cov = scipy.optimize.curve_fit(Fitting.lorentz_w_flat_bg,curve.q.values,curve.values,p0=p0)
+    assert np.allclose(fit.isel(energy=2,chi=3)[['intensity','pos','width','bg']].to_array().values,coeff,rtol=1e-4)
+    assert np.allclose(fit.isel(energy=2,chi=3)[['intensity_err','pos_err']].to_array().values,
+                       np.sqrt(np.diag(cov))[:2],rtol=0.1)
+
+def test_fit_lorentz_bg_wrapper_stays_per_curve_by_default(peak_cube,monkeypatch):
+    data,true = peak_cube
+    monkeypatch.setattr(Fitting.Fitting,'apply_batched',lambda *args,**kwargs: pytest.fail('fit_lorentz_bg was batched'))
+    class PerCurvePath(Exception):
+        pass
+    def stack_curves(*args,**kwargs):
+        raise PerCurvePath()
+    monkeypatch.setattr(Fitting.Fitting,'_stackCurves',stack_curves)
+    with pytest.raises(PerCurvePath):
+        data.fit.apply(Fitting.fit_lorentz_bg,silent=True)
+
+def test_fit_lorentz_bg_wrapper_batched_on_request(peak_cube):
+    data,true = peak_cube
+    batched = data.fit.apply(Fitting.fit_lorentz_bg,method='batched',silent=True)
+    # fit_lorentz_bg's default start: median q, the intensity there, width 0.0002 and no background
+    curve = data.isel(energy=0,chi=0).dropna('q')
+    center = np.median(curve.q.values)
+    p0 = [float(curve.sel(q=center,method='nearest')),center,0.0002,0]
+    coeff,cov = scipy.optimize.curve_fit(Fitting.lorentz_w_flat_bg,curve.q.values,curve.values,p0=p0)
+    for name,value in zip(['intensity','pos','width','bg'],coeff):
+        assert float(batched[name].isel(energy=0,chi=0)) == pytest.approx(value,rel=1e-3)
+
+def test_chunked_fit_matches_single_batch(peak_cube):
+    data,true = peak_cube
+    whole = data.fit.apply(Fitting.lorentz_w_flat_bg)
+    chunked = data.fit.apply(Fitting.lorentz_w_flat_bg,chunk_size=7)
+    assert np.allclose(whole.pos,chunked.pos)
+
+def test_dask_cube_is_fit_chunk_by_chunk(peak_cube,monkeypatch):
+    da = pytest.importorskip('dask.array')
+    data,true = peak_cube
+    whole = data.fit.apply(Fitting.lorentz_w_flat_bg)
+    lazy = data.transpose('q','chi','energy').chunk({'energy':2})
+    computed = []
+    original_compute = da.Array.compute
+    monkeypatch.setattr(da.Array,'compute',lambda self,**kwargs: computed.append(self.shape) or original_compute(self,**kwargs))
+    chunked = lazy.fit.apply(Fitting.lorentz_w_flat_bg,chunk_size=7)
+    assert np.allclose(whole.pos,chunked.pos.transpose(*whole.pos.dims))
+    assert len(computed) == 7 and max(shape[0] for shape in computed) == 7
+
+def test_gauss_and_cos_models():
+    rng = np.random.default_rng(1)
+    q = np.linspace(-1,1,80)
+    amps = rng.uniform(1,5,10)
+    gauss = xr.DataArray(Fitting.gauss(q,amps[:,np.newaxis],0.1,0.2)+rng.normal(0,0.01,(10,80)),
+                         dims=('energy','q'),coords={'energy':np.arange(10),'q':q})
+    fit = gauss.fit.apply(Fitting.gauss)
+    assert np.allclose(fit.intensity,amps,rtol=0.02)
+    assert np.allclose(np.abs(fit.sigma),0.2,rtol=0.02)
+
+    chi = np.radians(np.linspace(-180,180,72))
+    cos = xr.DataArray(Fitting.cos_func(chi,amps[:,np.newaxis],10.)+rng.normal(0,0.01,(10,72)),
+                       dims=('energy','chi'),coords={'energy':np.arange(10),'chi':chi})
+    fit = cos.fit.apply(Fitting.cos_func,fit_axis='chi')
+    assert np.allclose(fit.a,amps,rtol=0.01)
+
+def test_empty_curves_come_back_nan(peak_cube):
+    data,true = peak_cube
+    data = data.copy()
+    data[0,0] = np.nan
+    fit = data.fit.apply(Fitting.lorentz_w_flat_bg)
+    assert np.isnan(fit.pos[0,0]) and np.isnan(fit.pos_err[0,0])
+    assert np.isfinite(fit.pos[0,1])
+
+def test_unconverged_curves_have_nan_errors(peak_cube):
+    data,true = peak_cube
+    fit = data.fit.apply(Fitting.lorentz_w_flat_bg,max_iter=1)
+    unconverged = np.isnan(fit.pos.values)
+    assert unconverged.any()
+    assert np.all(np.isnan(fit.pos_err.values[unconverged]))
+
+@pytest.fixture()
+def anisotropy_cube():
+    rng = np.random.default_rng(3)
+    chi = np.linspace(-179.5,179.5,360)
+    q = np.linspace(0.001,0.05,100)
+    energy = np.linspace(280,290,6)
+    data = (1+0.3*np.cos(2*np.radians(chi))[None,:,None]*np.sin(q*100)[None,None,:])*100
+    data = data + rng.normal(0,1,(len(energy),len(chi),len(q)))
+    data[:,50:60,:] = np.nan
+    return xr.DataArray(data[...,np.newaxis],dims=('energy','chi','q','polarization'),
+                        coords={'energy':energy,'chi':chi,'q':q,'polarization':[90]})
+
+@pytest.mark.parametrize('binnumber',[0,4])
+def test_cos_anisotropy_matches_per_cell_fits(anisotropy_cube,binnumber):
+    energies = anisotropy_cube.energy.values[::2]
+    qarray,ani,ani_unc,chisq = Fitting.fit_cos_anisotropy(anisotropy_cube.isel(polarization=0),0.005,0.045,0.004,
+                                                          energies,-100,-120,binnumber,1e9)
+    assert ani.shape == (len(energies),len(qarray))
+    for e_index,q_index in [(0,0),(1,4),(2,9)]:
+        chi,intensity,params,expected,expected_unc,expected_chisq = Fitting.fit_cos_anisotropy_single(
+            anisotropy_cube.isel(polarization=0),qarray[q_index],0.004,energies[e_index],-100,-120,binnumber,1e9)
+        assert ani[e_index,q_index] == pytest.approx(expected,rel=1e-4)
+        assert ani_unc[e_index,q_index] == pytest.approx(expected_unc,rel=1e-3)
+        assert chisq[e_index,q_index] == pytest.approx(expected_chisq,rel=1e-6)
+
+def test_cos_anisotropy_chisq_limit_and_empty_cells(anisotropy_cube):
+    data = anisotropy_cube.copy()
+    data[0] = np.nan
+    qarray,ani,ani_unc,chisq = Fitting.fit_cos_anisotropy(data,0.005,0.045,0.004,data.energy.values,-100,-120,0,1e9)
+    assert np.all(ani[0] == 0) and np.all(chisq[0] == 100)
+    qarray,ani,ani_unc,chisq = Fitting.fit_cos_anisotropy(data,0.005,0.045,0.004,data.energy.values,-100,-120,0,0)
+    assert np.all(ani == 0)
+
+def test_cos_anisotropy_needs_one_polarization(anisotropy_cube):
+    both = xr.concat([anisotropy_cube,anisotropy_cube.assign_coords(polarization=[0])],dim='polarization')
+    with pytest.raises(ValueError):
+        Fitting.fit_cos_anisotropy(both,0.005,0.045,0.004,both.energy.values,-100,-120,0,1e9)
+
+def fit_line(x,guess=None):
+    slope,offset = np.polyfit(x.q.values,x.values.ravel(),1)
+    return xr.Dataset({'slope':x*0+slope,'offset':x*0+offset})
+
+def fit_mean_recording_guess(x,guess=None):
+    started = -1. if guess is None else guess[0]
+    return xr.Dataset({'value':x*0+float(x.mean()),'started':x*0+started})
+
+@pytest.fixture()
+def line_cube():
+    rng = np.random.default_rng(4)
+    q = np.linspace(0,1,20)
+    return xr.DataArray(rng.random((3,5,20)),dims=('energy','chi','q'),
+                        coords={'energy':[280.,281.,282.],'chi':np.arange(5),'q':q})
+
+def test_process_pool_fit_matches_serial(line_cube):
+    serial = line_cube.fit.apply(fit_line)
+    parallel = line_cube.fit.apply(fit_line,workers=2,chunk_size=4)
+    xr.testing.assert_allclose(serial.transpose(*parallel.slope.dims),parallel)
+
+def test_process_pool_fit_warm_starts_within_chunks(line_cube):
+    fit = line_cube.fit.apply(fit_mean_recording_guess,workers=2,chunk_size=3)
+    stacked = fit.stack(curve=['energy','chi'])
+    values = stacked.value.values
+    started = stacked.started.values
+    for i in range(len(values)):
+        if i % 3 == 0:
+            assert started[i] == -1
+        else:
+            assert started[i] == pytest.approx(values[i-1])
+    cold = line_cube.fit.apply(fit_mean_recording_guess,workers=2,chunk_size=3,warm_start=False)
+    assert np.all(cold.started == -1)
+
+def fit_mean_strict_guess(x,guess=None):
+    # takes a one-value guess but returns two variables, so the raw warm guess has the wrong length
+    if guess is not None and len(guess) != 1:
+        raise ValueError('guess must be [value]')
+    started = -1. if guess is None else guess[0]
+    return xr.Dataset({'value':x*0+float(x.mean()),'started':x*0+started})
+
+def test_process_pool_warm_start_falls_back_to_user_guess(line_cube):
+    fit = line_cube.fit.apply(fit_mean_strict_guess,workers=2,chunk_size=3,guess=[0.5])
+    assert np.all(fit.started == 0.5)
+    fit = line_cube.fit.apply(fit_mean_strict_guess,workers=2,chunk_size=3)
+    assert np.all(fit.started == -1)
@@ -0,0 +1,78 @@
+import sys
+sys.path.append("src/")
+
+from PyHyperScattering import HDR
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import skimage.morphology
+import pytest
+
+
+@pytest.fixture()
+def multi_exposure_stack():
+    rng = np.random.default_rng(0)
+    rows = []
+    for energy in [280,285]:
+        for pol in [0,90]:
+            for exposure in [0.1,1.0,10.0]:
+                for repeat in range(2):
+                    rows.append((energy,pol,exposure,len(rows)))
+    index = pd.MultiIndex.from_tuples(rows,names=['energy','polarization','exposure','filenumber'])
+    data = rng.random((len(rows),20,24))*rng.choice([1,100,10000],size=(len(rows),20,24))
+    raw = xr.DataArray(data,dims=['system','pix_x','pix_y'])
+    return raw.assign_coords(xr.Coordinates.from_pandas_multiindex(index,'system'))
+
+def reference_merge(frames_by_exposure,cutoff_hi=45000,cutoff_lo=20):
+    '''
+    one group merged the way the per-group masked-array implementation did
+    '''
+    masked,weights = [],[]
+    for exposure,frames in frames_by_exposure.items():
+        mean = np.ma.masked_greater_equal(frames.mean(axis=0),cutoff_hi/exposure)
+        mean = np.ma.masked_less_equal(mean,cutoff_lo/exposure)
+        mean.mask = skimage.morphology.binary_closing(mean.mask)
+        masked.append(mean)
+        weights.append(exposure)
+    return np.ma.average(masked,axis=0,weights=weights).filled(np.nan)
+
+def test_hdr_merge_matches_masked_average(multi_exposure_stack):
+    merged = HDR.scaleAndMask(multi_exposure_stack)
+    assert merged.dims == ('system','pix_x','pix_y')
+    assert list(merged.indexes['system'].names) == ['energy','polarization']
+    assert len(merged.system) == 4
+    for energy,pol in merged.indexes['system']:
+        group = multi_exposure_stack.sel(energy=energy,polarization=pol)
+        frames = {exposure:group.values[group.exposure.values==exposure] for exposure in np.unique(group.exposure)}
+        expected = reference_merge(frames)
+        assert np.allclose(merged.sel(energy=energy,polarization=pol).values,expected,equal_nan=True)
+
+def test_close_masks_matches_skimage():
+    rng = np.random.default_rng(1)
+    mask = rng.random((4,30,40)) > 0.7
+    expected = np.stack([skimage.morphology.binary_closing(frame) for frame in mask])
+    assert np.array_equal(HDR.closeMasks(mask),expected)
+
+def test_hdr_merge_without_masks(multi_exposure_stack):
+    merged = HDR.scaleAndMask(multi_exposure_stack,mask_hi=False,mask_lo=False,close_mask=False)
+    group = multi_exposure_stack.sel(energy=280,polarization=90)
+    exposures = group.exposure.values
+    expected = sum(e*group.values[exposures==e].mean(axis=0) for e in np.unique(exposures))/np.unique(exposures).sum()
+    assert np.allclose(merged.sel(energy=280,polarization=90).values,expected)
+
+def test_hdr_merge_stays_lazy_on_dask(multi_exposure_stack):
+    lazy_raw = multi_exposure_stack.chunk({'system':5})
+    merged = HDR.scaleAndMask(lazy_raw,chunk_frames=12)
+    assert merged.chunks is not None
+    # 6 frames per condition, so two conditions per chunk
+    assert merged.chunks[0] == (2,2)
+    expected = HDR.scaleAndMask(multi_exposure_stack)
+    assert list(merged.indexes['system']) == list(expected.indexes['system'])
+    assert np.allclose(merged.values,expected.values,equal_nan=True)
+
+def test_hdr_merge_on_dask_with_shuffled_frames(multi_exposure_stack):
+    shuffled = multi_exposure_stack.isel(system=np.random.default_rng(2).permutation(len(multi_exposure_stack.system)))
+    merged = HDR.scaleAndMask(shuffled.chunk({'system':7}))
+    expected = HDR.scaleAndMask(multi_exposure_stack)
+    assert np.allclose(merged.values,expected.values,equal_nan=True)
@@ -0,0 +1,167 @@
+import sys
+sys.path.append("src/")
+
+from PyHyperScattering.integrate import PFGeneralIntegrator
+from PyHyperScattering.integrate import PFEnergySeriesIntegrator
+from PyHyperScattering.PFGeneralIntegrator import SparseIntegrationEngine
+
+import xarray as xr
+import numpy as np
+import pandas as pd
+import time
+import os
+import pytest
+
+
+def make_synthetic_data(n_energies=8):
+    '''
+    small synthetic raw stack with SST1-like geometry attrs, so these tests do not need the example data packs
+    '''
+    rng = np.random.default_rng(0)
+    shape = (128,130)
+    index = pd.MultiIndex.from_product([np.linspace(280,290,n_energies),[0,90]],names=['energy','polarization'])
+    data = xr.DataArray(rng.random((len(index),)+shape)*100,dims=['system','pix_y','pix_x'],
+                        coords={'pix_y':np.arange(shape[0]),'pix_x':np.arange(shape[1])},
+                        attrs={'dist':0.5,'poni1':shape[0]/2*6e-5,'poni2':shape[1]/2*6e-5,
+                               'rot1':0,'rot2':0,'rot3':0,'pixel1':6e-5,'pixel2':6e-5})
+    return data.assign_coords(xr.Coordinates.from_pandas_multiindex(index,'system'))
+
+@pytest.fixture(autouse=True,scope='module')
+def synthetic_data():
+    return make_synthetic_data()
+
+@pytest.fixture(autouse=True,scope='module')
+def pfgenint(synthetic_data):
+    integrator = PFGeneralIntegrator(maskmethod='none',geomethod='template_xr',template_xr=synthetic_data,integration_method='csr')
+    integrator.mask = np.zeros((len(synthetic_data.pix_y),len(synthetic_data.pix_x)),dtype=bool)
+    integrator.mask[:10,:40] = True
+    return integrator
+
+@pytest.fixture(autouse=True,scope='module')
+def smooth_data(synthetic_data):
+    '''
+    radially smooth frames, so that binning in 2theta then resampling to q is comparable to binning in q directly
+    '''
+    yy,xx = np.mgrid[:len(synthetic_data.pix_y),:len(synthetic_data.pix_x)]
+    r = np.hypot(yy-64,xx-65)
+    scale = 1+0.1*np.arange(len(synthetic_data.system))
+    return synthetic_data.copy(data=1000*np.exp(-r/20)[np.newaxis]*scale[:,np.newaxis,np.newaxis])
+
+@pytest.fixture(autouse=True,scope='module')
+def pfesint(synthetic_data):
+    integrator = PFEnergySeriesIntegrator(maskmethod='none',geomethod='template_xr',template_xr=synthetic_data,integration_method='csr')
+    integrator.mask = np.zeros((len(synthetic_data.pix_y),len(synthetic_data.pix_x)),dtype=bool)
+    return integrator
+
+def _assert_matches_legacy(legacy,batch):
+    # every bin, empty ones included
+    assert np.allclose(legacy.q,batch.q)
+    assert np.allclose(legacy.values,batch.values,rtol=1e-5,equal_nan=True)
+
+def test_batch_matches_legacy_1dim_mi(synthetic_data,pfgenint):
+    legacy = pfgenint.integrateImageStack(synthetic_data,method='legacy')
+    batch = pfgenint.integrateImageStack(synthetic_data,method='batch')
+    assert batch.dims == ('system','chi','q')
+    assert np.allclose(legacy.chi,batch.chi)
+    _assert_matches_legacy(legacy,batch)
+
+def test_batch_matches_legacy_2dim(synthetic_data,pfgenint):
+    legacy = pfgenint.integrateImageStack(synthetic_data.unstack('system'),method='legacy')
+    batch = pfgenint.integrateImageStack(synthetic_data.unstack('system'),method='batch',chunksize=5)
+    assert batch.dims == ('energy','polarization','chi','q')
+    _assert_matches_legacy(legacy.transpose(*batch.dims),batch)
+
+@pytest.mark.parametrize('maskToNan',[True,False])
+def test_batch_excludes_nan_and_zero_pixels_like_legacy(synthetic_data,maskToNan):
+    integrator = PFGeneralIntegrator(maskmethod='none',geomethod='template_xr',template_xr=synthetic_data,
+                                     integration_method='csr',maskToNan=maskToNan)
+    integrator.mask = np.zeros((len(synthetic_data.pix_y),len(synthetic_data.pix_x)),dtype=bool)
+    integrator.mask[:10,:40] = True
+    data = synthetic_data.copy()
+    data[0,60:70,60:70] = np.nan
+    data[1,20:40,20:40] = 0
+    legacy = integrator.integrateImageStack(data,method='legacy')
+    batch = integrator.integrateImageStack(data,method='batch')
+    _assert_matches_legacy(legacy,batch)
+    processes = integrator.integrateImageStack(data,method='processes',workers=2,chunksize=3)
+    assert np.array_equal(batch.values,processes.values,equal_nan=True)
+
+@pytest.mark.skipif('PYHYPER_BENCHMARK' not in os.environ,reason='benchmark; set PYHYPER_BENCHMARK=1 to run')
+def test_batch_benchmark_vs_legacy(pfgenint):
+    data = make_synthetic_data(n_energies=64)
+    start = time.perf_counter()
+    legacy = pfgenint.integrateImageStack(data,method='legacy')
+    legacy_time = time.perf_counter()-start
+    start = time.perf_counter()
+    batch = pfgenint.integrateImageStack(data,method='batch')
+    batch_time = time.perf_counter()-start
+    _assert_matches_legacy(legacy,batch)
+    assert batch_time < legacy_time
+    print(f'{data.sizes["system"]} frames: legacy {legacy_time:.3f} s, batch {batch_time:.3f} s ({legacy_time/batch_time:.1f}x)')
+
+@pytest.mark.parametrize('maskToNan',[True,False])
+def test_en_series_batch_matches_legacy(smooth_data,synthetic_data,maskToNan):
+    integrator = PFEnergySeriesIntegrator(maskmethod='none',geomethod='template_xr',template_xr=synthetic_data,
+                                          integration_method='csr',maskToNan=maskToNan)
+    integrator.mask = np.zeros((len(synthetic_data.pix_y),len(synthetic_data.pix_x)),dtype=bool)
+    legacy = integrator.integrateImageStack(smooth_data,method='legacy')
+    batch = integrator.integrateImageStack(smooth_data,method='batch')
+    assert batch.dims == ('system','chi','q')
+    assert np.allclose(legacy.q,batch.q)
+    legacy,batch = legacy.transpose(*batch.dims).values,batch.values
+    # every bin: empty bins are filled like legacy, and only bins on the edge of the detector's coverage can differ
+    # in whether they are empty, since batch interpolates from 2theta bins rather than binning onto q directly
+    assert np.isfinite(batch).all() and np.isfinite(legacy).all()
+    assert np.mean((legacy==0) != (batch==0)) < 0.01
+    relative_error = np.abs(batch-legacy)/np.maximum(np.abs(legacy),1e-6)
+    assert np.median(relative_error) < 1e-3
+    assert np.percentile(relative_error,99) < 0.02
+
+def test_en_series_batch_shares_one_matrix(smooth_data,synthetic_data):
+    integrator = PFEnergySeriesIntegrator(maskmethod='none',geomethod='template_xr',template_xr=synthetic_data,integration_method='csr')
+    integrator.mask = np.zeros((len(synthetic_data.pix_y),len(synthetic_data.pix_x)),dtype=bool)
+    integrator.integrateImageStack(smooth_data,method='batch')
+    engine = integrator.getSparseEngine((len(synthetic_data.pix_y),len(synthetic_data.pix_x)),unit='2th_deg')
+    integrator.integrateImageStack(smooth_data.sel(polarization=90),method='batch')
+    assert integrator.getSparseEngine((len(synthetic_data.pix_y),len(synthetic_data.pix_x)),unit='2th_deg') is engine
+
+def test_en_series_batch_matrix_is_independent_of_energy(smooth_data,synthetic_data):
+    engines = []
+    for energy in (280,2000):
+        integrator = PFEnergySeriesIntegrator(maskmethod='none',geomethod='template_xr',template_xr=synthetic_data,
+                                              integration_method='csr',energy=energy)
+        integrator.mask = np.zeros((len(synthetic_data.pix_y),len(synthetic_data.pix_x)),dtype=bool)
+        integrator.integrateImageStack(smooth_data,method='batch')
+        engines.append(integrator.getSparseEngine((len(synthetic_data.pix_y),len(synthetic_data.pix_x)),unit='2th_deg'))
+    assert engines[0] is engines[1]
+
+def test_en_series_legacy_bins_directly_onto_dest_q(smooth_data,pfesint):
+    legacy = pfesint.integrateImageStack(smooth_data,method='legacy')
+    assert np.array_equal(legacy.q,pfesint.dest_q)
+    npts,radial_range = pfesint.radialBinning()
+    assert radial_range is not None
+    frame = smooth_data.isel(system=-1)
+    direct = pfesint.createIntegrator(float(frame.energy)).integrate2d(frame.values,npts,radial_range=radial_range,
+                                                                       mask=pfesint.mask,unit='q_A^-1',method='csr')
+    assert np.allclose(legacy.isel(system=-1).values,direct.intensity,equal_nan=True)
+
+def test_processes_matches_batch(synthetic_data,pfgenint):
+    batch = pfgenint.integrateImageStack(synthetic_data,method='batch')
+    processes = pfgenint.integrateImageStack(synthetic_data,method='processes',workers=2,chunksize=3)
+    assert processes.dims == batch.dims
+    assert np.array_equal(batch.values,processes.values,equal_nan=True)
+
+def test_processes_builds_no_engine_in_parent(synthetic_data,pfgenint,monkeypatch):
+    monkeypatch.setattr(pfgenint,'getSparseEngine',lambda *args,**kwargs: pytest.fail('parent built a sparse engine'))
+    processes = pfgenint.integrateImageStack(synthetic_data,method='processes',workers=2,chunksize=5)
+    assert processes.sizes['chi'] == SparseIntegrationEngine.npts_chi and processes.sizes['q'] == pfgenint.npts
+
+def test_processes_empty_stack(synthetic_data,pfgenint):
+    empty = pfgenint.integrateImageStack(synthetic_data.isel(system=slice(0,0)),method='processes',workers=2)
+    assert empty.sizes['system'] == 0
+
+def test_en_series_processes_is_not_supported(smooth_data,pfesint):
+    with pytest.raises(NotImplementedError):
+        pfesint.integrateImageStack_processes(smooth_data,workers=2)
+    with pytest.raises(NotImplementedError):
+        pfesint.integrateImageStack(smooth_data,method='processes')
@@ -0,0 +1,89 @@
+import sys
+sys.path.append("src/")
+
+from PyHyperScattering.load import SST1RSoXSLoader
+
+import numpy as np
+import pandas as pd
+import json
+import warnings
+import os
+from PIL import Image, TiffImagePlugin
+import pytest
+
+
+@pytest.fixture()
+def scan_dir(tmp_path):
+    '''
+    synthetic SST1 suitcase output: primary csv in the scan root, images + jsonl + baseline in a subdirectory
+    '''
+    images = tmp_path/'images'
+    images.mkdir()
+    nimages = 6
+    pd.DataFrame({'en_energy_setpoint':np.linspace(280,285,nimages),
+                  'en_polarization_setpoint':[0,90]*(nimages//2),
+                  'RSoXS Shutter Opening Time (ms)':[1000]*nimages}).to_csv(tmp_path/'12345-primary.csv',index=False)
+    pd.DataFrame({'RSoXS Sample Outboard-Inboard':[1.],'RSoXS Sample Up-Down':[2.],
+                  'RSoXS Sample Downstream-Upstream':[3.],'RSoXS Sample Rotation':[0.]}).to_csv(images/'12345-baseline.csv',index=False)
+    with open(images/'12345.jsonl','w') as f:
+        json.dump([{},{'time':1.7e9,'sample_name':'test','RSoXS_Main_DET':'SAXS',
+                       'RSoXS_SAXS_BCX':490.,'RSoXS_SAXS_BCY':491.,'RSoXS_SAXS_SDD':512.}],f)
+    for seq_num in range(nimages):
+        Image.fromarray(np.full((8,9),seq_num,dtype=np.uint16)).save(images/f'12345-test-primary-Small Angle CCD Detector_image-{seq_num}.tiff')
+    return images
+
+def test_scan_csvs_parsed_once(scan_dir,monkeypatch):
+    loader = SST1RSoXSLoader(corr_mode='none')
+    reads = []
+    read_csv = pd.read_csv
+    monkeypatch.setattr(pd,'read_csv',lambda *args,**kwargs: reads.append(args[0]) or read_csv(*args,**kwargs))
+    out = loader.loadFileSeries(scan_dir,['energy','polarization'])
+    assert len(out.system) == 6
+    assert len(reads) == 2
+    assert np.allclose(sorted(out.energy.values),np.linspace(280,285,6))
+
+def test_scan_index_reparses_changed_files(scan_dir):
+    loader = SST1RSoXSLoader(corr_mode='none')
+    image = next(scan_dir.glob('*image-2.tiff'))
+    assert loader.loadMd(image)['energy'] == 282
+    primary = scan_dir.parent/'12345-primary.csv'
+    df = pd.read_csv(primary)
+    df['en_energy_setpoint'] += 10
+    df.to_csv(primary,index=False)
+    os.utime(primary,(0,os.path.getmtime(primary)+10))
+    assert loader.loadMd(image)['energy'] == 292
+
+@pytest.mark.parametrize('dtype',[np.uint16,np.float32])
+def test_sliced_tiff_read_matches_full_read(tmp_path,dtype):
+    loader = SST1RSoXSLoader(corr_mode='none')
+    data = np.arange(40*30).reshape(40,30).astype(dtype)
+    Image.fromarray(data).save(tmp_path/'frame.tiff')
+    roi = (slice(5,20,3),slice(10,None))
+    sliced,full_shape = loader.readTiff(tmp_path/'frame.tiff',roi)
+    assert full_shape == (40,30)
+    assert np.array_equal(sliced,data[roi])
+    Image.fromarray(data).save(tmp_path/'compressed.tiff',compression='tiff_lzw')
+    with pytest.warns(UserWarning,match='decoding the whole image'):
+        assert np.array_equal(loader.readTiff(tmp_path/'compressed.tiff',roi)[0],data[roi])
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert np.array_equal(loader.readTiff(tmp_path/'compressed.tiff')[0],data)
+        assert np.array_equal(loader.readTiff(tmp_path/'compressed.tiff',(slice(None),slice(0,30)))[0],data)
+
+def test_multistrip_tiff_is_memory_mapped(tmp_path,monkeypatch):
+    loader = SST1RSoXSLoader(corr_mode='none')
+    data = np.arange(40*30).reshape(40,30).astype(np.uint16)
+    strips = TiffImagePlugin.ImageFileDirectory_v2()
+    strips[278] = 7 # RowsPerStrip
+    Image.fromarray(data).save(tmp_path/'strips.tiff',tiffinfo=strips)
+    monkeypatch.setattr(TiffImagePlugin.TiffImageFile,'load',lambda self: pytest.fail('multi-strip image was decoded by PIL'))
+    roi = (slice(5,20,3),slice(10,None))
+    sliced,full_shape = loader.readTiff(tmp_path/'strips.tiff',roi)
+    assert full_shape == (40,30)
+    assert np.array_equal(sliced,data[roi])
+
+def test_sliced_load(scan_dir):
+    loader = SST1RSoXSLoader(corr_mode='none')
+    image = next(scan_dir.glob('*image-2.tiff'))
+    sliced = loader.loadSingleImage(image,image_slice=(slice(0,4),slice(2,5)))
+    assert sliced.shape == (4,3)
@@ -0,0 +1,69 @@
+import sys
+sys.path.append("src/")
+
+from PyHyperScattering.integrate import PFGeneralIntegrator, PFEnergySeriesIntegrator, StreamingReducer, loadStreamedReduction
+
+import xarray as xr
+import numpy as np
+import pytest
+
+
+def make_frame(energy,polarization):
+    rng = np.random.default_rng(int(energy))
+    shape = (64,66)
+    return xr.DataArray(rng.random(shape)*100,dims=['pix_y','pix_x'],
+                        coords={'pix_y':np.arange(shape[0]),'pix_x':np.arange(shape[1])},
+                        attrs={'energy':energy,'polarization':polarization,'dist':0.5,'poni1':shape[0]/2*6e-5,
+                               'poni2':shape[1]/2*6e-5,'rot1':0,'rot2':0,'rot3':0,'pixel1':6e-5,'pixel2':6e-5})
+
+@pytest.fixture()
+def pfgenint():
+    integrator = PFGeneralIntegrator(maskmethod='none',geomethod='template_xr',template_xr=make_frame(280,0),integration_method='csr')
+    integrator.mask = np.zeros((64,66),dtype=bool)
+    return integrator
+
+def test_stream_appends_each_frame(tmp_path,pfgenint):
+    energies = [280.,281.,282.]
+    with StreamingReducer(pfgenint,tmp_path/'live.h5',dims=['energy','polarization'],chunk_frames=2) as sr:
+        for n,energy in enumerate(energies):
+            sr.processFrame(make_frame(energy,'p' if n%2 else 's'))
+            assert len(loadStreamedReduction(tmp_path/'live.h5').system) == n+1
+    red = loadStreamedReduction(tmp_path/'live.h5')
+    assert red.dims == ('system','chi','q')
+    assert np.array_equal(red.energy,energies)
+    assert list(red.polarization.values) == ['s','p','s']
+    direct = pfgenint.integrateSingleImage(make_frame(281.,'p')).squeeze()
+    assert np.allclose(red.sel(energy=281.).squeeze().values,direct.values,equal_nan=True)
+
+def test_stream_from_documents(tmp_path,pfgenint):
+    frames = [make_frame(e,0) for e in (280.,285.)]
+    docs = [('start',{k:v for k,v in frames[0].attrs.items() if k not in ('energy','polarization')})]
+    docs += [('event',{'data':{'image':f.values,'en_energy':f.attrs['energy'],'polarization':0}}) for f in frames]
+    docs += [('stop',{})]
+    with StreamingReducer(pfgenint,tmp_path/'live.h5',dims=['energy','polarization']) as sr:
+        assert sr.processDocuments(docs,'image',md_fields={'energy':'en_energy'}) == 2
+        red = sr.result()
+    assert np.array_equal(red.energy,[280.,285.])
+
+def test_stream_coords_keep_later_frames_exact(tmp_path,pfgenint):
+    with StreamingReducer(pfgenint,tmp_path/'live.h5',dims=['energy','polarization']) as sr:
+        sr.processFrame(make_frame(280,'s'))
+        sr.processFrame(make_frame(280.5,'p'*100))
+        with pytest.raises(TypeError):
+            sr.processFrame(make_frame(281,90))
+    red = loadStreamedReduction(tmp_path/'live.h5')
+    assert np.array_equal(red.energy,[280.,280.5])
+    assert list(red.polarization.values) == ['s','p'*100]
+
+@pytest.mark.parametrize('energies',[None,[280.,281.,282.]])
+def test_stream_energy_series(tmp_path,energies):
+    integrator = PFEnergySeriesIntegrator(maskmethod='none',geomethod='template_xr',template_xr=make_frame(280,0),integration_method='csr')
+    integrator.mask = np.zeros((64,66),dtype=bool)
+    with StreamingReducer(integrator,tmp_path/'live.h5',dims=['energy'],energies=energies) as sr:
+        for energy in (280.,281.,282.):
+            sr.processFrame(make_frame(energy,0))
+        red = sr.result()
+    assert np.array_equal(red.energy,[280.,281.,282.])
+    assert np.allclose(red.q,integrator.dest_q)
+    direct = integrator.integrateSingleImage(make_frame(282.,0)).squeeze()
+    assert np.allclose(red.sel(energy=282.).squeeze().values,direct.values,equal_nan=True)
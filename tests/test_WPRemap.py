@@ -0,0 +1,90 @@
+import sys
+sys.path.append("src/")
+
+from PyHyperScattering.integrate import WPIntegrator
+from PyHyperScattering.WPIntegrator import PolarRemapEngine
+
+import xarray as xr
+import numpy as np
+import skimage
+import pytest
+
+
+@pytest.fixture()
+def qxqy_stack():
+    rng = np.random.default_rng(0)
+    qx = np.linspace(-0.3,0.25,24)
+    qy = np.linspace(-0.2,0.3,20)
+    energy = [280.,281.,282.]
+    return xr.DataArray(rng.random((24,20,3)).astype(np.float32),dims=('qx','qy','energy'),
+                        coords={'qx':qx,'qy':qy,'energy':energy})
+
+def test_remap_engine_matches_warp_polar():
+    rng = np.random.default_rng(1)
+    img = rng.random((32,40))
+    center = (15.3,20.7)
+    reference = skimage.transform.warp_polar(img,center=center)
+    assert np.allclose(PolarRemapEngine(img.shape,center).remap(img),reference)
+
+def test_batched_stack_matches_single_images(qxqy_stack):
+    integ = WPIntegrator(force_np_backend=True)
+    reduced = integ.integrateImageStack(qxqy_stack,method='batched')
+    assert reduced.dims == ('energy','chi','q')
+    assert reduced.dtype == np.float32
+    for energy in qxqy_stack.energy.values:
+        single = integ.integrateSingleImage(qxqy_stack.sel(energy=energy))
+        assert np.allclose(reduced.sel(energy=energy).values,single.values)
+        assert np.allclose(reduced.q,single.q)
+
+def test_batched_stack_on_dask(qxqy_stack):
+    integ = WPIntegrator(force_np_backend=True,use_chunked_processing=True)
+    reduced = integ.integrateImageStack(qxqy_stack,chunksize=2)
+    assert reduced.chunks is not None
+    eager = WPIntegrator(force_np_backend=True).integrateImageStack(qxqy_stack,method='batched')
+    assert np.allclose(reduced.values,eager.values)
+
+def test_default_method_is_legacy(qxqy_stack,monkeypatch):
+    integ = WPIntegrator(force_np_backend=True)
+    monkeypatch.setattr(integ,'integrateImageStack_batched',lambda *args,**kwargs: pytest.fail('default method was batched'))
+    monkeypatch.setattr(integ,'integrateImageStack_legacy',lambda data: 'legacy')
+    assert integ.integrateImageStack(qxqy_stack) == 'legacy'
+
+def test_integer_images_scaled_like_warp_polar(qxqy_stack):
+    counts = (qxqy_stack*1000).astype(np.uint16)
+    batched = WPIntegrator(force_np_backend=True).integrateImageStack(counts,method='batched')
+    center = WPIntegrator().beamCenter(counts)
+    reference = skimage.transform.warp_polar(counts.isel(energy=0).values,center=center)
+    assert np.allclose(batched.isel(energy=0).values,reference)
+
+def test_batched_stack_keeps_extra_dims(qxqy_stack):
+    sweep = xr.concat([qxqy_stack,2*qxqy_stack],dim='radius').assign_coords(radius=[5,10])
+    reduced = WPIntegrator(force_np_backend=True).integrateImageStack(sweep,method='batched')
+    assert reduced.dims == ('radius','energy','chi','q')
+    assert np.allclose(reduced.sel(radius=10).values,2*reduced.sel(radius=5).values,atol=1e-6)
+
+@pytest.fixture()
+def radial_image():
+    q_axis = np.linspace(-0.5,0.5,101)
+    qx,qy = np.meshgrid(q_axis,q_axis,indexing='ij')
+    return xr.DataArray(np.sqrt(qx**2+qy**2)[:,:,np.newaxis],dims=('qx','qy','energy'),
+                        coords={'qx':q_axis,'qy':q_axis,'energy':[280.]})
+
+def test_configurable_bins(qxqy_stack):
+    reduced = WPIntegrator(force_np_backend=True,npts_chi=90,npts_q=40).integrateImageStack(qxqy_stack)
+    assert reduced.shape == (3,90,40)
+    assert np.allclose(np.diff(reduced.chi),4)
+    assert reduced.chi[0] == -178
+
+@pytest.mark.parametrize('log_q',[False,True])
+def test_q_bins_land_on_the_right_radius(radial_image,log_q):
+    integ = WPIntegrator(force_np_backend=True,q_max=0.4,q_min=0.02,npts_q=64,log_q=log_q)
+    reduced = integ.integrateImageStack(radial_image).isel(energy=0)
+    assert float(reduced.q.max()) == pytest.approx(0.4)
+    if log_q:
+        assert np.allclose(np.diff(np.log(reduced.q)),np.log(0.4/0.02)/63)
+    # the image is |q|, so every chi row should read back its own q bin
+    assert np.allclose(reduced.values,reduced.q.values[np.newaxis,:],atol=0.01)
+
+def test_log_q_needs_a_positive_q_min(radial_image):
+    with pytest.raises(ValueError):
+        WPIntegrator(force_np_backend=True,log_q=True,q_min=0,q_max=0.4).integrateImageStack(radial_image)
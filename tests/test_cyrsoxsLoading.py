@@ -0,0 +1,105 @@
+import sys
+sys.path.append("src/")
+
+from PyHyperScattering.load import cyrsoxsLoader
+
+import xarray as xr
+import numpy as np
+import h5py
+import pickle
+import pytest
+
+
+def write_simulation(path,energies=(280.,281.,282.5),shape=(16,16),seed=0,output_dir='HDF5'):
+    '''
+    minimal CyRSoXS output directory: config.txt plus one projection per energy
+    '''
+    rng = np.random.default_rng(seed)
+    (path/output_dir).mkdir(parents=True)
+    with open(path/'config.txt','w') as f:
+        f.write(f'Energies = [{", ".join(str(e) for e in energies)}];\n')
+        f.write('NumThreads = 4;\n')
+    projections = []
+    for e in energies:
+        projection = rng.random(shape).astype(np.float32)
+        with h5py.File(path/output_dir/f'Energy_{e:0.2f}.h5','w') as h5:
+            h5.create_dataset('K0/projection',data=projection)
+        projections.append(projection)
+    return np.stack(projections,axis=-1)
+
+@pytest.fixture()
+def sim_dir(tmp_path):
+    expected = write_simulation(tmp_path/'sim')
+    return tmp_path/'sim',expected
+
+def test_legacy_load_keeps_source_dtype(sim_dir):
+    path,expected = sim_dir
+    data = cyrsoxsLoader(profile_time=False).loadDirectory(path,PhysSize=5)
+    assert data.dtype == np.float32
+    assert data.dims == ('qx','qy','energy')
+    assert np.array_equal(data.values,expected)
+
+def test_dask_load_matches_legacy(sim_dir):
+    path,expected = sim_dir
+    loader = cyrsoxsLoader(profile_time=False)
+    legacy = loader.loadDirectory(path,method='legacy',PhysSize=5)
+    lazy = loader.loadDirectory(path,method='dask',PhysSize=5)
+    assert np.array_equal(lazy.values,legacy.values)
+
+@pytest.mark.parametrize('method',['legacy','dask'])
+def test_load_from_custom_output_dir(tmp_path,method):
+    expected = write_simulation(tmp_path/'sim',output_dir='out')
+    data = cyrsoxsLoader(profile_time=False).loadDirectory(tmp_path/'sim',method=method,output_dir='out',PhysSize=5)
+    assert np.array_equal(data.values,expected)
+    sweep = cyrsoxsLoader(profile_time=False).loadSweep(tmp_path,r'(sim)',output_dir='out',PhysSize=5)
+    assert np.array_equal(sweep.sel(param='sim').transpose('qx','qy','energy').values,expected)
+
+def test_dask_load_holds_no_file_handles(sim_dir):
+    path,expected = sim_dir
+    lazy = cyrsoxsLoader(profile_time=False).loadDirectory(path,method='dask',PhysSize=5)
+    assert 'filehandles' not in lazy.attrs
+    assert len(h5py.h5f.get_obj_ids(types=h5py.h5f.OBJ_FILE)) == 0
+    restored = pickle.loads(pickle.dumps(lazy))
+    assert np.array_equal(restored.values,expected)
+    assert len(h5py.h5f.get_obj_ids(types=h5py.h5f.OBJ_FILE)) == 0
+
+@pytest.fixture()
+def sweep_dir(tmp_path):
+    expected = {}
+    for n,(radius,spacing) in enumerate([(5,10),(5,20),(7.5,10),(7.5,20)]):
+        expected[(radius,spacing)] = write_simulation(tmp_path/f'sim_r{radius}_s{spacing}',seed=n)
+    (tmp_path/'notes').mkdir()
+    return tmp_path,expected
+
+def test_sweep_stacks_on_a_parameter_grid(sweep_dir):
+    path,expected = sweep_dir
+    sweep = cyrsoxsLoader(profile_time=False).loadSweep(path,r'sim_r(?P<radius>[0-9.]+)_s(?P<spacing>[0-9]+)',PhysSize=5)
+    assert sweep.dims == ('radius','spacing','energy','qx','qy')
+    assert list(sweep.radius.values) == [5,7.5]
+    assert sweep.chunks is not None
+    assert np.array_equal(sweep.sel(radius=7.5,spacing=10).transpose('qx','qy','energy').values,expected[(7.5,10)])
+
+def test_sweep_single_group(sweep_dir):
+    path,expected = sweep_dir
+    sweep = cyrsoxsLoader(profile_time=False).loadSweep(path,r'sim_r5_s([0-9]+)',PhysSize=5)
+    assert sweep.dims == ('param','energy','qx','qy')
+    assert list(sweep.param.values) == [10,20]
+
+def test_sweep_reduced_in_one_pass(sweep_dir,monkeypatch):
+    from PyHyperScattering.integrate import WPIntegrator
+    path,expected = sweep_dir
+    integrator = WPIntegrator(force_np_backend=True)
+    calls = []
+    integrate = integrator.integrateImageStack
+    monkeypatch.setattr(integrator,'integrateImageStack',lambda data,**kwargs: calls.append(data.dims) or integrate(data,**kwargs))
+    reduced = cyrsoxsLoader(profile_time=False).loadSweep(path,r'sim_r(?P<radius>[0-9.]+)_s(?P<spacing>[0-9]+)',PhysSize=5,
+                                                         integrator=integrator)
+    assert reduced.dims == ('radius','spacing','energy','chi','q')
+    assert len(calls) == 1
+
+def test_sweep_optional_group(sweep_dir):
+    path,expected = sweep_dir
+    sweep = cyrsoxsLoader(profile_time=False).loadSweep(path,r'sim_r5_s(?P<spacing>[0-9]+)(?P<tag>_x)?',PhysSize=5)
+    # tag never matched, so it is dropped and spacing is left as the only sweep dim
+    assert sweep.dims == ('spacing','energy','qx','qy')
+    assert list(sweep.spacing.values) == [10,20]